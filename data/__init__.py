@@ -11,8 +11,14 @@ Now you can use the dataset class by specifying flag '--dataset_mode dummy'.
 See our template dataset class 'template_dataset.py' for more details.
 """
 import importlib
+import torch.distributed as dist
 import torch.utils.data
+import os
 from data.base_dataset import BaseDataset
+from data.resampling import ResamplingDataset, report_failures
+from data.bucket_sampler import BucketBatchSampler, set_dataset_buckets
+from data.resumable_sampler import ResumableBatchSampler
+from data.prefetcher import DataPrefetcher
 from torch.utils import data
 
 
@@ -50,27 +56,43 @@ def get_option_setter(dataset_name):
 def create_dataset(opt):
     dataset_class = find_dataset_using_name(opt.data_dataset_mode)
     dataset = dataset_class(opt)
+    dataset.compact_paths()
     return dataset
 
 
 def create_dataloader(opt, rank, dataset):
     data_loader = CustomDatasetDataLoader(opt, rank, dataset)
-    dataset = data_loader.load_data()
+    dataset = prefetch(opt, rank, data_loader).load_data()
     return dataset
 
 
 def create_dataset_temporal(opt):
-    dataset_class = find_dataset_using_name("temporal")
+    if opt.data_temporal_video:
+        dataset_class = find_dataset_using_name("temporal_video")
+    else:
+        dataset_class = find_dataset_using_name("temporal")
     dataset = dataset_class(opt)
+    dataset.compact_paths()
     return dataset
 
 
 def create_iterable_dataloader(opt, rank, dataset):
     data_loader = IterableCustomDatasetDataLoader(opt, rank, dataset)
-    dataset = data_loader.load_data()
+    dataset = prefetch(opt, rank, data_loader).load_data()
     return dataset
 
 
+def prefetch(opt, rank, data_loader):
+    """Load batches ahead onto the training device with --data_prefetch_batches, see data/prefetcher.py"""
+    if opt.data_prefetch_batches <= 0:
+        return data_loader
+    if getattr(opt, "use_cuda", False):
+        device = torch.device("cuda:{}".format(opt.gpu_ids[rank]))
+    else:
+        device = torch.device("cpu")
+    return DataPrefetcher(data_loader, device, depth=opt.data_prefetch_batches)
+
+
 def collate_fn(batch):
     batch = list(filter(lambda x: x is not None, batch))
     if len(batch) > 0:
@@ -79,6 +101,25 @@ def collate_fn(batch):
         return None
 
 
+def get_loader_dataset(opt, dataset):
+    """Dataset read by the dataloader, that replaces failed samples with --data_resample_failures"""
+    if not opt.data_resample_failures:
+        return dataset
+    return ResamplingDataset(
+        dataset,
+        log_path=os.path.join(opt.checkpoints_dir, opt.name, "failed_samples.txt"),
+    )
+
+
+def get_shared_seed(opt):
+    """Random seed of the run, broadcast from rank 0 so that all ranks shuffle samples alike"""
+    seed = torch.randint(2**31, (1,))
+    if dist.is_available() and dist.is_initialized():
+        seed = seed.to("cuda" if getattr(opt, "use_cuda", False) else "cpu")
+        dist.broadcast(seed, src=0)
+    return int(seed)
+
+
 class CustomDatasetDataLoader:
     """Wrapper class of Dataset class that performs multi-threaded data loading"""
 
@@ -92,23 +133,53 @@ class CustomDatasetDataLoader:
         self.dataset = dataset
         if rank == 0:
             print("dataset [%s] was created" % type(self.dataset).__name__)
-        if len(opt.gpu_ids) > 1:
-            world_size = len(opt.gpu_ids)
-            sampler = data.distributed.DistributedSampler(
-                self.dataset,
+        self.loader_dataset = get_loader_dataset(opt, self.dataset)
+        self.failures = 0
+        self.epoch = 0
+        # index in the current pass of the batch following the last one yielded
+        self.next_batch = 0
+        world_size = max(1, len(opt.gpu_ids))
+        generator = None
+        # the order of each pass is set by the seed, for resuming
+        seed = get_shared_seed(opt)
+        if opt.data_bucket_by_shape:
+            # each batch is drawn from samples of the same shape
+            batch_sampler = BucketBatchSampler(
+                set_dataset_buckets(opt, self.dataset),
+                batch_size=opt.train_batch_size,
+                shuffle=not opt.data_serial_batches,
+                drop_last=opt.data_resample_failures,
                 num_replicas=world_size,
                 rank=rank,
-                shuffle=not opt.data_serial_batches,
+                seed=seed,
             )
-            shuffle = False
         else:
-            sampler = None
-            shuffle = not opt.data_serial_batches
+            if len(opt.gpu_ids) > 1:
+                sampler = data.distributed.DistributedSampler(
+                    self.dataset,
+                    num_replicas=world_size,
+                    rank=rank,
+                    shuffle=not opt.data_serial_batches,
+                    seed=seed,
+                )
+            elif not opt.data_serial_batches:
+                generator = torch.Generator()
+                sampler = data.RandomSampler(self.loader_dataset, generator=generator)
+            else:
+                sampler = data.SequentialSampler(self.loader_dataset)
+            batch_sampler = data.BatchSampler(
+                sampler,
+                batch_size=opt.train_batch_size,
+                # with resampling, all batches have train_batch_size samples
+                drop_last=opt.data_resample_failures
+                and len(self.dataset) >= opt.train_batch_size * world_size,
+            )
+        self.batch_sampler = ResumableBatchSampler(
+            batch_sampler, generator=generator, seed=seed
+        )
         self.dataloader = torch.utils.data.DataLoader(
-            self.dataset,
-            batch_size=opt.train_batch_size,
-            sampler=sampler,
-            shuffle=shuffle,
+            self.loader_dataset,
+            batch_sampler=self.batch_sampler,
             num_workers=int(opt.data_num_threads),
             collate_fn=collate_fn,
         )
@@ -120,14 +191,38 @@ class CustomDatasetDataLoader:
         """Return the number of data in the dataset"""
         return min(len(self.dataset), self.opt.data_max_dataset_size)
 
+    def state_dict(self, next_batch=None):
+        """State to resume from, at batch index next_batch of the current pass, or after the current pass when None"""
+        if next_batch is None:
+            return {"seed": self.batch_sampler.seed, "epoch": self.epoch, "batch": 0}
+        return {
+            "seed": self.batch_sampler.seed,
+            "epoch": self.epoch - 1,
+            "batch": next_batch,
+        }
+
+    def load_state_dict(self, state):
+        """Resume from state, the next pass goes through the remaining batches of the saved pass"""
+        self.batch_sampler.seed = state["seed"]
+        self.epoch = state["epoch"]
+        self.batch_sampler.start_batch = state["batch"]
+        self.next_batch = state["batch"]
+
     def __iter__(self):
         """Return a batch of data"""
-        for i, data in enumerate(self.dataloader):
+        self.batch_sampler.set_epoch(self.epoch)
+        self.epoch += 1
+        start_batch = self.batch_sampler.start_batch
+        self.next_batch = start_batch
+        for i, data in enumerate(self.dataloader, start_batch):
             if data is None:
                 continue
             if i * self.opt.train_batch_size >= self.opt.data_max_dataset_size:
                 break
+            # batches that failed to load are skipped, so yielded batches are not counted
+            self.next_batch = i + 1
             yield data
+        self.failures = report_failures(self.loader_dataset, self.failures)
 
 
 class IterableCustomDatasetDataLoader:
@@ -143,15 +238,32 @@ class IterableCustomDatasetDataLoader:
         self.dataset = dataset
         if rank == 0:
             print("dataset [%s] was created" % type(self.dataset).__name__)
-        sampler = None
-        shuffle = not opt.data_serial_batches
+        if len(opt.gpu_ids) > 1:
+            world_size = len(opt.gpu_ids)
+            self.sampler = data.distributed.DistributedSampler(
+                self.dataset,
+                num_replicas=world_size,
+                rank=rank,
+                shuffle=not opt.data_serial_batches,
+            )
+            shuffle = False
+        else:
+            self.sampler = None
+            shuffle = not opt.data_serial_batches
+        self.loader_dataset = get_loader_dataset(opt, self.dataset)
+        self.failures = 0
         self.dataloader = torch.utils.data.DataLoader(
-            self.dataset,
+            self.loader_dataset,
             batch_size=opt.train_batch_size,
-            sampler=sampler,
+            sampler=self.sampler,
+            shuffle=shuffle,
             num_workers=int(opt.data_num_threads),
             collate_fn=collate_fn,
+            # batches keep the same size over the dataset epochs
+            drop_last=len(self.dataset)
+            >= opt.train_batch_size * max(1, len(opt.gpu_ids)),
         )
+        self.epoch = 0
 
     def load_data(self):
         return self
@@ -161,8 +273,13 @@ class IterableCustomDatasetDataLoader:
         return self.opt.data_max_dataset_size
 
     def __iter__(self):
-        """Return a batch of data"""
-        for i, data in enumerate(self.dataloader):
-            if data is None:
-                continue
-            yield data
+        """Return batches of data, going through the dataset as many times as needed"""
+        while True:
+            if self.sampler is not None:
+                self.sampler.set_epoch(self.epoch)
+            self.epoch += 1
+            for i, data in enumerate(self.dataloader):
+                if data is None:
+                    continue
+                yield data
+            self.failures = report_failures(self.loader_dataset, self.failures)
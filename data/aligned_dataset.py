@@ -20,7 +20,7 @@ class AlignedDataset(BaseDataset):
         BaseDataset.__init__(self, opt)
         self.dir_AB = os.path.join(opt.dataroot, opt.phase)  # get the image directory
         self.AB_paths = sorted(
-            make_dataset(self.dir_AB, opt.data_max_dataset_size)
+            make_dataset(self.dir_AB, opt.data_max_dataset_size, cache_dir=self.sv_dir)
         )  # get image paths
         assert (
             self.opt.data_load_size >= self.opt.data_crop_size
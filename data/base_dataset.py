@@ -16,6 +16,9 @@ import imgaug as ia
 import imgaug.augmenters as iaa
 import os
 import warnings
+from data.packed_shards import ShardReader, SHARDS_DIRNAME
+from data.path_store import PathStore, is_path_list
+from util.batch_aug import BatchGeometricAug
 
 
 class BaseDataset(data.Dataset, ABC):
@@ -39,6 +42,7 @@ class BaseDataset(data.Dataset, ABC):
         self.sv_dir = os.path.join(opt.checkpoints_dir, opt.name)
         self.warning_mode = self.opt.warning_mode
         self.set_dataset_dirs_and_dims()
+        self.set_shards()
 
     @staticmethod
     def modify_commandline_options(parser, is_train):
@@ -88,10 +92,17 @@ class BaseDataset(data.Dataset, ABC):
             A_label_cls = None
 
         if hasattr(self, "B_img_paths"):
+            if hasattr(self, "B_bucket_indices"):
+                # B image of the same shape as A, see data/bucket_sampler.py
+                B_indices = self.B_bucket_indices[
+                    self.A_bucket_ids[index % self.A_size]
+                ]
+            else:
+                B_indices = range(self.B_size)
             if self.opt.data_serial_batches:  # make sure index is within then range
-                index_B = index % self.B_size
+                index_B = B_indices[index % len(B_indices)]
             else:  # randomize the index for domain B to avoid fixed pairs.
-                index_B = random.randint(0, self.B_size - 1)
+                index_B = B_indices[random.randint(0, len(B_indices) - 1)]
 
             B_img_path = self.B_img_paths[index_B]
 
@@ -157,6 +168,51 @@ class BaseDataset(data.Dataset, ABC):
                 self.opt.dataroot, self.opt.phase + "A"
             )  # create a path '/path/to/data/trainA'
 
+    def set_shards(self):
+        """Open the packed shards of the domain directories, if any (see data/packed_shards.py)"""
+        if not self.opt.data_shards:
+            self.shards = None
+            return
+
+        shard_dirs = [
+            os.path.join(cur_dir, SHARDS_DIRNAME)
+            for cur_dir in [
+                self.dir_A,
+                self.dir_B,
+                os.path.join(self.opt.dataroot, "validationA"),
+                os.path.join(self.opt.dataroot, "validationB"),
+                self.opt.dataroot,
+            ]
+        ]
+        self.shards = ShardReader(shard_dirs, root=self.root)
+        if len(self.shards) == 0:
+            warnings.warn(
+                "--data_shards is set but no packed shards were found in %s" % self.root
+            )
+            self.shards = None
+        else:
+            print("%d files found in packed shards" % len(self.shards))
+
+    def compact_paths(self):
+        """Replace the lists of paths of the dataset with PathStore arrays (see data/path_store.py).
+
+        Called once the dataset is built. With --data_paths_mmap, stores are memory-mapped
+        from files in the checkpoints directory, and shared by ranks and dataloader workers.
+        """
+        store_dir = None
+        if getattr(self.opt, "data_paths_mmap", False):
+            store_dir = os.path.join(self.sv_dir, "paths_store")
+
+        for name, value in list(vars(self).items()):
+            if not is_path_list(value):
+                continue
+            store = PathStore.from_list(value)
+            if store_dir is not None:
+                store = store.save(
+                    os.path.join(store_dir, type(self).__name__ + "_" + name)
+                )
+            setattr(self, name, store)
+
     def get_validation_set(self, size):
         return_A_list = []
         return_B_list = []
@@ -290,7 +346,10 @@ def get_transform(
             transforms.Lambda(lambda img: __make_power_2(img, base=4, method=method))
         )
 
-    if not opt.dataaug_no_flip:
+    # with dataaug_batch_geometric, geometric augmentations are applied to batches by the model
+    batch_geometric = getattr(opt, "dataaug_batch_geometric", False)
+
+    if not opt.dataaug_no_flip and not batch_geometric:
         if params is None:
             transform_list.append(transforms.RandomHorizontalFlip())
         elif params["flip"]:
@@ -298,10 +357,10 @@ def get_transform(
                 transforms.Lambda(lambda img: __flip(img, params["flip"]))
             )
 
-    if not opt.dataaug_no_rotate:
+    if not opt.dataaug_no_rotate and not batch_geometric:
         transform_list.append(transforms.RandomRotation([-90, 180]))
 
-    if opt.dataaug_affine:
+    if opt.dataaug_affine and not batch_geometric:
         transform_list.append(
             transforms.RandomAffine(
                 0,
@@ -311,10 +370,13 @@ def get_transform(
             )
         )
 
-    if opt.dataaug_imgaug and not grayscale:
+    if opt.dataaug_imgaug and not grayscale and not batch_imgaug(opt):
         transform_list.append(RandomImgAug(with_mask=False))
 
-    if convert:
+    if convert and getattr(opt, "data_uint8", False):
+        # normalized on device by the model
+        transform_list += [transforms.PILToTensor()]
+    elif convert:
         transform_list += [transforms.ToTensor()]
         if grayscale:
             transform_list += [transforms.Normalize((0.5,), (0.5,))]
@@ -331,7 +393,7 @@ def __make_power_2(img, base, method=InterpolationMode.BICUBIC):
         return img
 
     __print_size_warning(ow, oh, w, h)
-    return img.resize((w, h), interpolation=method)
+    return F.resize(img, [h, w], interpolation=method)
 
 
 def __scale_width(img, target_width, method=InterpolationMode.BICUBIC):
@@ -340,7 +402,7 @@ def __scale_width(img, target_width, method=InterpolationMode.BICUBIC):
         return img
     w = target_width
     h = int(target_width * oh / ow)
-    return img.resize((w, h), interpolation=method)
+    return F.resize(img, [h, w], interpolation=method)
 
 
 def __crop(img, pos, size):
@@ -391,17 +453,20 @@ def get_transform_seg(
     if "crop" in opt.data_preprocess:
         transform_list.append(RandomCropMask(opt.data_crop_size + margin))
 
-    if opt.dataaug_imgaug:
+    if opt.dataaug_imgaug and not batch_imgaug(opt):
         if not grayscale:
             transform_list.append(RandomImgAug())
 
-    if not opt.dataaug_no_flip:
+    # with dataaug_batch_geometric, geometric augmentations are applied to batches by the model
+    batch_geometric = getattr(opt, "dataaug_batch_geometric", False)
+
+    if not opt.dataaug_no_flip and not batch_geometric:
         transform_list.append(RandomHorizontalFlipMask())
 
-    if not opt.dataaug_no_rotate:
+    if not opt.dataaug_no_rotate and not batch_geometric:
         transform_list.append(RandomRotationMask(degrees=0))
 
-    if opt.dataaug_affine:
+    if opt.dataaug_affine and not batch_geometric:
         raff = RandomAffineMask(degrees=0)
         raff.set_params(
             opt.dataaug_affine,
@@ -412,12 +477,16 @@ def get_transform_seg(
         )
         transform_list.append(raff)
 
-    transform_list += [ToTensorMask()]
-
-    if grayscale:
-        transform_list += [NormalizeMask((0.5,), (0.5,))]
+    if getattr(opt, "data_uint8", False):
+        # normalized on device by the model
+        transform_list += [ToTensorMask(uint8=True)]
     else:
-        transform_list += [NormalizeMask((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]
+        transform_list += [ToTensorMask()]
+
+        if grayscale:
+            transform_list += [NormalizeMask((0.5,), (0.5,))]
+        else:
+            transform_list += [NormalizeMask((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]
 
     return ComposeMask(transform_list)
 
@@ -591,8 +660,13 @@ class ToTensorMask(transforms.ToTensor):
     or if the numpy.ndarray has dtype = np.uint8
 
     In the other cases, tensors are returned without scaling.
+
+    With uint8, images and masks are returned as uint8 tensors, without scaling.
     """
 
+    def __init__(self, uint8=False):
+        self.uint8 = uint8
+
     def __call__(self, img, mask):
         """
         Args:
@@ -601,6 +675,11 @@ class ToTensorMask(transforms.ToTensor):
         Returns:
             Tensor: Converted image.
         """
+        if self.uint8:
+            return (
+                F.pil_to_tensor(img),
+                torch.from_numpy(np.array(mask, dtype=np.uint8)).unsqueeze(0),
+            )
         return (
             F.to_tensor(img),
             torch.from_numpy(np.array(mask, dtype=np.int64)).unsqueeze(0),
@@ -712,6 +791,11 @@ class RandomAffineMask(transforms.RandomAffine):
             return img, mask
 
 
+def batch_imgaug(opt):
+    """Whether random image augmentation is applied to batches by the model (see util/batch_aug.py)."""
+    return getattr(opt, "dataaug_imgaug_backend", "imgaug") == "batch"
+
+
 def sometimes(aug):
     return iaa.Sometimes(0.5, aug)
 
@@ -844,12 +928,16 @@ def get_transform_list(
         )
         transform_list.append(raff)
 
-    transform_list += [ToTensorMaskList()]
-
-    if grayscale:
-        transform_list += [NormalizeMaskList((0.5,), (0.5,))]
+    if getattr(opt, "data_uint8", False):
+        # normalized on device by the model
+        transform_list += [ToTensorMaskList(uint8=True)]
     else:
-        transform_list += [NormalizeMaskList((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]
+        transform_list += [ToTensorMaskList()]
+
+        if grayscale:
+            transform_list += [NormalizeMaskList((0.5,), (0.5,))]
+        else:
+            transform_list += [NormalizeMaskList((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]
 
     return ComposeMaskList(transform_list)
 
@@ -1059,8 +1147,13 @@ class ToTensorMaskList(transforms.ToTensor):
     or if the numpy.ndarray has dtype = np.uint8
 
     In the other cases, tensors are returned without scaling.
+
+    With uint8, images and masks are returned as uint8 tensors, without scaling.
     """
 
+    def __init__(self, uint8=False):
+        self.uint8 = uint8
+
     def __call__(self, imgs, masks):
         """
         Args:
@@ -1071,11 +1164,15 @@ class ToTensorMaskList(transforms.ToTensor):
         """
         return_imgs, return_masks = [], []
         for img in imgs:
-            return_imgs.append(F.to_tensor(img))
+            if self.uint8:
+                return_imgs.append(F.pil_to_tensor(img))
+            else:
+                return_imgs.append(F.to_tensor(img))
         if masks is not None:
+            mask_dtype = np.uint8 if self.uint8 else np.int64
             for mask in masks:
                 return_masks.append(
-                    torch.from_numpy(np.array(mask, dtype=np.int64)).unsqueeze(0)
+                    torch.from_numpy(np.array(mask, dtype=mask_dtype)).unsqueeze(0)
                 )
         else:
             return_masks = None
@@ -1210,3 +1307,113 @@ class RandomAffineMaskList(transforms.RandomAffine):
             return return_imgs, return_masks
         else:
             return imgs, masks
+
+
+def get_transform_tensor_list(opt, grayscale=False, method=InterpolationMode.BICUBIC):
+    """Same transforms as get_transform_list, applied at once to a stack of frames as tensors."""
+
+    margin = opt.data_online_context_pixels * 2
+
+    if "resize" in opt.data_preprocess:
+        load_size = [opt.data_load_size + margin, opt.data_load_size + margin]
+    else:
+        load_size = None
+
+    if "crop" in opt.data_preprocess:
+        crop_size = [opt.data_crop_size + margin, opt.data_crop_size + margin]
+    else:
+        crop_size = None
+
+    # with dataaug_batch_geometric, geometric augmentations are applied to batches by the model
+    batch_geometric = getattr(opt, "dataaug_batch_geometric", False)
+
+    return TensorListTransform(
+        grayscale=grayscale,
+        load_size=load_size,
+        crop_size=crop_size,
+        flip=not opt.dataaug_no_flip and not batch_geometric,
+        rotate=not opt.dataaug_no_rotate and not batch_geometric,
+        affine=0.0 if batch_geometric else opt.dataaug_affine,
+        affine_translate=opt.dataaug_affine_translate,
+        affine_scale_min=opt.dataaug_affine_scale_min,
+        affine_scale_max=opt.dataaug_affine_scale_max,
+        affine_shear=opt.dataaug_affine_shear,
+        uint8=getattr(opt, "data_uint8", False),
+        method=method,
+    )
+
+
+class TensorListTransform:
+    """Resize, random crop, flip, rotation and affine transforms of a list of frames.
+
+    Frames are given as a (N, C, H, W) uint8 tensor and their masks as a (N, 1, H, W)
+    uint8 tensor, and all of them get the same random transforms, each computed with
+    a single tensor op over the whole stack. Flip, rotation and affine transforms are
+    composed and applied with BatchGeometricAug, with parameters shared by all frames.
+
+    Returns float frames normalized to [-1, 1] and int64 masks, or uint8 frames and
+    masks with uint8, as ToTensorMaskList and NormalizeMaskList do.
+    """
+
+    def __init__(
+        self,
+        grayscale=False,
+        load_size=None,
+        crop_size=None,
+        flip=True,
+        rotate=True,
+        affine=0.0,
+        affine_translate=0.2,
+        affine_scale_min=0.8,
+        affine_scale_max=1.2,
+        affine_shear=45,
+        uint8=False,
+        method=InterpolationMode.BICUBIC,
+    ):
+        self.grayscale = grayscale
+        self.load_size = load_size
+        self.crop_size = crop_size
+        self.uint8 = uint8
+        self.method = method
+        self.geometric_aug = BatchGeometricAug(
+            flip=flip,
+            rotate=rotate,
+            right_angles=True,
+            affine=affine,
+            translate=affine_translate,
+            scale_min=affine_scale_min,
+            scale_max=affine_scale_max,
+            shear=affine_shear,
+        )
+        self.geometric = flip or rotate or affine > 0
+
+    def __call__(self, imgs, masks=None):
+        if self.grayscale:
+            imgs = F.rgb_to_grayscale(imgs, num_output_channels=1)
+
+        if self.load_size is not None:
+            imgs = F.resize(imgs, self.load_size, interpolation=self.method)
+            if masks is not None:
+                masks = F.resize(
+                    masks, self.load_size, interpolation=InterpolationMode.NEAREST
+                )
+
+        if self.crop_size is not None:
+            i, j, h, w = transforms.RandomCrop.get_params(imgs, self.crop_size)
+            imgs = imgs[..., i : i + h, j : j + w]
+            if masks is not None:
+                masks = masks[..., i : i + h, j : j + w]
+
+        if self.geometric:
+            height, width = imgs.shape[-2:]
+            params = self.geometric_aug.get_params(1, height, width, imgs.device)
+            imgs, masks, _ = self.geometric_aug(
+                imgs, masks, params=params.expand(imgs.shape[0], 3, 3)
+            )
+
+        if not self.uint8:
+            imgs = imgs.float() / 127.5 - 1.0
+            if masks is not None:
+                masks = masks.long()
+
+        return imgs, masks
@@ -0,0 +1,218 @@
+"""Batches of samples that have the same shape after preprocessing.
+
+With --data_preprocess scale_width (or none), images keep their aspect ratio and samples
+have different shapes, so that batches cannot be stacked beyond one image and
+cudnn.benchmark has to be turned off. With --data_bucket_by_shape, samples are grouped
+into buckets by their shape after preprocessing, computed from image sizes read once
+from the image headers and saved in the checkpoints directory, and each batch is drawn
+from a single bucket.
+
+For unaligned datasets, the domain B image of a sample is drawn among the images of
+the same shape as its domain A image (see BaseDataset.__getitem__), samples without
+such a B image are left out.
+"""
+import os
+import random
+import numpy as np
+import torch.utils.data
+from data.packed_shards import open_image
+
+
+def read_image_sizes(paths, root=None, relative_paths=False, shards=None):
+    """(n, 2) int64 array of the (width, height) of images read from their headers, -1 for unreadable ones"""
+    sizes = np.full((len(paths), 2), -1, dtype=np.int64)
+    for i, path in enumerate(paths):
+        full_path = os.path.join(root, path) if relative_paths else path
+        try:
+            with open_image(full_path, shards) as img:
+                sizes[i] = img.size
+        except Exception as e:
+            print("failed reading size of image ", full_path)
+            print(e)
+    return sizes
+
+
+def load_image_sizes(sizes_path, paths, root=None, relative_paths=False, shards=None):
+    """Load the image sizes saved at sizes_path, read them again when they are not for the same files."""
+    paths = np.array(list(paths))
+    if os.path.isfile(sizes_path):
+        try:
+            saved = np.load(sizes_path)
+            if np.array_equal(saved["paths"], paths):
+                print("image sizes loaded from ", sizes_path)
+                return saved["sizes"]
+        except Exception as e:
+            print("failed loading image sizes at ", sizes_path)
+            print(e)
+
+    print("reading image sizes")
+    sizes = read_image_sizes(paths.tolist(), root, relative_paths, shards)
+    try:
+        np.savez(sizes_path, paths=paths, sizes=sizes)
+        print("image sizes saved at ", sizes_path)
+    except Exception as e:
+        print("failed saving image sizes at ", sizes_path)
+        print(e)
+    return sizes
+
+
+def get_preprocessed_sizes(opt, sizes):
+    """(width, height) of images after preprocessing, as done by get_transform"""
+    widths, heights = sizes[:, 0], sizes[:, 1]
+    if opt.data_preprocess == "scale_width":
+        target_width = opt.data_load_size
+        scaled = widths != target_width
+        heights = np.where(
+            scaled, target_width * heights // np.maximum(widths, 1), heights
+        )
+        widths = np.where(scaled, target_width, widths)
+    elif opt.data_preprocess == "none":
+        # images are resized to multiples of 4
+        widths = np.round(widths / 4).astype(np.int64) * 4
+        heights = np.round(heights / 4).astype(np.int64) * 4
+    else:
+        raise ValueError(
+            "--data_bucket_by_shape is for --data_preprocess scale_width or none, samples all have the same shape with %s"
+            % opt.data_preprocess
+        )
+    return np.stack([widths, heights], axis=1)
+
+
+def set_dataset_buckets(opt, dataset):
+    """Group the samples of dataset by shape, and return the bucket of each sample, -1 for left out samples.
+
+    For unaligned datasets, the domain B images of each bucket are set to dataset.B_bucket_indices.
+    """
+    sv_dir = os.path.join(opt.checkpoints_dir, opt.name)
+    kwargs = {
+        "root": dataset.root,
+        "relative_paths": opt.data_relative_paths,
+        "shards": dataset.shards,
+    }
+
+    if hasattr(dataset, "AB_paths"):  # aligned images, side by side
+        sizes = load_image_sizes(
+            os.path.join(sv_dir, "image_sizes_%s_AB.npz" % opt.phase),
+            dataset.AB_paths,
+            root=None,
+        )
+        sizes[:, 0] //= 2
+        B_sizes = None
+    else:
+        sizes = load_image_sizes(
+            os.path.join(sv_dir, "image_sizes_%s_A.npz" % opt.phase),
+            dataset.A_img_paths,
+            **kwargs
+        )
+        if hasattr(dataset, "B_img_paths"):
+            B_sizes = load_image_sizes(
+                os.path.join(sv_dir, "image_sizes_%s_B.npz" % opt.phase),
+                dataset.B_img_paths,
+                **kwargs
+            )
+        else:
+            B_sizes = None
+
+    shapes = get_preprocessed_sizes(opt, sizes)
+    valid = (sizes >= 0).all(axis=1)
+    keys, bucket_ids = np.unique(shapes, axis=0, return_inverse=True)
+    bucket_ids = np.where(valid, bucket_ids.reshape(-1), -1)
+
+    if B_sizes is not None:
+        B_shapes = get_preprocessed_sizes(opt, B_sizes)
+        B_valid = (B_sizes >= 0).all(axis=1)
+        dataset.B_bucket_indices = []
+        for bucket_id, key in enumerate(keys):
+            B_indices = np.nonzero(B_valid & (B_shapes == key).all(axis=1))[0]
+            dataset.B_bucket_indices.append(B_indices)
+            if len(B_indices) == 0:
+                bucket_ids[bucket_ids == bucket_id] = -1
+
+    dataset.A_bucket_ids = bucket_ids
+
+    nb_left_out = int((bucket_ids == -1).sum())
+    print(
+        "%d samples in %d shape buckets, %d samples left out"
+        % (
+            len(bucket_ids) - nb_left_out,
+            len(np.unique(bucket_ids[bucket_ids >= 0])),
+            nb_left_out,
+        )
+    )
+    return bucket_ids
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """Batch sampler that draws each batch from a single bucket of samples.
+
+    Batches are shuffled within and across buckets at every epoch, and split between
+    ranks when training on several GPUs, as with DistributedSampler.
+
+    Parameters:
+        bucket_ids (np.ndarray) -- bucket of each sample, -1 for samples that are left out
+        batch_size (int)        -- samples per batch
+        shuffle (bool)          -- whether to shuffle samples, otherwise batches follow the sample order
+        drop_last (bool)        -- whether to drop the last incomplete batch of each bucket
+        num_replicas (int)      -- number of ranks
+        rank (int)              -- rank of the current process
+        seed (int)              -- shuffling seed, shared by all ranks
+    """
+
+    def __init__(
+        self,
+        bucket_ids,
+        batch_size,
+        shuffle=True,
+        drop_last=False,
+        num_replicas=1,
+        rank=0,
+        seed=0,
+    ):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.buckets = [
+            np.nonzero(bucket_ids == bucket_id)[0]
+            for bucket_id in np.unique(bucket_ids)
+            if bucket_id >= 0
+        ]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_batches(self):
+        rng = random.Random(self.seed + self.epoch)
+        batches = []
+        for bucket in self.buckets:
+            indices = bucket.tolist()
+            if self.shuffle:
+                rng.shuffle(indices)
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start : start + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    continue
+                batches.append(batch)
+        if self.shuffle:
+            rng.shuffle(batches)
+        else:
+            batches.sort(key=lambda batch: batch[0])
+
+        # all ranks go through the same number of batches
+        nb_batches = len(batches) // self.num_replicas * self.num_replicas
+        return batches[self.rank : nb_batches : self.num_replicas]
+
+    def __iter__(self):
+        return iter(self.get_batches())
+
+    def __len__(self):
+        nb_batches = 0
+        for bucket in self.buckets:
+            if self.drop_last:
+                nb_batches += len(bucket) // self.batch_size
+            else:
+                nb_batches += (len(bucket) + self.batch_size - 1) // self.batch_size
+        return nb_batches // self.num_replicas
@@ -38,7 +38,7 @@ class ColorizationDataset(BaseDataset):
         """
         BaseDataset.__init__(self, opt)
         self.dir = os.path.join(opt.dataroot, opt.phase)
-        self.AB_paths = sorted(make_dataset(self.dir, opt.max_dataset_size))
+        self.AB_paths = sorted(make_dataset(self.dir, opt.max_dataset_size, cache_dir=self.sv_dir))
         self.transform = get_transform(self.opt, convert=False)
 
     def __getitem__(self, index):
@@ -0,0 +1,401 @@
+"""Offline crop bank for the online creation datasets.
+
+Crops and masks are computed once with 'crop_image' parameters, a given number of times
+around each bbox of the domain, and stored as uint8 arrays in memory-mapped .npy files:
+    /path/to/checkpoints/name/crop_bank_A/params.json
+    /path/to/checkpoints/name/crop_bank_A/imgs.npy      (slots, size, size, 3)
+    /path/to/checkpoints/name/crop_bank_A/masks.npy     (slots, size, size)
+    /path/to/checkpoints/name/crop_bank_A/index.npz     image and bbox of each crop
+    /path/to/checkpoints/name/crop_bank_A/img_paths.*.npy, label_paths.*.npy
+                                                        paths of the images with crops (PathStore)
+    /path/to/checkpoints/name/crop_bank_A/slot_map.npy  physical slot of each crop
+    /path/to/checkpoints/name/crop_bank_A/generations.npy  generation of each physical slot
+
+Samples are drawn at random from the bank, which costs a copy per sample instead of
+decoding and cropping an image. To keep crops diverse over long trainings, a background
+process started with the training can regenerate a fraction of the bank periodically.
+New crops are written to spare slots that no crop points to, and slot_map is updated
+afterwards. A reader may still hold a physical slot that has been freed and is being
+overwritten, so the generation of a slot is odd while it is written and incremented
+again when it is complete, and readers copy a crop again until its generation is even
+and unchanged by the copy.
+"""
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import random
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+from data.online_creation import crop_images, file_signature
+from data.path_store import PathStore
+
+BANK_PARAMS_FILENAME = "params.json"
+BANK_INDEX_FILENAME = "index.npz"
+
+
+def _compute_bank_crops(args):
+    """Compute nb_crops_per_bbox crops around each bbox of an image, as uint8 arrays."""
+    img_id, img_path, label_path, bboxes, refs, crop_kwargs, shards = args
+    try:
+        crops = crop_images(
+            img_path,
+            label_path,
+            nb_crops=len(refs),
+            idx_bbox_refs=refs,
+            return_refs=True,
+            shards=shards,
+            bboxes=bboxes,
+            **crop_kwargs,
+        )
+    except Exception:
+        return img_id, []
+    return img_id, [
+        (ref, np.array(img.convert("RGB")), np.array(mask)) for ref, img, mask in crops
+    ]
+
+
+def paths_hash(img_paths, label_paths, root=None, relative_paths=False):
+    """Hash of the image and bbox paths of a domain and of the signatures of their files.
+
+    The bank is built again when a file is added, removed or modified. Files only
+    available from packed shards have no signature, and only their paths are hashed.
+    """
+    sha = hashlib.sha1()
+    for img_path, label_path in zip(img_paths, label_paths):
+        signatures = []
+        for path in [img_path, label_path]:
+            if path is not None and relative_paths:
+                path = os.path.join(root, path)
+            signatures.append(file_signature(path))
+        sha.update(json.dumps([img_path, label_path, signatures]).encode())
+    return sha.hexdigest()
+
+
+class CropBank:
+    """Memory-mapped bank of crops and masks of a domain.
+
+    Arrays are mapped lazily in the process that reads them, so the bank can be pickled
+    to dataloader workers and spawned processes without copying its content.
+
+    Parameters:
+        bank_dir (str)  -- bank directory
+        writable (bool) -- whether crops are written (refresh), read-only otherwise
+    """
+
+    def __init__(self, bank_dir, writable=False):
+        self.bank_dir = bank_dir
+        self.writable = writable
+
+        index = np.load(os.path.join(bank_dir, BANK_INDEX_FILENAME))
+        self.img_paths = PathStore.load(os.path.join(bank_dir, "img_paths"))
+        self.label_paths = PathStore.load(os.path.join(bank_dir, "label_paths"))
+        self.img_ids = index["img_ids"]
+        self.bbox_refs = index["bbox_refs"]
+        self.nb_physical_slots = int(index["nb_physical_slots"])
+
+        self._pid = None
+
+    def __len__(self):
+        return len(self.img_ids)
+
+    def _map(self):
+        if self._pid != os.getpid():
+            mode = "r+" if self.writable else "r"
+            self.imgs = np.load(os.path.join(self.bank_dir, "imgs.npy"), mmap_mode=mode)
+            self.masks = np.load(
+                os.path.join(self.bank_dir, "masks.npy"), mmap_mode=mode
+            )
+            self.slot_map = np.load(
+                os.path.join(self.bank_dir, "slot_map.npy"), mmap_mode=mode
+            )
+            self.generations = np.load(
+                os.path.join(self.bank_dir, "generations.npy"), mmap_mode=mode
+            )
+            self._pid = os.getpid()
+
+    def get(self, slot):
+        """Return img_path, label_path, img and mask (PIL images) of a crop."""
+        self._map()
+        while True:
+            physical_slot = int(self.slot_map[slot])
+            generation = int(self.generations[physical_slot])
+            if generation % 2 == 1:  # being written
+                continue
+            img = np.array(self.imgs[physical_slot])
+            mask = np.array(self.masks[physical_slot])
+            # the slot was freed and written again during the copy
+            if int(self.generations[physical_slot]) == generation:
+                break
+        img_id = self.img_ids[slot]
+        return (
+            self.img_paths[img_id],
+            self.label_paths[img_id],
+            Image.fromarray(img),
+            Image.fromarray(mask),
+        )
+
+    def sample(self):
+        return self.get(random.randint(0, len(self) - 1))
+
+    def refresh(
+        self, crop_kwargs, bbox_index, root=None, relative_paths=False, shards=None
+    ):
+        """Regenerate as many random crops as there are spare slots."""
+        self._map()
+        spare_slots = np.setdiff1d(
+            np.arange(self.nb_physical_slots), np.asarray(self.slot_map)
+        )
+        if len(spare_slots) == 0:
+            return 0
+
+        slots = np.random.choice(len(self), len(spare_slots), replace=False)
+        nb_refreshed = 0
+        for slot in slots:
+            img_id = self.img_ids[slot]
+            img_path = self.img_paths[img_id]
+            label_path = self.label_paths[img_id]
+            bboxes = bbox_index.get(label_path)
+            if relative_paths:
+                img_path = os.path.join(root, img_path)
+                label_path = os.path.join(root, label_path)
+            _, crops = _compute_bank_crops(
+                (
+                    img_id,
+                    img_path,
+                    label_path,
+                    bboxes,
+                    [int(self.bbox_refs[slot])],
+                    crop_kwargs,
+                    shards,
+                )
+            )
+            if len(crops) == 0:
+                continue
+
+            _, img, mask = crops[0]
+            physical_slot = spare_slots[nb_refreshed]
+            self.generations[physical_slot] += 1
+            self.generations.flush()
+            self.imgs[physical_slot] = img
+            self.masks[physical_slot] = mask
+            self.imgs.flush()
+            self.masks.flush()
+            self.generations[physical_slot] += 1
+            self.generations.flush()
+            # the crop is complete before it is pointed to
+            self.slot_map[slot] = physical_slot
+            nb_refreshed += 1
+
+        self.slot_map.flush()
+        return nb_refreshed
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ["imgs", "masks", "slot_map", "generations"]:
+            state.pop(key, None)
+        state["_pid"] = None
+        return state
+
+
+def load_or_build_crop_bank(
+    bank_dir,
+    img_paths,
+    label_paths,
+    bbox_index,
+    nb_crops_per_bbox,
+    crop_kwargs,
+    refresh_fraction=0.0,
+    root=None,
+    relative_paths=False,
+    shards=None,
+    num_workers=0,
+):
+    """Open the crop bank saved in bank_dir, build it first if it is missing or outdated.
+
+    Parameters:
+        bank_dir (str)            -- bank directory
+        img_paths (str list)      -- images of the domain
+        label_paths (str list)    -- bbox files of the images
+        bbox_index (BBoxIndex)    -- bboxes of the domain
+        nb_crops_per_bbox (int)   -- number of crops computed around each bbox
+        crop_kwargs (dict)        -- crop_image parameters
+        refresh_fraction (float)  -- fraction of the bank that can be regenerated at once
+        root (str)                -- dataroot
+        relative_paths (bool)     -- whether paths are relative to root
+        shards (ShardReader)      -- packed shards to read files from, if any
+        num_workers (int)         -- number of processes computing crops
+    """
+    params = {
+        "crop_kwargs": crop_kwargs,
+        "nb_crops_per_bbox": nb_crops_per_bbox,
+        "refresh_fraction": refresh_fraction,
+        "nb_images": len(img_paths),
+        "paths_hash": paths_hash(img_paths, label_paths, root, relative_paths),
+    }
+    params_path = os.path.join(bank_dir, BANK_PARAMS_FILENAME)
+    # banks saved without path stores and slot generations are built again
+    if os.path.isfile(params_path) and os.path.isfile(
+        os.path.join(bank_dir, "generations.npy")
+    ):
+        with open(params_path, "r") as f:
+            if json.load(f) == params:
+                print("crop bank loaded from ", bank_dir)
+                return CropBank(bank_dir)
+        print("crop bank parameters changed, building it again")
+
+    os.makedirs(bank_dir, exist_ok=True)
+    if os.path.isfile(params_path):
+        os.remove(params_path)
+
+    tasks = []
+    nb_max_slots = 0
+    for img_id, (img_path, label_path) in enumerate(zip(img_paths, label_paths)):
+        bboxes = bbox_index.get(label_path)
+        if bboxes is None or len(bboxes) == 0:
+            continue
+        refs = [j for j in range(len(bboxes)) for k in range(nb_crops_per_bbox)]
+        nb_max_slots += len(refs)
+        if relative_paths:
+            img_path = os.path.join(root, img_path)
+            label_path = os.path.join(root, label_path)
+        tasks.append((img_id, img_path, label_path, bboxes, refs, crop_kwargs, shards))
+    nb_max_slots += math.ceil(refresh_fraction * nb_max_slots)
+
+    size = crop_kwargs["output_dim"] + 2 * crop_kwargs["context_pixels"]
+    print(
+        "building crop bank of %d crops of size %d in %s"
+        % (nb_max_slots, size, bank_dir)
+    )
+    imgs = np.lib.format.open_memmap(
+        os.path.join(bank_dir, "imgs.npy"),
+        mode="w+",
+        dtype=np.uint8,
+        shape=(max(1, nb_max_slots), size, size, 3),
+    )
+    masks = np.lib.format.open_memmap(
+        os.path.join(bank_dir, "masks.npy"),
+        mode="w+",
+        dtype=np.uint8,
+        shape=(max(1, nb_max_slots), size, size),
+    )
+
+    pool = None
+    if num_workers > 0:
+        pool = multiprocessing.Pool(num_workers)
+        results = pool.imap(_compute_bank_crops, tasks, chunksize=16)
+    else:
+        results = map(_compute_bank_crops, tasks)
+
+    img_ids = []
+    bbox_refs = []
+    try:
+        for img_id, crops in tqdm(results, total=len(tasks)):
+            for ref, img, mask in crops:
+                if img.shape[:2] != (size, size):
+                    continue
+                slot = len(img_ids)
+                imgs[slot] = img
+                masks[slot] = mask
+                img_ids.append(img_id)
+                bbox_refs.append(ref)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    imgs.flush()
+    masks.flush()
+    del imgs, masks
+
+    nb_slots = len(img_ids)
+    if nb_slots == 0:
+        raise ValueError(f"No crop could be computed for crop bank {bank_dir}")
+    nb_physical_slots = nb_slots + math.ceil(refresh_fraction * nb_slots)
+    np.save(os.path.join(bank_dir, "slot_map.npy"), np.arange(nb_slots, dtype=np.int64))
+    np.save(
+        os.path.join(bank_dir, "generations.npy"),
+        np.zeros(nb_physical_slots, dtype=np.int64),
+    )
+    # only the paths of the images with crops are kept
+    bank_img_ids, img_ids = np.unique(img_ids, return_inverse=True)
+    PathStore.from_list([img_paths[i] for i in bank_img_ids]).save(
+        os.path.join(bank_dir, "img_paths")
+    )
+    PathStore.from_list([label_paths[i] for i in bank_img_ids]).save(
+        os.path.join(bank_dir, "label_paths")
+    )
+    np.savez(
+        os.path.join(bank_dir, BANK_INDEX_FILENAME),
+        img_ids=img_ids.astype(np.int64),
+        bbox_refs=np.array(bbox_refs, dtype=np.int64),
+        nb_physical_slots=nb_physical_slots,
+    )
+    with open(params_path, "w") as f:
+        json.dump(params, f)
+    print("crop bank of %d crops saved in %s" % (nb_slots, bank_dir))
+
+    return CropBank(bank_dir)
+
+
+def _refresh_loop(
+    stop, bank_dir, crop_kwargs, bbox_index, period, root, relative_paths, shards
+):
+    bank = CropBank(bank_dir, writable=True)
+    while not stop.wait(period):
+        try:
+            bank.refresh(crop_kwargs, bbox_index, root, relative_paths, shards)
+        except Exception as e:
+            print("crop bank refresh failed for ", bank_dir)
+            print(e)
+
+
+class CropBankRefresher:
+    """Process that regenerates part of a crop bank every period seconds.
+
+    It is started and closed by the training loop, see train.py.
+
+    Parameters:
+        bank_dir (str)         -- bank directory
+        crop_kwargs (dict)     -- crop_image parameters
+        bbox_index (BBoxIndex) -- bboxes of the domain
+        period (float)         -- period in seconds of refreshes
+        root (str)             -- dataroot
+        relative_paths (bool)  -- whether paths are relative to root
+        shards (ShardReader)   -- packed shards to read files from, if any
+    """
+
+    def __init__(
+        self,
+        bank_dir,
+        crop_kwargs,
+        bbox_index,
+        period,
+        root=None,
+        relative_paths=False,
+        shards=None,
+    ):
+        # the training process may have initialized CUDA, which cannot be forked
+        context = multiprocessing.get_context("spawn")
+        self.stop = context.Event()
+        self.process = context.Process(
+            target=_refresh_loop,
+            args=(
+                self.stop,
+                bank_dir,
+                crop_kwargs,
+                bbox_index,
+                period,
+                root,
+                relative_paths,
+                shards,
+            ),
+            daemon=True,
+        )
+        self.process.start()
+
+    def close(self):
+        """Stop the process, after the refresh in progress if any"""
+        self.stop.set()
+        self.process.join()
@@ -9,8 +9,10 @@ import torch.utils.data as data
 from PIL import Image
 import os
 import os.path
-import glob
+import hashlib
+import json
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 IMG_EXTENSIONS = [
     ".jpg",
@@ -28,43 +30,165 @@ IMG_EXTENSIONS = [
     ".tiff",
     ".TIFF",
 ]
+IMG_EXTENSIONS_TUPLE = tuple(IMG_EXTENSIONS)
+
+LISTING_CACHE_VERSION = 1
+# default directory of listing caches, datasets use their checkpoints directory instead
+LISTING_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+    "joligan",
+    "listings",
+)
 
 
 def is_image_file(filename):
-    return any(filename.endswith(extension) for extension in IMG_EXTENSIONS)
+    return filename.endswith(IMG_EXTENSIONS_TUPLE)
+
 
+def _scan_one_dir(path, cached):
+    """List the image files and the subdirectories of a single directory.
+
+    The cached listing is reused if the directory mtime did not change, i.e. no entry was
+    added, removed or renamed in it.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    if cached is not None and cached[0] == mtime:
+        return cached
+    files = []
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                # symbolic links to directories are not followed, as with os.walk
+                if not entry.is_symlink():
+                    subdirs.append(entry.name)
+            elif is_image_file(entry.name):
+                files.append(entry.name)
+    return [mtime, sorted(files), sorted(subdirs)]
+
+
+def get_listing_cache_path(cache_dir, dir):
+    """Path of the listing cache of dir in cache_dir, e.g. the checkpoints directory of a run"""
+    dir_hash = hashlib.sha1(os.path.abspath(dir).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, "listing_%s.json" % dir_hash[:16])
+
+
+def crawl_images(dir, max_depth=None, num_workers=16, cache_path=None):
+    """Return the sorted paths of all the image files under dir.
+
+    Directories are listed with os.scandir, level by level and in parallel threads.
+    If cache_path is given, listings are cached there, keyed by directory mtimes, so that
+    a subsequent crawl only lists again the directories that have changed since. The
+    cache is never written inside dir.
+
+    Parameters:
+        dir (str)         -- root directory
+        max_depth (int)   -- only images at most max_depth levels below dir are returned, all if None
+        num_workers (int) -- number of threads listing directories
+        cache_path (str)  -- listing cache file, no cache if None
+    """
+    root = os.path.abspath(dir)
+    cache = {}
+    if cache_path is not None and os.path.isfile(cache_path):
+        try:
+            with open(cache_path, "r") as f:
+                cache_data = json.load(f)
+            if (
+                cache_data.get("version") == LISTING_CACHE_VERSION
+                and cache_data.get("root") == root
+            ):
+                cache = cache_data["dirs"]
+        except (OSError, ValueError, KeyError):
+            cache = {}
+
+    listings = {}
+    level = [""]
+    depth = 0
+    with ThreadPoolExecutor(max(1, num_workers)) as pool:
+        while len(level) > 0:
+            results = pool.map(
+                lambda rel_dir: _scan_one_dir(
+                    os.path.join(dir, rel_dir), cache.get(rel_dir)
+                ),
+                level,
+            )
+            next_level = []
+            for rel_dir, listing in zip(level, results):
+                listings[rel_dir] = listing
+                if max_depth is None or depth < max_depth:
+                    next_level += [
+                        os.path.join(rel_dir, subdir) for subdir in listing[2]
+                    ]
+            level = next_level
+            depth += 1
+
+    if cache_path is not None and listings != cache:
+        tmp_path = cache_path + ".tmp%d" % os.getpid()
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(
+                    {"version": LISTING_CACHE_VERSION, "root": root, "dirs": listings},
+                    f,
+                )
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
 
-def make_dataset(dir, max_dataset_size=float("inf")):
     images = []
+    for rel_dir in sorted(listings):
+        images += [os.path.join(dir, rel_dir, fname) for fname in listings[rel_dir][1]]
+    return images
+
+
+def make_dataset(dir, max_dataset_size=float("inf"), cache_dir=LISTING_CACHE_DIR):
+    """Paths of the images under dir, directory listings are cached in cache_dir, if not None"""
     assert os.path.isdir(dir), "%s is not a valid directory" % dir
 
-    for root, _, fnames in sorted(os.walk(dir)):
-        for fname in fnames:
-            if is_image_file(fname):
-                path = os.path.join(root, fname)
-                images.append(path)
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = get_listing_cache_path(cache_dir, dir)
+    images = crawl_images(dir, cache_path=cache_path)
     if max_dataset_size == "inf":
         max_dataset_size = len(images)
     return images[: min(max_dataset_size, len(images))]
 
 
-def make_labeled_dataset(dir, max_dataset_size=float("inf")):
+def make_labeled_dataset(
+    dir, max_dataset_size=float("inf"), cache_dir=LISTING_CACHE_DIR
+):
+    """Images of the class subdirectories of dir, and their class ids.
+
+    As with a dir/*/*.* glob, only images one level down are listed, and hidden entries
+    are skipped. Class ids are assigned in the order the glob listed the class
+    directories, i.e. the os.scandir order of dir.
+    """
     images = []
     labels = []
     alllabels = {}
     lbl = 0
     assert os.path.isdir(dir), "%s is not a valid directory" % dir
 
-    # for root, _, fnames in sorted(os.walk(dir)):
-    #    for fname in fnames:
-    #        if is_image_file(fname):
-    #            path = os.path.join(root, fname)
-    #            images.append(path)
-    all_files = glob.glob(dir + "/*/*.*")
-    for img in all_files:
-        if is_image_file(img):
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = get_listing_cache_path(cache_dir, dir)
+    images_by_class = {}
+    for img in crawl_images(dir, max_depth=1, cache_path=cache_path):
+        parts = os.path.relpath(img, dir).split(os.sep)
+        if len(parts) != 2 or any(part.startswith(".") for part in parts):
+            continue
+        images_by_class.setdefault(parts[0], []).append(img)
+
+    with os.scandir(dir) as it:
+        class_dirs = [entry.name for entry in it]
+    for class_dir in class_dirs:
+        for img in images_by_class.get(class_dir, []):
             images.append(img)
-            label = os.path.basename(os.path.dirname(img))
+            label = class_dir
             if not label in alllabels:
                 alllabels[label] = lbl
                 lbl += 1
@@ -128,8 +252,15 @@ def default_loader(path):
 
 
 class ImageFolder(data.Dataset):
-    def __init__(self, root, transform=None, return_paths=False, loader=default_loader):
-        imgs = make_dataset(root)
+    def __init__(
+        self,
+        root,
+        transform=None,
+        return_paths=False,
+        loader=default_loader,
+        cache_dir=LISTING_CACHE_DIR,
+    ):
+        imgs = make_dataset(root, cache_dir=cache_dir)
         if len(imgs) == 0:
             raise (
                 RuntimeError(
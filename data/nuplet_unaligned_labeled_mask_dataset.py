@@ -1,28 +1,41 @@
-import os.path
-from data.base_dataset import BaseDataset, get_transform, get_transform_list
-from data.image_folder import (
-    make_dataset,
-    make_labeled_mask_dataset,
-    make_dataset_path,
-    sort_nicely,
-)
-from PIL import Image
+import os
+from data.base_dataset import BaseDataset, get_transform_tensor_list
+from data.image_folder import make_labeled_path_dataset, sort_nicely
+from data.packed_shards import open_image
 import random
 import numpy as np
-import torchvision.transforms as transforms
 import torch
 import torchvision.transforms.functional as F
-import glob
+import warnings
+
+
+def list_nuplet_frames(nuplet_dirs):
+    """List the frames of each nuplet directory, in human order.
+
+    Returns the frame paths of all the nuplets, concatenated, and an int64 array of
+    size n + 1, the frames of nuplet i being frames[offsets[i]:offsets[i + 1]].
+    """
+    frames = []
+    offsets = np.zeros(len(nuplet_dirs) + 1, dtype=np.int64)
+    for i, nuplet_dir in enumerate(nuplet_dirs):
+        with os.scandir(nuplet_dir) as it:
+            nuplet_frames = [entry.path for entry in it if entry.is_file()]
+        sort_nicely(nuplet_frames)
+        frames += nuplet_frames
+        offsets[i + 1] = len(frames)
+    return frames, offsets
 
 
 class NupletUnalignedLabeledMaskDataset(BaseDataset):
     """
-    This dataset class can load unaligned/unpaired datasets with mask labels.
+    This dataset class can load unaligned/unpaired datasets of nuplets of frames with mask labels.
 
     It requires two directories to host training images from domain A '/path/to/data/trainA'
     and from domain B '/path/to/data/trainB' respectively.
 
-    Domain A must have labels, at the moment there are two subdirections 'images' and 'labels'.
+    Each line of their paths.txt gives a directory of frames and a directory of their masks,
+    e.g. 'path/to/nuplet/images path/to/nuplet/labels', masks are optional for domain B.
+    Frames and masks of a nuplet are matched in human order of their file names.
 
     You can train the model with the dataset flag '--dataroot /path/to/data'.
     Similarly, you need to prepare two directories:
@@ -37,25 +50,98 @@ class NupletUnalignedLabeledMaskDataset(BaseDataset):
         """
         BaseDataset.__init__(self, opt)
 
-        self.nuplet_size = self.opt.nuplet_size
-
         if os.path.exists(self.dir_A):
-            self.A_img_paths, self.A_label_paths = make_labeled_mask_dataset(
-                self.dir_A, "/paths.txt", opt.max_dataset_size
-            )  # load images from '/path/to/data/trainA/paths.txt' as well as labels
+            self.A_img_paths, self.A_label_paths = make_labeled_path_dataset(
+                self.dir_A, "/paths.txt", opt.data_max_dataset_size
+            )  # load nuplets from '/path/to/data/trainA/paths.txt' as well as labels
         else:
-            self.A_img_paths, self.A_label_paths = make_labeled_mask_dataset(
-                opt.dataroot, "/paths.txt", opt.max_dataset_size
-            )  # load images from '/path/to/data/trainA/paths.txt' as well as labels
+            self.A_img_paths, self.A_label_paths = make_labeled_path_dataset(
+                opt.dataroot, "/paths.txt", opt.data_max_dataset_size
+            )  # load nuplets from '/path/to/data/trainA/paths.txt' as well as labels
         self.A_size = len(self.A_img_paths)  # get the size of dataset A
 
         if os.path.exists(self.dir_B):
-            self.B_img_paths, self.B_label_paths = make_labeled_mask_dataset(
-                self.dir_B, "/paths.txt", opt.max_dataset_size
-            )  # load images from '/path/to/data/trainB'
+            self.B_img_paths, self.B_label_paths = make_labeled_path_dataset(
+                self.dir_B, "/paths.txt", opt.data_max_dataset_size
+            )  # load nuplets from '/path/to/data/trainB'
             self.B_size = len(self.B_img_paths)  # get the size of dataset B
 
-        self.transform = get_transform_list(self.opt, grayscale=(self.input_nc == 1))
+        # frames of all the nuplets are listed once, stored as PathStores by compact_paths
+        for domain in ["A", "B"]:
+            if not hasattr(self, domain + "_img_paths"):
+                continue
+            for kind in ["img", "label"]:
+                nuplet_dirs = getattr(self, domain + "_" + kind + "_paths")
+                if len(nuplet_dirs) == 0:  # B label is optional
+                    continue
+                if opt.data_relative_paths:
+                    nuplet_dirs = [
+                        os.path.join(self.root, path) for path in nuplet_dirs
+                    ]
+                frames, offsets = list_nuplet_frames(nuplet_dirs)
+                setattr(self, domain + "_" + kind + "_frames", frames)
+                setattr(self, domain + "_" + kind + "_offsets", offsets)
+
+            if hasattr(self, domain + "_label_offsets") and not np.array_equal(
+                getattr(self, domain + "_img_offsets"),
+                getattr(self, domain + "_label_offsets"),
+            ):
+                raise ValueError(
+                    "nuplets of domain %s do not have as many frames as labels" % domain
+                )
+
+        self.transform = get_transform_tensor_list(
+            self.opt, grayscale=(self.input_nc == 1)
+        )
+
+        self.semantic_nclasses = self.opt.f_s_semantic_nclasses
+
+    def get_nuplet(self, domain, index):
+        """Return the (n, C, H, W) frames and (n, 1, H, W) masks of a nuplet, None on failure"""
+        offsets = getattr(self, domain + "_img_offsets")
+        start, end = offsets[index], offsets[index + 1]
+        frame_paths = getattr(self, domain + "_img_frames")[start:end]
+        if hasattr(self, domain + "_label_frames"):
+            label_paths = getattr(self, domain + "_label_frames")[start:end]
+        else:
+            label_paths = None
+
+        try:
+            imgs = torch.stack(
+                [
+                    F.pil_to_tensor(open_image(path, self.shards).convert("RGB"))
+                    for path in frame_paths
+                ]
+            )
+            if label_paths is not None:
+                labels = torch.stack(
+                    [
+                        torch.from_numpy(
+                            np.array(open_image(path, self.shards), dtype=np.uint8)
+                        ).unsqueeze(0)
+                        for path in label_paths
+                    ]
+                )
+            else:
+                labels = None
+        except Exception as e:
+            print(
+                "failure with reading domain %s nuplet " % domain,
+                getattr(self, domain + "_img_paths")[index],
+            )
+            print(e)
+            return None
+
+        imgs, labels = self.transform(imgs, labels)
+
+        if labels is not None and torch.any(labels > self.semantic_nclasses - 1):
+            warnings.warn(
+                "%s label is above number of semantic classes for nuplet %s"
+                % (domain, getattr(self, domain + "_img_paths")[index])
+            )
+            labels = torch.clamp(labels, max=self.semantic_nclasses - 1)
+
+        return imgs, labels
 
     def __getitem__(self, index):
         """Return a data point and its metadata information.
@@ -63,113 +149,41 @@ class NupletUnalignedLabeledMaskDataset(BaseDataset):
         Parameters:
             index (int)      -- a random integer for data indexing
 
-        Returns a dictionary that contains A, B, A_paths and B_paths
-            A (tensor)       -- an image in the input domain
-            B (tensor)       -- its corresponding image in the target domain
-            A_paths (str)    -- image paths
-            B_paths (str)    -- image paths
-            A_label (tensor) -- mask label of image A
+        Returns a dictionary that contains A, B, A_img_paths and B_img_paths
+            A (tensor)            -- a nuplet of frames in the input domain
+            B (tensor)            -- a nuplet of frames in the target domain
+            A_img_paths (str)     -- nuplet paths
+            B_img_paths (str)     -- nuplet paths
+            A_label_mask (tensor) -- mask labels of nuplet A
         """
-        A_list = []
-        A_label_list = []
-        A_paths_list = []
-
-        index_A = index
-
-        A_img_path = self.A_img_paths[
-            index_A % (self.A_size - self.nuplet_size)
-        ]  # make sure index is within then range
-        A_label_path = self.A_label_paths[index_A % (self.A_size - self.nuplet_size)]
-
-        A_paths_list = glob.glob(A_img_path + "/*")
-        A_label_paths_list = glob.glob(A_label_path + "/*")
-
-        sort_nicely(A_paths_list)
-        sort_nicely(A_label_list)
-
-        for cur_A_img_path, cur_A_label_path in zip(A_paths_list, A_label_paths_list):
-            try:
-                A_img = Image.open(cur_A_img_path).convert("RGB")
-                A_label = Image.open(cur_A_label_path)
-            except Exception as e:
-                print(
-                    "failure with reading A domain image ",
-                    A_img_path,
-                    " or label ",
-                    A_label_path,
-                )
-                print(e)
-
-            # A,A_label = self.transform(A_img,A_label)
-
-            A_list.append(A_img)
-            A_label_list.append(A_label)
-
-        A_list, A_label_list = self.transform(A_list, A_label_list)
-
-        A = torch.stack(A_list)
-        A_label = torch.stack(A_label_list)
+        index_A = index % self.A_size  # make sure index is within then range
+        A_nuplet = self.get_nuplet("A", index_A)
+        if A_nuplet is None:
+            return None
+        A, A_label_mask = A_nuplet
+
+        result = {
+            "A": A,
+            "A_img_paths": self.A_img_paths[index_A],
+            "A_label_mask": A_label_mask,
+        }
 
-        B_list = []
-        B_label_list = []
-        B_paths_list = []
         if hasattr(self, "B_img_paths"):
-            if self.opt.serial_batches:  # make sure index is within then range
-                index_B = index % (self.B_size - self.nuplet_size)
+            if self.opt.data_serial_batches:  # make sure index is within then range
+                index_B = index % self.B_size
             else:  # randomize the index for domain B to avoid fixed pairs.
-                index_B = random.randint(0, self.B_size - 1 - self.nuplet_size)
-
-            B_img_path = self.B_img_paths[index_B]
-            B_paths_list = glob.glob(B_img_path + "/*")
-            sort_nicely(B_paths_list)
-            if len(self.B_label_paths) > 0:  # B label is optional
-                B_label_path = self.B_label_paths[index_B]
-                B_label_paths_list = glob.glob(B_label_path + "/*")
-                sort_nicely(B_label_paths_list)
-            else:
-                B_label_list = [None for k in range(len(B_img_path))]
+                index_B = random.randint(0, self.B_size - 1)
 
-            for cur_B_img_path, cur_B_label_path in zip(
-                B_paths_list, B_label_paths_list
-            ):
-                try:
-                    B_img = Image.open(cur_B_img_path).convert("RGB")
-                    if cur_B_label_path is not None:  # B label is optional
-                        B_label = Image.open(cur_B_label_path)
-                    else:
-                        B_label = None
-                except:
-                    print(
-                        "failed to read B domain image ",
-                        B_img_path,
-                        " at index_B=",
-                        index_B,
-                    )
-
-                if len(self.B_label_paths) > 0:  # B label is optional
-                    # B,B_label = self.transform(B_img,B_label)
-                    B_label_list.append(B_label)
-                else:
-                    # B = self.transform_noseg(B_img)
-                    B_label_list = None
-
-                B_list.append(B_img)
-
-            B_list, B_label_list = self.transform(B_list, B_label_list)
-            B = torch.stack(B_list)
-            if len(self.B_label_paths) > 0:  # B label is optional
-                B_label = torch.stack(B_label_list)
-
-            return {
-                "A": A,
-                "B": B,
-                "A_paths": A_img_path,
-                "B_paths": B_img_path,
-                "A_label": A_label,
-                "B_label": B_label,
-            }
-        else:
-            return {"A": A, "A_paths": A_img_path, "A_label": A_label}
+            B_nuplet = self.get_nuplet("B", index_B)
+            if B_nuplet is None:
+                return None
+            B, B_label_mask = B_nuplet
+
+            result.update({"B": B, "B_img_paths": self.B_img_paths[index_B]})
+            if B_label_mask is not None:  # B label is optional
+                result["B_label_mask"] = B_label_mask
+
+        return result
 
     def __len__(self):
         """Return the total number of images in the dataset.
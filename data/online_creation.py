@@ -1,4 +1,10 @@
+from collections import OrderedDict
+import fcntl
+import hashlib
+import json
 import math
+import multiprocessing
+import os
 import numpy as np
 import random
 from PIL import Image
@@ -7,6 +13,10 @@ import torchvision.transforms.functional as F
 from torchvision.transforms import InterpolationMode
 from tqdm import tqdm
 import warnings
+from data.packed_shards import key_hash, open_image, open_text, shard_key
+from data.path_store import PathStore
+
+SANITIZE_CACHE_DIRNAME = ".sanitized"
 
 
 def crop_image(
@@ -22,119 +32,381 @@ def crop_image(
     get_crop_coordinates=False,
     crop_coordinates=None,
     select_cat=-1,
+    shards=None,
+    bboxes=None,
+    fast_decode=False,
 ):
+    img, img_width, img_height, ratio_x, ratio_y = open_image_header(
+        img_path, load_size, shards
+    )
 
-    margin = context_pixels * 2
+    if bboxes is None:
+        bboxes = load_bboxes(img_path, bbox_path, select_cat, shards)
+    elif select_cat != -1:
+        bboxes = bboxes[bboxes[:, 0] == select_cat]
+
+    if len(bboxes) == 0:
+        raise ValueError(f"There is no bbox at {bbox_path} for image {img_path}.")
+
+    crop = compute_crop(
+        img_path,
+        bboxes,
+        img_width,
+        img_height,
+        ratio_x,
+        ratio_y,
+        mask_delta,
+        crop_delta,
+        mask_square,
+        crop_dim,
+        context_pixels,
+        crop_coordinates,
+    )
+
+    if get_crop_coordinates:
+        x_crop, y_crop, crop_size, x_min_ref, y_min_ref = crop[:5]
+        return x_crop - x_min_ref, y_crop - y_min_ref, crop_size
+
+    img = DecodedImage(
+        img, load_size, [crop_box(crop)], output_dim + context_pixels * 2, fast_decode
+    )
+    return crop_decoded(img_path, img, crop, output_dim + context_pixels * 2)
+
+
+def crop_images(
+    img_path,
+    bbox_path,
+    mask_delta,
+    crop_delta,
+    mask_square,
+    crop_dim,
+    output_dim,
+    context_pixels,
+    load_size,
+    nb_crops,
+    select_cat=-1,
+    shards=None,
+    bboxes=None,
+    fast_decode=False,
+    idx_bbox_refs=None,
+    return_refs=False,
+):
+    """Return nb_crops (img, mask) crops of an image that is decoded only once.
+
+    Each crop is computed as in crop_image, around a randomly chosen bbox and with
+    random crop size and position, crops that cannot be computed are left out.
+    When idx_bbox_refs is given, one crop is computed around each bboxes[idx] instead,
+    and with return_refs, (idx, img, mask) tuples are returned.
+    """
+    img, img_width, img_height, ratio_x, ratio_y = open_image_header(
+        img_path, load_size, shards
+    )
+
+    if bboxes is None:
+        bboxes = load_bboxes(img_path, bbox_path, select_cat, shards)
+    elif select_cat != -1:
+        bboxes = bboxes[bboxes[:, 0] == select_cat]
+
+    if len(bboxes) == 0:
+        raise ValueError(f"There is no bbox at {bbox_path} for image {img_path}.")
+
+    if idx_bbox_refs is None:
+        idx_bbox_refs = [None] * nb_crops
+
+    crops = []
+    refs = []
+    error = ValueError(f"No crop requested for image {img_path}.")
+    for idx_bbox_ref in idx_bbox_refs:
+        try:
+            crops.append(
+                compute_crop(
+                    img_path,
+                    bboxes,
+                    img_width,
+                    img_height,
+                    ratio_x,
+                    ratio_y,
+                    mask_delta,
+                    crop_delta,
+                    mask_square,
+                    crop_dim,
+                    context_pixels,
+                    idx_bbox_ref=idx_bbox_ref,
+                )
+            )
+            refs.append(idx_bbox_ref)
+        except ValueError as e:
+            error = e
+    if len(crops) == 0:
+        raise error
 
+    img = DecodedImage(
+        img,
+        load_size,
+        [crop_box(crop) for crop in crops],
+        output_dim + context_pixels * 2,
+        fast_decode,
+    )
+    crops = [
+        crop_decoded(img_path, img, crop, output_dim + context_pixels * 2)
+        for crop in crops
+    ]
+    if return_refs:
+        return [(ref,) + crop for ref, crop in zip(refs, crops)]
+    return crops
+
+
+def crop_sequence(
+    img_paths,
+    bbox_paths,
+    mask_delta,
+    crop_delta,
+    mask_square,
+    crop_dim,
+    output_dim,
+    context_pixels,
+    load_size,
+    select_cat=-1,
+    shards=None,
+    bboxes_list=None,
+    fast_decode=False,
+    frame_cache=None,
+    imgs=None,
+):
+    """Return the (img, mask) crops of the same area in each frame of a sequence.
+
+    The crop is computed as in crop_image on the first frame, and at the same position
+    relative to the reference bbox in the following frames. Each frame is opened and
+    decoded once, decoded frames are looked up in and added to frame_cache if given.
+    Frames already opened, e.g. decoded from a video, can be given as imgs, img_paths
+    are then only used as cache keys and in error messages.
+    """
+    if bboxes_list is None:
+        bboxes_list = [None] * len(img_paths)
+    if imgs is None:
+        imgs = [None] * len(img_paths)
+    output_size = output_dim + context_pixels * 2
+
+    crop_coordinates = None
+    crops = []
+    for img_path, bbox_path, bboxes, frame in zip(
+        img_paths, bbox_paths, bboxes_list, imgs
+    ):
+        if bboxes is None:
+            bboxes = load_bboxes(img_path, bbox_path, select_cat, shards)
+        elif select_cat != -1:
+            bboxes = bboxes[bboxes[:, 0] == select_cat]
+        if len(bboxes) == 0:
+            raise ValueError(f"There is no bbox at {bbox_path} for image {img_path}.")
+
+        img = None
+        header_key = (img_path, tuple(load_size))
+        header = frame_cache.get(header_key) if frame_cache is not None else None
+        if header is None:
+            img, *header = open_image_header(img_path, load_size, shards, frame)
+        img_width, img_height, ratio_x, ratio_y = header
+
+        crop = compute_crop(
+            img_path,
+            bboxes,
+            img_width,
+            img_height,
+            ratio_x,
+            ratio_y,
+            mask_delta,
+            crop_delta,
+            mask_square,
+            crop_dim,
+            context_pixels,
+            crop_coordinates,
+        )
+        if crop_coordinates is None:
+            x_crop, y_crop, crop_size, x_min_ref, y_min_ref = crop[:5]
+            crop_coordinates = (x_crop - x_min_ref, y_crop - y_min_ref, crop_size)
+
+        box = crop_box(crop)
+        # with fast_decode, the decoding resolution depends on the crop size
+        decoded_key = header_key + (
+            (box[2] - box[0], box[3] - box[1], output_size) if fast_decode else None,
+        )
+        decoded = frame_cache.get(decoded_key) if frame_cache is not None else None
+        if decoded is None:
+            if img is None:
+                img = open_image_header(img_path, load_size, shards, frame)[0]
+            decoded = DecodedImage(img, load_size, [box], output_size, fast_decode)
+            if frame_cache is not None and decoded.img is not None:
+                frame_cache.put(header_key, header)
+                frame_cache.put(decoded_key, decoded)
+
+        crops.append(crop_decoded(img_path, decoded, crop, output_size))
+
+    return crops
+
+
+class FrameCache:
+    """LRU cache of opened and decoded frames, local to each process.
+
+    Entries are dropped when the cache is pickled, e.g. to dataloader workers, so that each
+    worker fills its own cache.
+
+    Parameters:
+        max_size (int) -- maximum number of entries
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def touch(self, key):
+        """Whether key is cached, it is then marked as recently used without counting a hit"""
+        if key not in self.entries:
+            return False
+        self.entries.move_to_end(key)
+        return True
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["entries"] = OrderedDict()
+        return state
+
+
+def open_image_header(img_path, load_size, shards=None, img=None):
+    """Open an image without decoding it, and compute its size once resized to load_size.
+
+    img can be given when the image is already opened, e.g. a frame decoded from a video.
+    Returns the PIL image, its width and height after resizing, and the resizing ratios.
+    """
     try:
-        img = Image.open(img_path)
+        if img is None:
+            img = open_image(img_path, shards)
         if load_size != []:
             old_size = img.size
-            img = F.resize(img, load_size)
-            new_size = img.size
-            ratio_x = img.size[0] / old_size[0]
-            ratio_y = img.size[1] / old_size[1]
+            img_width, img_height = resized_size(old_size, load_size)
+            ratio_x = img_width / old_size[0]
+            ratio_y = img_height / old_size[1]
         else:
+            img_width, img_height = img.size
             ratio_x = 1
             ratio_y = 1
-
-        img = np.array(img)
     except Exception as e:
         raise ValueError(f"failure with loading image {img_path}") from e
 
-    try:
-        f = open(bbox_path, "r")
-    except Exception as e:
-        raise ValueError(
-            f"failure with loading label {bbox_path} for image {img_path}"
-        ) from e
+    return img, img_width, img_height, ratio_x, ratio_y
 
-    with f:
-        bboxes = []
 
-        for line in f:
-            if len(line) > 2:  # to make sure the current line is a real bbox
-                if select_cat != -1:
-                    bbox = line.split()
-                    cat = int(bbox[0])
-                    if cat != select_cat:
-                        continue  # skip bboxes
-                    else:
-                        bboxes.append(line)
-                else:
-                    bboxes.append(line)
-            elif line != "" or line != " ":
-                print("%s does not describe a bbox" % line)
+def compute_crop(
+    img_path,
+    bboxes,
+    img_width,
+    img_height,
+    ratio_x,
+    ratio_y,
+    mask_delta,
+    crop_delta,
+    mask_square,
+    crop_dim,
+    context_pixels,
+    crop_coordinates=None,
+    idx_bbox_ref=None,
+):
+    """Draw a random crop around a random bbox, in the coordinates of the image resized to load_size.
 
-        if len(bboxes) == 0:
-            raise ValueError(f"There is no bbox at {bbox_path} for image {img_path}.")
+    The crop is drawn around bboxes[idx_bbox_ref] instead when idx_bbox_ref is given.
+
+    Returns x_crop, y_crop, crop_size, x_min_ref, y_min_ref, context_pixels and the
+    list of (cat, xmin, ymin, xmax, ymax) bboxes to draw in the mask. context_pixels may be
+    reduced when the bbox is too close to the image edges.
+    """
+    margin = context_pixels * 2
 
-        # Creation of a blank mask
-        mask = np.zeros(img.shape[:2], dtype=np.uint8)
+    # Bboxes coordinates in the loaded image, masks are rasterized later on, only within the crop
+    mask_bboxes = []
 
-        # A bbox of reference will be used to compute the crop
+    # A bbox of reference will be used to compute the crop
+    if idx_bbox_ref is None:
         idx_bbox_ref = random.randint(0, len(bboxes) - 1)
 
-        for i, cur_bbox in enumerate(bboxes):
-            bbox = cur_bbox.split()
-            cat = int(bbox[0])
-            if select_cat != -1:
-                if cat != select_cat:
-                    continue  # skip bboxes
+    for i, bbox in enumerate(bboxes):
+        cat = int(bbox[0])
+
+        xmin = math.floor(int(bbox[1]) * ratio_x)
+        ymin = math.floor(int(bbox[2]) * ratio_y)
+        xmax = math.floor(int(bbox[3]) * ratio_x)
+        ymax = math.floor(int(bbox[4]) * ratio_y)
+
+        if (
+            mask_delta > 0
+        ):  # increase mask box so that it can fit the reconstructed object (for semantic loss)
+            ymin -= mask_delta
+            ymax += mask_delta
+            xmin -= mask_delta
+            xmax += mask_delta
+
+        if mask_square:
+            sdiff = (xmax - xmin) - (ymax - ymin)
+            if sdiff > 0:
+                ymax += int(sdiff / 2)
+                ymin -= int(sdiff / 2)
+            else:
+                xmax += -int(sdiff / 2)
+                xmin -= -int(sdiff / 2)
 
-            xmin = math.floor(int(bbox[1]) * ratio_x)
-            ymin = math.floor(int(bbox[2]) * ratio_y)
-            xmax = math.floor(int(bbox[3]) * ratio_x)
-            ymax = math.floor(int(bbox[4]) * ratio_y)
+        xmin = max(0, xmin)
+        ymin = max(0, ymin)
+        xmax = min(xmax, img_width)
+        ymax = min(ymax, img_height)
+
+        if xmax < xmin or ymax < ymin:
+            raise ValueError(f"Bbox {bbox[1:]} is out of image {img_path}")
+
+        mask_bboxes.append((cat, xmin, ymin, xmax, ymax))
+
+        if i == idx_bbox_ref:
+            x_min_ref = xmin
+            x_max_ref = xmax
+            y_min_ref = ymin
+            y_max_ref = ymax
 
             if (
-                mask_delta > 0
-            ):  # increase mask box so that it can fit the reconstructed object (for semantic loss)
-                ymin -= mask_delta
-                ymax += mask_delta
-                xmin -= mask_delta
-                xmax += mask_delta
-
-            if mask_square:
-                sdiff = (xmax - xmin) - (ymax - ymin)
-                if sdiff > 0:
-                    ymax += int(sdiff / 2)
-                    ymin -= int(sdiff / 2)
-                else:
-                    xmax += -int(sdiff / 2)
-                    xmin -= -int(sdiff / 2)
-
-            xmin = max(0, xmin)
-            ymin = max(0, ymin)
-            xmax = min(xmax, img.shape[1])
-            ymax = min(ymax, img.shape[0])
-
-            mask[ymin:ymax, xmin:xmax] = np.full((ymax - ymin, xmax - xmin), cat)
-
-            if i == idx_bbox_ref:
-                x_min_ref = xmin
-                x_max_ref = xmax
-                y_min_ref = ymin
-                y_max_ref = ymax
-
-                if (
-                    x_min_ref < context_pixels
-                    or y_min_ref < context_pixels
-                    or x_max_ref + context_pixels > img.shape[1]
-                    or y_max_ref + context_pixels > img.shape[0]
-                ):
-                    new_context_pixels = min(
-                        x_min_ref,
-                        y_min_ref,
-                        img.shape[1] - x_max_ref,
-                        img.shape[0] - y_max_ref,
-                    )
-
-                    warnings.warn(
-                        f"Bbox is too close to the edge to crop with context ({context_pixels} pixels)  for {img_path},using context_pixels=distance to the edge {new_context_pixels}"
-                    )
-
-                    context_pixels = new_context_pixels
+                x_min_ref < context_pixels
+                or y_min_ref < context_pixels
+                or x_max_ref + context_pixels > img_width
+                or y_max_ref + context_pixels > img_height
+            ):
+                new_context_pixels = min(
+                    x_min_ref,
+                    y_min_ref,
+                    img_width - x_max_ref,
+                    img_height - y_max_ref,
+                )
+
+                warnings.warn(
+                    f"Bbox is too close to the edge to crop with context ({context_pixels} pixels)  for {img_path},using context_pixels=distance to the edge {new_context_pixels}"
+                )
+
+                context_pixels = new_context_pixels
 
     height = y_max_ref - y_min_ref
     width = x_max_ref - x_min_ref
@@ -165,11 +437,11 @@ def crop_image(
 
         crop_size = random.randint(crop_size_min, crop_size_max)
 
-        if crop_size > min(img.shape[0], img.shape[1]):
+        if crop_size > min(img_height, img_width):
             warnings.warn(
-                f"Image size ({img.shape}) > crop dim {crop_size} for {img_path}, using crop_dim = img size"
+                f"Image size ({img_height}, {img_width}) > crop dim {crop_size} for {img_path}, using crop_dim = img size"
             )
-            crop_size = min(img.shape[0], img.shape[1])
+            crop_size = min(img_height, img_width)
 
         # Let's compute crop position
         # The final crop coordinates will be [x_crop:x_crop+crop_size+margin,y_crop:y_crop+crop_size+margin)
@@ -181,10 +453,10 @@ def crop_image(
         # So x_crop - context_pixels >=0 and x_crop + crop_size + context_pixels <= img_size-1
 
         x_crop_min = max(context_pixels, x_max_ref - crop_size)
-        x_crop_max = min(x_min_ref, img.shape[1] - crop_size - context_pixels)
+        x_crop_max = min(x_min_ref, img_width - crop_size - context_pixels)
 
         y_crop_min = max(context_pixels, y_max_ref - crop_size)
-        y_crop_max = min(y_min_ref, img.shape[0] - crop_size - context_pixels)
+        y_crop_max = min(y_min_ref, img_height - crop_size - context_pixels)
 
         if x_crop_min > x_crop_max or y_crop_min > y_crop_max:
             raise ValueError(f"Crop position cannot be computed for {img_path}")
@@ -192,9 +464,6 @@ def crop_image(
         x_crop = random.randint(x_crop_min, x_crop_max)
         y_crop = random.randint(y_crop_min, y_crop_max)
 
-        if get_crop_coordinates:
-            return x_crop - x_min_ref, y_crop - y_min_ref, crop_size
-
     else:
         x_crop, y_crop, crop_size = crop_coordinates
         x_crop = x_crop + x_min_ref
@@ -202,34 +471,413 @@ def crop_image(
 
     if (
         x_crop < context_pixels
-        or x_crop + crop_size + context_pixels > img.shape[1]
+        or x_crop + crop_size + context_pixels > img_width
         or y_crop < context_pixels
-        or y_crop + crop_size + context_pixels > img.shape[0]
+        or y_crop + crop_size + context_pixels > img_height
     ):
         raise ValueError(
             f"Image cropping failed for {img_path}.",
         )
 
-    img = img[
-        y_crop - context_pixels : y_crop + crop_size + context_pixels,
-        x_crop - context_pixels : x_crop + crop_size + context_pixels,
-        :,
-    ]
+    # the mask is not cut at context pixels (which may have been reduced), but at the original margin
+    mask_box = (
+        x_crop,
+        y_crop,
+        min(x_crop + crop_size + margin, img_width),
+        min(y_crop + crop_size + margin, img_height),
+    )
 
-    img = Image.fromarray(img)
+    return (
+        x_crop,
+        y_crop,
+        crop_size,
+        x_min_ref,
+        y_min_ref,
+        context_pixels,
+        mask_bboxes,
+        mask_box,
+    )
 
-    img = F.resize(img, output_dim + margin)
 
-    mask = mask[
-        y_crop : y_crop + crop_size + margin,
-        x_crop : x_crop + crop_size + margin,
-    ]
+def crop_box(crop):
+    """(left, upper, right, lower) box of a crop with its context, as returned by compute_crop"""
+    x_crop, y_crop, crop_size, _, _, context_pixels = crop[:6]
+    return (
+        x_crop - context_pixels,
+        y_crop - context_pixels,
+        x_crop + crop_size + context_pixels,
+        y_crop + crop_size + context_pixels,
+    )
+
+
+def crop_decoded(img_path, img, crop, output_size):
+    """Cut a crop computed by compute_crop from a DecodedImage, and draw its mask."""
+    img = img.crop(crop_box(crop), output_size, img_path)
+
+    mask_bboxes, mask_box = crop[6:]
+    mask = rasterize_mask(
+        mask_bboxes, mask_box[1], mask_box[3], mask_box[0], mask_box[2]
+    )
     mask = Image.fromarray(mask)
-    mask = F.resize(mask, output_dim + margin, interpolation=InterpolationMode.NEAREST)
+    mask = F.resize(mask, output_size, interpolation=InterpolationMode.NEAREST)
 
     return img, mask
 
 
+def resized_size(size, load_size):
+    """(width, height) of an image of size (width, height) once resized with F.resize(img, load_size)"""
+    width, height = size
+    if len(load_size) == 1:
+        short, long = (width, height) if width <= height else (height, width)
+        new_short, new_long = load_size[0], int(load_size[0] * long / short)
+        return (new_short, new_long) if width <= height else (new_long, new_short)
+    return load_size[1], load_size[0]
+
+
+class DecodedImage:
+    """An image opened with PIL, decoded once to cut one or several crops from it.
+
+    Crop boxes are given in the coordinates of the image resized to load_size. The
+    default path decodes and resizes the full image. With fast_decode, JPEG images
+    are decoded at a reduced DCT scale (1/2, 1/4 or 1/8) when all crops are downscaled
+    anyway, and only the crop boxes are resampled, so the full resolution image is
+    never materialized.
+
+    Parameters:
+        img (PIL image)    -- image opened and not decoded yet
+        load_size (list)   -- size the image is resized to before cropping, [] for none
+        boxes (list)       -- (left, upper, right, lower) boxes of the crops to come
+        output_size (int)  -- size crops are resized to
+        fast_decode (bool) -- whether to decode at reduced resolution
+    """
+
+    def __init__(self, img, load_size, boxes, output_size, fast_decode=False):
+        self.fast_decode = fast_decode
+        try:
+            if not fast_decode:
+                if load_size != []:
+                    img = F.resize(img, load_size)
+                self.img = np.array(img)
+                return
+
+            src_width, src_height = img.size
+            load_width, load_height = (
+                resized_size(img.size, load_size) if load_size != [] else img.size
+            )
+            # from load_size coordinates to source image coordinates
+            self.ratio_x = src_width / load_width
+            self.ratio_y = src_height / load_height
+
+            scale = min(
+                output_size
+                / max(
+                    (box[2] - box[0]) * self.ratio_x, (box[3] - box[1]) * self.ratio_y
+                )
+                for box in boxes
+            )
+            if scale < 1:
+                # no-op for formats other than JPEG
+                img.draft(
+                    img.mode,
+                    (math.ceil(src_width * scale), math.ceil(src_height * scale)),
+                )
+                self.ratio_x *= img.size[0] / src_width
+                self.ratio_y *= img.size[1] / src_height
+            img.load()
+            self.img = img
+        except Exception as e:
+            self.img = None
+            self.error = e
+
+    def crop(self, box, output_size, img_path=None):
+        """Return the box crop resized to output_size, as a PIL image."""
+        try:
+            if self.img is None:
+                raise self.error
+
+            if not self.fast_decode:
+                img = self.img[box[1] : box[3], box[0] : box[2], :]
+                img = Image.fromarray(img)
+                return F.resize(img, output_size)
+
+            box = (
+                box[0] * self.ratio_x,
+                box[1] * self.ratio_y,
+                box[2] * self.ratio_x,
+                box[3] * self.ratio_y,
+            )
+            return self.img.resize((output_size, output_size), Image.BILINEAR, box=box)
+        except Exception as e:
+            raise ValueError(f"failure with loading image {img_path}") from e
+
+
+def load_bboxes(img_path, bbox_path, select_cat=-1, shards=None):
+    """Parse a bbox file into a (k, 5) int array of [cat, xmin, ymin, xmax, ymax] rows.
+
+    Bboxes whose category is not select_cat are skipped, unless select_cat is -1.
+    """
+    try:
+        f = open_text(bbox_path, shards)
+    except Exception as e:
+        raise ValueError(
+            f"failure with loading label {bbox_path} for image {img_path}"
+        ) from e
+
+    bboxes = []
+    with f:
+        for line in f:
+            if len(line) > 2:  # to make sure the current line is a real bbox
+                bbox = [int(elt) for elt in line.split()[:5]]
+                if len(bbox) < 5:
+                    raise ValueError(f"{line} in {bbox_path} is not a valid bbox")
+                if select_cat != -1 and bbox[0] != select_cat:
+                    continue  # skip bboxes
+                bboxes.append(bbox)
+            elif line != "" or line != " ":
+                print("%s does not describe a bbox" % line)
+
+    return np.array(bboxes, dtype=np.int64).reshape(-1, 5)
+
+
+def rasterize_mask(bboxes, y_start, y_end, x_start, x_end):
+    """Draw bboxes given in image coordinates onto a mask covering [y_start:y_end, x_start:x_end].
+
+    Bboxes are drawn in order, so that later bboxes overwrite earlier ones.
+    """
+    mask = np.zeros((max(0, y_end - y_start), max(0, x_end - x_start)), dtype=np.uint8)
+    for cat, xmin, ymin, xmax, ymax in bboxes:
+        xmin = max(xmin, x_start) - x_start
+        ymin = max(ymin, y_start) - y_start
+        xmax = min(xmax, x_end) - x_start
+        ymax = min(ymax, y_end) - y_start
+        if xmax > xmin and ymax > ymin:
+            mask[ymin:ymax, xmin:xmax] = cat
+    return mask
+
+
+class BBoxIndex:
+    """Columnar index of all the bboxes of a dataset, so that bbox files are parsed once.
+
+    Each bbox is a row of the img_ids, cats and boxes arrays, rows are sorted by
+    img_ids, which is the position of the bbox file in paths. Bbox files are looked
+    up by the 64-bit hash of their path relative to root, as in packed shards.
+    Files that could not be parsed are indexed as failed, so that they are not
+    parsed again, and are not found by get.
+
+    Parameters:
+        paths (str list)         -- indexed bbox files paths, as a list or a PathStore
+        img_ids (int array)      -- (n,) index in paths of the file of each bbox
+        cats (int array)         -- (n,) category of each bbox
+        boxes (int array)        -- (n, 4) [xmin, ymin, xmax, ymax] coordinates of each bbox
+        select_cat (int)         -- category the bboxes were filtered on, -1 for all categories
+        root (str)               -- dataroot, stripped from the paths that are looked up
+        signatures (int array)   -- (len(paths), 2) (size, mtime) of each file when it was parsed,
+                                    -1 for files that are not on the filesystem
+        failed (bool array)      -- (len(paths),) whether each file could not be parsed
+    """
+
+    def __init__(
+        self,
+        paths,
+        img_ids,
+        cats,
+        boxes,
+        select_cat=-1,
+        root=None,
+        signatures=None,
+        failed=None,
+    ):
+        self.select_cat = select_cat
+        self.root = root
+        if not isinstance(paths, PathStore):
+            paths = PathStore.from_list(paths)
+        self.paths = paths
+        self.img_ids = img_ids
+        self.cats = cats
+        self.boxes = boxes
+        if signatures is None:
+            signatures = np.full((len(paths), 2), -1, dtype=np.int64)
+        self.signatures = signatures
+        if failed is None:
+            failed = np.zeros(len(paths), dtype=bool)
+        self.failed = failed
+
+        hashes = np.fromiter(
+            (key_hash(shard_key(path, root)) for path in paths),
+            dtype=np.uint64,
+            count=len(paths),
+        )
+        self.order = np.argsort(hashes, kind="stable")
+        self.hashes = hashes[self.order]
+        self.offsets = np.searchsorted(img_ids, np.arange(len(paths) + 1))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _row(self, path):
+        key = shard_key(path, self.root)
+        h = np.uint64(key_hash(key))
+        # paths are compared on hash collisions
+        pos = np.searchsorted(self.hashes, h)
+        while pos < len(self.hashes) and self.hashes[pos] == h:
+            row = int(self.order[pos])
+            if shard_key(self.paths[row], self.root) == key:
+                return row
+            pos += 1
+        return -1
+
+    def get(self, path):
+        """Return the (k, 5) [cat, xmin, ymin, xmax, ymax] bboxes of a file, None if it is not indexed."""
+        if path is None or len(self.hashes) == 0:
+            return None
+        img_id = self._row(path)
+        if img_id < 0 or self.failed[img_id]:
+            return None
+        start, end = self.offsets[img_id], self.offsets[img_id + 1]
+        return np.concatenate(
+            [self.cats[start:end, None], self.boxes[start:end]], axis=1
+        )
+
+    def is_up_to_date(self, paths, signatures, select_cat):
+        """Whether the index has the given files, with the same signatures, and category."""
+        if self.select_cat != select_cat:
+            return False
+        indexed = dict(zip(self.paths, map(tuple, self.signatures.tolist())))
+        if len(indexed) != len(set(paths)):
+            return False
+        for path, signature in zip(paths, signatures):
+            if indexed.get(path) != tuple(signature):
+                return False
+        return True
+
+    @classmethod
+    def build(
+        cls,
+        paths,
+        select_cat=-1,
+        root=None,
+        relative_paths=False,
+        shards=None,
+        signatures=None,
+    ):
+        """Parse all bbox files, files that cannot be parsed are indexed as failed."""
+        if signatures is None:
+            signatures = bbox_signatures(paths, root, relative_paths)
+        indexed_paths = []
+        indexed_signatures = []
+        failed = []
+        img_ids = []
+        bboxes = []
+        for path, signature in zip(tqdm(paths), signatures):
+            if path is None:
+                continue
+            full_path = os.path.join(root, path) if relative_paths else path
+            try:
+                cur_bboxes = load_bboxes(full_path, full_path, select_cat, shards)
+            except Exception:
+                cur_bboxes = None
+            if cur_bboxes is not None:
+                img_ids.append(
+                    np.full(len(cur_bboxes), len(indexed_paths), dtype=np.int32)
+                )
+                bboxes.append(cur_bboxes)
+            failed.append(cur_bboxes is None)
+            indexed_signatures.append(signature)
+            indexed_paths.append(path)
+
+        if len(bboxes) > 0:
+            img_ids = np.concatenate(img_ids)
+            bboxes = np.concatenate(bboxes)
+        else:
+            img_ids = np.zeros(0, dtype=np.int32)
+            bboxes = np.zeros((0, 5), dtype=np.int64)
+
+        return cls(
+            indexed_paths,
+            img_ids,
+            bboxes[:, 0].astype(np.int32),
+            bboxes[:, 1:].astype(np.int32),
+            select_cat,
+            root,
+            np.array(indexed_signatures, dtype=np.int64).reshape(-1, 2),
+            np.array(failed, dtype=bool),
+        )
+
+    def save(self, index_path):
+        np.savez(
+            index_path,
+            paths_buffer=np.asarray(self.paths.buffer),
+            paths_offsets=np.asarray(self.paths.offsets),
+            signatures=self.signatures,
+            failed=self.failed,
+            img_ids=self.img_ids,
+            cats=self.cats,
+            boxes=self.boxes,
+            select_cat=self.select_cat,
+        )
+
+    @classmethod
+    def load(cls, index_path, root=None):
+        index = np.load(index_path)
+        return cls(
+            PathStore(index["paths_buffer"], index["paths_offsets"]),
+            index["img_ids"],
+            index["cats"],
+            index["boxes"],
+            int(index["select_cat"]),
+            root,
+            index["signatures"],
+            index["failed"],
+        )
+
+
+def bbox_signatures(paths, root=None, relative_paths=False):
+    """(size, mtime) signature of each bbox file, (-1, -1) for files that are not on the filesystem."""
+    signatures = []
+    for path in paths:
+        full_path = os.path.join(root, path) if relative_paths and path else path
+        signatures.append(file_signature(full_path) or [-1, -1])
+    return signatures
+
+
+def load_bbox_index(
+    index_path, paths, select_cat=-1, root=None, relative_paths=False, shards=None
+):
+    """Load the bbox index saved at index_path, (re)build it when files were added, removed or modified.
+
+    Parameters:
+        index_path (str)     -- where the index is saved, usually next to the sanitized paths files
+        paths (str list)     -- bbox files paths, None paths are ignored
+        select_cat (int)     -- only bboxes of this category are indexed, -1 for all categories
+        root (str)           -- dataroot
+        relative_paths (bool)-- whether paths are relative to root
+        shards (ShardReader) -- packed shards to read bbox files from, if any
+    """
+    paths = [path for path in paths if path is not None]
+    signatures = bbox_signatures(paths, root, relative_paths)
+    if os.path.isfile(index_path):
+        try:
+            index = BBoxIndex.load(index_path, root)
+            if index.is_up_to_date(paths, signatures, select_cat):
+                print("bbox index loaded from ", index_path)
+                return index
+        except Exception as e:
+            print("failed loading bbox index at ", index_path)
+            print(e)
+
+    print("building bbox index")
+    index = BBoxIndex.build(paths, select_cat, root, relative_paths, shards, signatures)
+    try:
+        # datasets may be created before the checkpoints directory
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        index.save(index_path)
+        print("bbox index saved at ", index_path)
+    except Exception as e:
+        print("failed saving bbox index at ", index_path)
+        print(e)
+    return index
+
+
 def fill_mask_with_random(img, mask, cls):
     """
     Randomize image inside masks.
@@ -268,6 +916,66 @@ def fill_mask_with_color(img, mask, colors):
     return img
 
 
+def file_signature(path):
+    """(size, mtime) of a file, used to detect files that changed since they were sanitized.
+
+    Files that are not on the filesystem (e.g. only available from packed shards) have no signature.
+    """
+    if path is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def check_paths(path_img, path_bb, crop_kwargs, shards=None):
+    """Return None if an image/bbox pair can be loaded and cropped, the error otherwise."""
+    try:
+        open_image(path_img, shards)
+        if path_bb is not None:
+            crop_image(path_img, path_bb, shards=shards, **crop_kwargs)
+    except Exception as e:
+        return str(e)
+    return None
+
+
+def _check_paths_chunk(args):
+    chunk, crop_kwargs, shards = args
+    return [
+        check_paths(path_img, path_bb, crop_kwargs, shards)
+        for path_img, path_bb in chunk
+    ]
+
+
+def load_sanitize_checkpoint(checkpoint_path, crop_kwargs):
+    """Read the results of a previous (possibly interrupted) sanitization.
+
+    Returns a dict (path_img, path_bb) -> (signatures, error), empty when there is no
+    checkpoint or when it was computed with other crop parameters.
+    """
+    results = {}
+    if checkpoint_path is None or not os.path.isfile(checkpoint_path):
+        return results
+    try:
+        with open(checkpoint_path, "r") as f:
+            header = json.loads(f.readline())
+            if header != crop_kwargs:
+                print("crop parameters changed, sanitizing all paths again")
+                return results
+            for line in f:
+                try:
+                    path_img, path_bb, signatures, error = json.loads(line)
+                except ValueError:
+                    continue  # last line of an interrupted run
+                results[(path_img, path_bb)] = (signatures, error)
+    except Exception as e:
+        print("failed loading sanitize checkpoint at ", checkpoint_path)
+        print(e)
+    return results
+
+
 def sanitize_paths(
     paths_img,
     paths_bb,
@@ -281,42 +989,117 @@ def sanitize_paths(
     select_cat=-1,
     max_dataset_size=float("inf"),
     verbose=False,
+    shards=None,
+    num_workers=0,
+    chunk_size=256,
+    checkpoint_path=None,
 ):
+    """Remove image/bbox pairs that cannot be loaded or cropped.
+
+    Pairs are checked by chunks, in num_workers processes. When checkpoint_path is set,
+    results are appended to it after each chunk along with the size and mtime of the
+    files, so that an interrupted run resumes where it stopped, and a later run only
+    checks again the new or modified files.
+    """
     return_paths_img = []
     return_paths_bb = []
 
     if paths_bb is None:
         paths_bb = [None for k in range(len(paths_img))]
 
-    for path_img, path_bb in tqdm(zip(paths_img, paths_bb)):
-        if len(return_paths_img) >= max_dataset_size:
-            break
+    crop_kwargs = {
+        "mask_delta": mask_delta,
+        "crop_delta": 0,
+        "mask_square": mask_square,
+        "crop_dim": crop_dim + crop_delta,
+        "output_dim": output_dim,
+        "context_pixels": context_pixels,
+        "load_size": load_size,
+        "select_cat": select_cat,
+    }
+
+    previous_results = load_sanitize_checkpoint(checkpoint_path, crop_kwargs)
+
+    # Pairs still to be checked, the others are known from the checkpoint
+    errors = [None] * len(paths_img)
+    signatures = [None] * len(paths_img)
+    to_check = []
+    for i, (path_img, path_bb) in enumerate(zip(paths_img, paths_bb)):
+        signatures[i] = [file_signature(path_img), file_signature(path_bb)]
+        previous = previous_results.get((path_img, path_bb))
+        if previous is not None and previous[0] == signatures[i]:
+            errors[i] = previous[1]
+        else:
+            to_check.append(i)
+    if len(previous_results) > 0:
+        print(
+            "%d paths already sanitized, %d paths to check"
+            % (len(paths_img) - len(to_check), len(to_check))
+        )
 
-        failed = False
+    checkpoint_file = None
+    if checkpoint_path is not None:
         try:
-            Image.open(path_img)
-            if path_bb is not None:
-                try:
-                    crop_image(
-                        path_img,
-                        path_bb,
-                        mask_delta=mask_delta,
-                        crop_delta=0,
-                        mask_square=mask_square,
-                        crop_dim=crop_dim + crop_delta,
-                        output_dim=output_dim,
-                        context_pixels=context_pixels,
-                        load_size=load_size,
-                        select_cat=select_cat,
-                    )
-                except Exception as e:
-                    failed = True
-                    error = e
+            if len(previous_results) == 0 or not os.path.isfile(checkpoint_path):
+                os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+                checkpoint_file = open(checkpoint_path, "w")
+                checkpoint_file.write(json.dumps(crop_kwargs) + "\n")
+            else:
+                checkpoint_file = open(checkpoint_path, "a")
         except Exception as e:
-            failed = True
-            error = e
+            print("failed opening sanitize checkpoint at ", checkpoint_path)
+            print(e)
+
+    chunks = [to_check[k : k + chunk_size] for k in range(0, len(to_check), chunk_size)]
+    tasks = (
+        (
+            [(paths_img[i], paths_bb[i]) for i in chunk],
+            crop_kwargs,
+            shards,
+        )
+        for chunk in chunks
+    )
+
+    pool = None
+    if num_workers > 0 and len(chunks) > 1:
+        pool = multiprocessing.Pool(num_workers)
+        chunk_results = pool.imap(_check_paths_chunk, tasks)
+    else:
+        chunk_results = map(_check_paths_chunk, tasks)
 
-        if failed:
+    num_scanned, num_valid = 0, 0
+    try:
+        with tqdm(total=len(to_check)) as pbar:
+            for chunk, chunk_errors in zip(chunks, chunk_results):
+                for i, error in zip(chunk, chunk_errors):
+                    errors[i] = error
+                    if checkpoint_file is not None:
+                        checkpoint_file.write(
+                            json.dumps(
+                                [paths_img[i], paths_bb[i], signatures[i], error]
+                            )
+                            + "\n"
+                        )
+                if checkpoint_file is not None:
+                    checkpoint_file.flush()
+                pbar.update(len(chunk))
+
+                # chunks are checked in order, we can stop once enough pairs are valid
+                while num_scanned <= chunk[-1]:
+                    num_valid += errors[num_scanned] is None
+                    num_scanned += 1
+                if num_valid >= max_dataset_size:
+                    break
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if checkpoint_file is not None:
+            checkpoint_file.close()
+
+    for path_img, path_bb, error in zip(paths_img, paths_bb, errors):
+        if len(return_paths_img) >= max_dataset_size:
+            break
+        if error is not None:
             if verbose:
                 print("failed", path_img, path_bb)
                 print(error)
@@ -336,6 +1119,63 @@ def sanitize_paths(
     return return_paths_img, return_paths_bb
 
 
+class FileLock:
+    """Exclusive lock on a file, shared by all the processes (e.g. trainings) of a host."""
+
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self.lock_file = None
+
+    def __enter__(self):
+        self.lock_file = open(self.lock_path, "a")
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+        self.lock_file = None
+
+
+def file_hash(path):
+    """sha1 of a file content, None if it does not exist."""
+    if not os.path.isfile(path):
+        return None
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def sanitize_cache_dir(dataroot, paths_file, params):
+    """Directory of the sanitization results of a paths file shared by all experiments on dataroot.
+
+    Results are keyed by dataroot, the content of the paths file and the parameters that
+    affect the validity of the crops, so that they are reused across experiments.
+    None is returned when dataroot is not writable.
+    """
+    key = json.dumps(
+        {
+            "dataroot": os.path.abspath(dataroot),
+            "paths_file": file_hash(paths_file),
+            "params": params,
+        },
+        sort_keys=True,
+    )
+    cache_dir = os.path.join(
+        dataroot, SANITIZE_CACHE_DIRNAME, hashlib.sha1(key.encode()).hexdigest()
+    )
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(os.path.join(cache_dir, "key.json"), "w") as f:
+            f.write(key)
+    except OSError as e:
+        warnings.warn(f"Sanitized paths cannot be cached in {dataroot}: {e}")
+        return None
+    return cache_dir
+
+
 def write_paths_file(img_paths, label_paths, file_path):
     try:
         with open(file_path, "w") as f:
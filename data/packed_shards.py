@@ -0,0 +1,234 @@
+"""Packed shard storage for path-based datasets.
+
+A domain directory (e.g. '/path/to/data/trainA') can be packed with
+'scripts/pack_path_dataset.py' into a few large container files holding the raw
+bytes of every image and label file listed in its 'paths.txt', plus an offset index.
+Datasets then read samples from the shards instead of opening one file per image
+and per label, which matters a lot on network filesystems.
+
+Layout of a packed domain:
+    /path/to/data/trainA/shards/index.npz
+    /path/to/data/trainA/shards/shard_00000.bin
+    /path/to/data/trainA/shards/shard_00001.bin
+    ...
+
+Records are keyed by their path as listed in 'paths.txt', relative to dataroot. Keys are
+stored as in a PathStore (see data/path_store.py), along with their 64-bit hashes that
+readers sort and search.
+"""
+import hashlib
+import io
+import os
+import numpy as np
+from PIL import Image
+from data.path_store import PathStore
+
+SHARDS_DIRNAME = "shards"
+SHARD_INDEX_FILENAME = "index.npz"
+SHARD_FILENAME = "shard_%05d.bin"
+
+
+def shard_key(path, root=None):
+    """Return the key under which a file is stored in the shards.
+
+    Paths are normalized, and made relative to root when they lie below it, so that
+    the same file is found whether data_relative_paths is used or not.
+    """
+    path = os.path.normpath(path)
+    if root:
+        root = os.path.normpath(root)
+        if path.startswith(root + os.sep):
+            path = path[len(root) + 1 :]
+    return path
+
+
+def key_hash(key):
+    """64-bit hash of a key, stable across processes and runs"""
+    digest = hashlib.blake2b(
+        key.encode("utf-8", "surrogateescape"), digest_size=8
+    ).digest()
+    return int.from_bytes(digest, "little")
+
+
+class ShardWriter:
+    """Append files to a shard directory, rolling over to a new shard file every shard_size bytes."""
+
+    def __init__(self, shard_dir, shard_size=1 << 30):
+        self.shard_dir = shard_dir
+        self.shard_size = shard_size
+        os.makedirs(shard_dir, exist_ok=True)
+
+        self.keys = []
+        self.hashes = []
+        self.shards = []
+        self.offsets = []
+        self.lengths = []
+        self.known_keys = set()
+
+        self.cur_shard = -1
+        self.cur_file = None
+        self.cur_size = 0
+
+    def _next_shard(self):
+        if self.cur_file is not None:
+            self.cur_file.close()
+        self.cur_shard += 1
+        self.cur_file = open(
+            os.path.join(self.shard_dir, SHARD_FILENAME % self.cur_shard), "wb"
+        )
+        self.cur_size = 0
+
+    def add(self, key, data):
+        """Store bytes data under key, records already present are skipped."""
+        if key in self.known_keys:
+            return
+        if self.cur_file is None or (
+            self.cur_size > 0 and self.cur_size + len(data) > self.shard_size
+        ):
+            self._next_shard()
+
+        self.keys.append(key)
+        self.hashes.append(key_hash(key))
+        self.shards.append(self.cur_shard)
+        self.offsets.append(self.cur_size)
+        self.lengths.append(len(data))
+        self.known_keys.add(key)
+
+        self.cur_file.write(data)
+        self.cur_size += len(data)
+
+    def add_file(self, key, path):
+        with open(path, "rb") as f:
+            self.add(key, f.read())
+
+    def close(self):
+        if self.cur_file is not None:
+            self.cur_file.close()
+            self.cur_file = None
+        keys = PathStore.from_list(self.keys)
+        np.savez(
+            os.path.join(self.shard_dir, SHARD_INDEX_FILENAME),
+            key_buffer=keys.buffer,
+            key_offsets=keys.offsets,
+            key_hashes=np.array(self.hashes, dtype=np.uint64),
+            shards=np.array(self.shards, dtype=np.int32),
+            offsets=np.array(self.offsets, dtype=np.int64),
+            lengths=np.array(self.lengths, dtype=np.int64),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ShardReader:
+    """Random-access reader over one or several shard directories.
+
+    Shard files are opened lazily in the process that reads them, so a reader created
+    before the DataLoader workers are started ends up with a single open handle per
+    shard file and per worker, and no handle is ever pickled.
+
+    Parameters:
+        shard_dirs (str list) -- shard directories, missing ones are ignored
+        root (str)            -- dataroot, stripped from the paths that are looked up
+    """
+
+    def __init__(self, shard_dirs, root=None):
+        self.root = root
+        self.shard_files = []
+
+        keys, hashes, shards, offsets, lengths = [], [], [], [], []
+        for shard_dir in shard_dirs:
+            index_path = os.path.join(shard_dir, SHARD_INDEX_FILENAME)
+            if not os.path.isfile(index_path):
+                continue
+            index = np.load(index_path)
+            keys.append(PathStore(index["key_buffer"], index["key_offsets"]))
+            hashes.append(index["key_hashes"])
+            shards.append(index["shards"] + len(self.shard_files))
+            offsets.append(index["offsets"])
+            lengths.append(index["lengths"])
+            nb_shards = int(index["shards"].max()) + 1 if len(index["shards"]) else 0
+            for i in range(nb_shards):
+                self.shard_files.append(os.path.join(shard_dir, SHARD_FILENAME % i))
+
+        # records are searched by hash, in the order of the hashes
+        self.keys = PathStore.concatenate(keys)
+        if len(keys) > 0:
+            hashes = np.concatenate(hashes)
+            self.order = np.argsort(hashes, kind="stable")
+            self.hashes = hashes[self.order]
+            self.shards = np.concatenate(shards)
+            self.offsets = np.concatenate(offsets)
+            self.lengths = np.concatenate(lengths)
+        else:
+            self.order = np.zeros(0, dtype=np.int64)
+            self.hashes = np.zeros(0, dtype=np.uint64)
+
+        self._pid = None
+        self._files = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _row(self, path):
+        if len(self.keys) == 0:
+            return -1
+        key = shard_key(path, self.root)
+        h = np.uint64(key_hash(key))
+        # keys are compared on hash collisions
+        pos = np.searchsorted(self.hashes, h)
+        while pos < len(self.hashes) and self.hashes[pos] == h:
+            row = int(self.order[pos])
+            if self.keys[row] == key:
+                return row
+            pos += 1
+        return -1
+
+    def __contains__(self, path):
+        return self._row(path) >= 0
+
+    def _file(self, shard):
+        if self._pid != os.getpid():  # handles are never shared across processes
+            self._files = {}
+            self._pid = os.getpid()
+        f = self._files.get(shard)
+        if f is None:
+            f = open(self.shard_files[shard], "rb")
+            self._files[shard] = f
+        return f
+
+    def get(self, path):
+        """Return the bytes stored for path, None if path is not in the shards."""
+        row = self._row(path)
+        if row < 0:
+            return None
+        f = self._file(int(self.shards[row]))
+        f.seek(int(self.offsets[row]))
+        return f.read(int(self.lengths[row]))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_pid"] = None
+        state["_files"] = {}
+        return state
+
+
+def open_image(path, shards=None):
+    """Open an image from the shards when it has been packed, from the filesystem otherwise."""
+    if shards is not None:
+        data = shards.get(path)
+        if data is not None:
+            return Image.open(io.BytesIO(data))
+    return Image.open(path)
+
+
+def open_text(path, shards=None):
+    """Open a text file (e.g. bbox labels) from the shards or from the filesystem."""
+    if shards is not None:
+        data = shards.get(path)
+        if data is not None:
+            return io.StringIO(data.decode("utf-8"))
+    return open(path, "r")
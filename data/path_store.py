@@ -0,0 +1,135 @@
+"""Compact storage of large lists of paths.
+
+A list of n Python strings costs an object per path, and every access from a forked
+dataloader worker touches its reference count, so that the pages holding the strings are
+slowly copied in each worker. A PathStore holds all the paths in a single bytes buffer
+with an offsets array instead, two numpy arrays whose pages are never written to.
+
+A store can also be saved to .npy files and memory-mapped, so that all ranks and
+dataloader workers share the same pages, and only the file prefix is pickled:
+    /path/to/prefix.buffer.npy    utf-8 encoded paths, concatenated
+    /path/to/prefix.offsets.npy   start of each path in the buffer, and end of the last one
+"""
+import os
+from collections.abc import Sequence
+import numpy as np
+
+
+def _encode(path):
+    return path.encode("utf-8", "surrogateescape")
+
+
+def _decode(data):
+    return data.decode("utf-8", "surrogateescape")
+
+
+class PathStore(Sequence):
+    """Read-only sequence of paths stored in a bytes buffer and an offsets array.
+
+    Parameters:
+        buffer (np.ndarray)  -- uint8 array, concatenated utf-8 encoded paths
+        offsets (np.ndarray) -- int64 array of size n + 1, path i is buffer[offsets[i]:offsets[i + 1]]
+        prefix (str)         -- prefix of the .npy files the store is memory-mapped from, if any
+    """
+
+    def __init__(self, buffer, offsets, prefix=None):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.prefix = prefix
+
+    @classmethod
+    def from_list(cls, paths):
+        encoded = [_encode(path) for path in paths]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(
+            np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)),
+            out=offsets[1:],
+        )
+        buffer = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return cls(buffer, offsets)
+
+    @classmethod
+    def concatenate(cls, stores):
+        """Store of the paths of all the stores, in order."""
+        buffers = [np.asarray(store.buffer) for store in stores]
+        offsets = [np.zeros(1, dtype=np.int64)]
+        start = 0
+        for store, buffer in zip(stores, buffers):
+            offsets.append(np.asarray(store.offsets[1:]) + start)
+            start += len(buffer)
+        return cls(
+            np.concatenate(buffers) if buffers else np.zeros(0, dtype=np.uint8),
+            np.concatenate(offsets),
+        )
+
+    @classmethod
+    def load(cls, prefix):
+        """Memory-map a store saved with save."""
+        return cls(
+            np.load(prefix + ".buffer.npy", mmap_mode="r"),
+            np.load(prefix + ".offsets.npy", mmap_mode="r"),
+            prefix,
+        )
+
+    def save(self, prefix):
+        """Write the store to .npy files, and return the memory-mapped store."""
+        dirname = os.path.dirname(prefix)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        for suffix, array in [
+            (".buffer.npy", self.buffer),
+            (".offsets.npy", self.offsets),
+        ]:
+            tmp_path = prefix + suffix + ".tmp%d" % os.getpid()
+            with open(tmp_path, "wb") as f:
+                np.save(f, np.asarray(array))
+            os.replace(tmp_path, prefix + suffix)
+        return PathStore.load(prefix)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("PathStore index out of range")
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return _decode(self.buffer[start:end].tobytes())
+
+    def __iter__(self):
+        data = self.buffer.tobytes()
+        offsets = self.offsets.tolist()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield _decode(data[start:end])
+
+    def __repr__(self):
+        return "PathStore(%d paths%s)" % (
+            len(self),
+            ", " + self.prefix if self.prefix is not None else "",
+        )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.prefix is not None:
+            # memory-mapped stores are reopened from their files
+            state["buffer"] = None
+            state["offsets"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.prefix is not None:
+            self.buffer = np.load(self.prefix + ".buffer.npy", mmap_mode="r")
+            self.offsets = np.load(self.prefix + ".offsets.npy", mmap_mode="r")
+
+
+def is_path_list(value):
+    """Whether value is a non-empty list of strings, to be replaced with a PathStore."""
+    return (
+        isinstance(value, list)
+        and len(value) > 0
+        and all(isinstance(elt, str) for elt in value)
+    )
@@ -0,0 +1,135 @@
+"""Prefetching of batches, overlapped with the training step.
+
+A DataPrefetcher iterates over a dataloader on a background thread, up to depth
+batches ahead of the training loop. Batch tensors are pinned and copied to the device
+on a side CUDA stream, so that the host-to-device copy of batch N+1 runs while step N
+computes, and the training stream only waits for the copy of the batch it consumes.
+On CPU, the thread still overlaps fetching and collating batches with compute.
+
+The time spent waiting for a batch is measured on the consumer side, in data_wait_time
+for the last batch and total_data_wait_time since the last reset.
+"""
+import queue
+import threading
+import time
+import torch
+
+_END = object()
+
+
+def _map_tensors(data, fn):
+    if torch.is_tensor(data):
+        return fn(data)
+    if isinstance(data, dict):
+        return {key: _map_tensors(value, fn) for key, value in data.items()}
+    if isinstance(data, list):
+        return [_map_tensors(value, fn) for value in data]
+    if isinstance(data, tuple):
+        return tuple(_map_tensors(value, fn) for value in data)
+    return data
+
+
+class DataPrefetcher:
+    """Dataloader wrapper that loads and moves batches to the device ahead of their use.
+
+    Parameters:
+        dataloader           -- CustomDatasetDataLoader or IterableCustomDatasetDataLoader
+        device (torch.device)-- device batch tensors are moved to
+        depth (int)          -- maximum number of batches loaded ahead
+    """
+
+    def __init__(self, dataloader, device, depth=2):
+        self.dataloader = dataloader
+        self.device = device
+        self.depth = depth
+        self.use_cuda = device.type == "cuda"
+        self.stream = torch.cuda.Stream(device=device) if self.use_cuda else None
+        self.data_wait_time = 0.0
+        self.total_data_wait_time = 0.0
+
+    def load_data(self):
+        return self
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __getattr__(self, name):
+        # dataset, sampler, ... of the wrapped dataloader
+        if "dataloader" not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.__dict__["dataloader"], name)
+
+    def reset_data_wait_time(self):
+        total = self.total_data_wait_time
+        self.total_data_wait_time = 0.0
+        return total
+
+    def to_device(self, data):
+        """Pin the tensors of a batch and start their copy to the device, on the side stream"""
+        if not self.use_cuda:
+            return data, None
+        with torch.cuda.stream(self.stream):
+            data = _map_tensors(
+                data,
+                lambda tensor: tensor.pin_memory().to(self.device, non_blocking=True),
+            )
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return data, event
+
+    def produce(self, batches, stop):
+        try:
+            for data in self.dataloader:
+                # the resume position of the wrapped dataloader runs ahead, it is kept with each batch
+                item = self.to_device(data) + (
+                    getattr(self.dataloader, "next_batch", None),
+                )
+                while not stop.is_set():
+                    try:
+                        batches.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+        except Exception as e:
+            item = e
+        else:
+            item = _END
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self.produce, args=(batches, stop), daemon=True
+        )
+        thread.start()
+        try:
+            while True:
+                wait_start = time.time()
+                item = batches.get()
+                if item is _END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                data, event, next_batch = item
+                if next_batch is not None:
+                    self.next_batch = next_batch
+                if event is not None:
+                    # the training stream waits for the copy, and owns the copied tensors
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    _map_tensors(
+                        data, lambda tensor: tensor.record_stream(current_stream)
+                    )
+                self.data_wait_time = time.time() - wait_start
+                self.total_data_wait_time += self.data_wait_time
+                yield data
+        finally:
+            stop.set()
@@ -0,0 +1,93 @@
+"""Replacement of the samples that fail to load, so that batches keep their size.
+
+Datasets return None for samples whose files cannot be read, and collate_fn drops them,
+so that batches with unreadable files are smaller than train_batch_size. A
+ResamplingDataset replaces such a sample inside the dataloader worker with another
+random one instead, up to max_tries times.
+
+Failures are counted in a tensor shared by all the workers, and appended to a log file
+with the index and exception of each failed sample, so that bad files can be pruned.
+"""
+import os
+import random
+import numpy as np
+import torch
+import torch.utils.data
+
+
+class ResamplingDataset(torch.utils.data.Dataset):
+    """Dataset wrapper that replaces failed samples with random other ones.
+
+    Parameters:
+        dataset (Dataset) -- wrapped dataset, returns None or raises on failures
+        log_path (str)    -- file where failed samples are appended, if any
+        max_tries (int)   -- maximum number of samples tried for an index
+    """
+
+    def __init__(self, dataset, log_path=None, max_tries=50):
+        self.dataset = dataset
+        self.log_path = log_path
+        self.max_tries = max_tries
+        self.failures = torch.zeros(1, dtype=torch.int64).share_memory_()
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        for i in range(self.max_tries):
+            try:
+                sample = self.dataset[index]
+                error = None
+            except Exception as e:
+                sample = None
+                error = e
+            if sample is not None:
+                return sample
+            self.log_failure(index, error)
+            index = self.get_replacement_index(index)
+        raise RuntimeError(
+            "%d samples in a row failed to load, see %s"
+            % (self.max_tries, self.log_path)
+        )
+
+    def get_replacement_index(self, index):
+        bucket_ids = getattr(self.dataset, "A_bucket_ids", None)
+        if bucket_ids is None:
+            return random.randint(0, len(self.dataset) - 1)
+        # a sample of the same shape, see data/bucket_sampler.py
+        indices = np.nonzero(bucket_ids == bucket_ids[index % len(bucket_ids)])[0]
+        return int(indices[random.randint(0, len(indices) - 1)])
+
+    def log_failure(self, index, error):
+        self.failures += 1
+        if self.log_path is None:
+            return
+        path = self.get_path(index)
+        with open(self.log_path, "a") as f:
+            f.write(
+                "%d\t%s\t%s\n"
+                % (index, path, repr(error) if error is not None else "None")
+            )
+
+    def get_path(self, index):
+        """Path of the domain A image of a sample, to identify it in the log"""
+        paths = getattr(self.dataset, "A_img_paths", None)
+        if paths is None or len(paths) == 0:
+            return ""
+        return paths[index % len(paths)]
+
+    def get_failures(self):
+        return int(self.failures.item())
+
+
+def report_failures(dataset, reported):
+    """Print the number of failed samples since the last report, and return the total"""
+    if not isinstance(dataset, ResamplingDataset):
+        return reported
+    failures = dataset.get_failures()
+    if failures > reported:
+        print(
+            "%d samples failed to load and were resampled (%d in total), see %s"
+            % (failures - reported, failures, dataset.log_path)
+        )
+    return failures
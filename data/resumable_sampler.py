@@ -0,0 +1,43 @@
+"""Batch sampler that can resume a pass over the dataset from a given batch.
+
+Sample indices are drawn in the same order for a given seed and pass, so that a training
+run resumed from a checkpoint taken in the middle of an epoch goes through the remaining
+batches of that epoch, without loading the batches that were already seen.
+"""
+import itertools
+import torch.utils.data
+
+
+class ResumableBatchSampler(torch.utils.data.Sampler):
+    """Wrapper of a batch sampler whose next pass can start at a given batch.
+
+    Parameters:
+        batch_sampler -- BatchSampler, or BucketBatchSampler whose order is set by set_epoch
+        generator (torch.Generator) -- generator of the wrapped sampler when it shuffles, reseeded at each pass
+        seed (int) -- shuffling seed
+    """
+
+    def __init__(self, batch_sampler, generator=None, seed=0):
+        self.batch_sampler = batch_sampler
+        self.generator = generator
+        self.seed = seed
+        self.start_batch = 0
+
+    def set_epoch(self, epoch):
+        # the seed may have been restored from a checkpoint since the samplers were created
+        if hasattr(self.batch_sampler, "set_epoch"):  # BucketBatchSampler
+            self.batch_sampler.seed = self.seed
+            self.batch_sampler.set_epoch(epoch)
+        sampler = getattr(self.batch_sampler, "sampler", None)
+        if hasattr(sampler, "set_epoch"):  # DistributedSampler
+            sampler.seed = self.seed
+            sampler.set_epoch(epoch)
+        if self.generator is not None:
+            self.generator.manual_seed(self.seed + epoch)
+
+    def __iter__(self):
+        start_batch, self.start_batch = self.start_batch, 0
+        return itertools.islice(iter(self.batch_sampler), start_batch, None)
+
+    def __len__(self):
+        return max(0, len(self.batch_sampler) - self.start_batch)
@@ -16,7 +16,9 @@ class SingleDataset(BaseDataset):
             opt (Option class) -- stores all the experiment flags; needs to be a subclass of BaseOptions
         """
         BaseDataset.__init__(self, opt)
-        self.A_paths = sorted(make_dataset(opt.dataroot, opt.max_dataset_size))
+        self.A_paths = sorted(
+            make_dataset(opt.dataroot, opt.max_dataset_size, cache_dir=self.sv_dir)
+        )
         self.transform = get_transform(opt, grayscale=(self.input_nc == 1))
 
     def __getitem__(self, index):
@@ -3,9 +3,10 @@ import random
 import torch
 import re
 import os
+import numpy as np
 from data.image_folder import make_labeled_path_dataset
 from data.base_dataset import get_transform_list
-from data.online_creation import crop_image
+from data.online_creation import crop_sequence, load_bbox_index, FrameCache
 
 
 def atoi(text):
@@ -16,9 +17,41 @@ def natural_keys(text):
     return [atoi(c) for c in re.split("(\d+)", text)]
 
 
+def get_valid_windows(paths, num_frames, frame_step, num_common_char):
+    """Return the start indices of all the valid windows of frames.
+
+    A window is made of num_frames frames every frame_step frames in the sorted paths,
+    and is valid if all its frames belong to the same sequence, i.e. their file names share
+    the same num_common_char first characters (all paths are one sequence if -1).
+    Also returns the number of sequences.
+    """
+    nb_paths = len(paths)
+    span = (num_frames - 1) * frame_step
+    if num_common_char == -1:
+        seq_starts = np.array([0], dtype=np.int64)
+    else:
+        prefixes = [path.split("/")[-1][:num_common_char] for path in paths]
+        # sorted paths of a sequence are consecutive
+        seq_starts = np.array(
+            [0] + [i for i in range(1, nb_paths) if prefixes[i] != prefixes[i - 1]],
+            dtype=np.int64,
+        )
+    seq_ends = np.append(seq_starts[1:], nb_paths)
+
+    windows = [
+        np.arange(seq_start, seq_end - span, dtype=np.int64)
+        for seq_start, seq_end in zip(seq_starts, seq_ends)
+        if seq_end - span > seq_start
+    ]
+    if len(windows) == 0:
+        return np.zeros(0, dtype=np.int64), len(seq_starts)
+    return np.concatenate(windows), len(seq_starts)
+
+
 class TemporalDataset(BaseDataset):
     def __len__(self):
-        return 1000000000000
+        """An epoch goes once through all the valid windows of domain A"""
+        return len(self.A_windows)
 
     def __init__(self, opt):
         BaseDataset.__init__(self, opt)
@@ -38,8 +71,6 @@ class TemporalDataset(BaseDataset):
         self.num_B = len(self.B_img_paths)
         self.num_frames = opt.D_temporal_number_frames
         self.frame_step = opt.D_temporal_frame_step
-        self.range_A = self.num_A - self.num_frames * self.frame_step
-        self.range_B = self.num_B - self.num_frames * self.frame_step
         self.num_common_char = self.opt.D_temporal_num_common_char
 
         self.opt = opt
@@ -53,6 +84,46 @@ class TemporalDataset(BaseDataset):
         self.B_img_paths.sort(key=natural_keys)
         self.B_label_paths.sort(key=natural_keys)
 
+        # decoded frames, shared by overlapping windows
+        self.frame_cache = FrameCache(opt.data_temporal_frame_cache_size)
+
+        # windows of frames from a single sequence, sampled from instead of rejecting samples
+        self.A_windows, nb_seqs_A = get_valid_windows(
+            self.A_img_paths, self.num_frames, self.frame_step, self.num_common_char
+        )
+        self.B_windows, nb_seqs_B = get_valid_windows(
+            self.B_img_paths, self.num_frames, self.frame_step, self.num_common_char
+        )
+        for domain, windows, nb_seqs in [
+            ("A", self.A_windows, nb_seqs_A),
+            ("B", self.B_windows, nb_seqs_B),
+        ]:
+            if len(windows) == 0:
+                raise ValueError(
+                    "No window of %d frames every %d frames found in the %d sequences of temporal domain %s"
+                    % (self.num_frames, self.frame_step, nb_seqs, domain)
+                )
+            print(
+                "temporal domain %s: %d windows in %d sequences"
+                % (domain, len(windows), nb_seqs)
+            )
+
+        # bbox files are parsed once into an index saved next to sanitized paths files
+        self.A_bbox_index = load_bbox_index(
+            os.path.join(self.sv_dir, "bbox_index_temporal_A.npz"),
+            self.A_label_paths,
+            root=self.root,
+            relative_paths=opt.data_relative_paths,
+            shards=self.shards,
+        )
+        self.B_bbox_index = load_bbox_index(
+            os.path.join(self.sv_dir, "bbox_index_temporal_B.npz"),
+            self.B_label_paths,
+            root=self.root,
+            relative_paths=opt.data_relative_paths,
+            shards=self.shards,
+        )
+
     def get_img(
         self,
         A_img_path,
@@ -62,138 +133,72 @@ class TemporalDataset(BaseDataset):
         B_label_mask_path=None,
         B_label_cls=None,
         index=None,
-    ):  # all params are unused
-
-        index_A = random.randint(0, self.range_A - 1)
-
-        images_A = []
-        labels_A = []
-
-        ref_name_A = self.A_img_paths[index_A].split("/")[-1][: self.num_common_char]
-
-        for i in range(self.num_frames):
-
-            cur_index_A = index_A + i * self.frame_step
-
-            if (
-                self.num_common_char != -1
-                and self.A_img_paths[cur_index_A].split("/")[-1][: self.num_common_char]
-                not in ref_name_A
-            ):
-                return None
-
-            cur_A_img_path, cur_A_label_path = (
-                self.A_img_paths[cur_index_A],
-                self.A_label_paths[cur_index_A],
-            )
+    ):  # all params but index are unused
 
-            if self.opt.data_relative_paths:
-                cur_A_img_path = os.path.join(self.root, cur_A_img_path)
-                if cur_A_label_path is not None:
-                    cur_A_label_path = os.path.join(self.root, cur_A_label_path)
-
-            try:
-                if i == 0:
-                    crop_coordinates = crop_image(
-                        cur_A_img_path,
-                        cur_A_label_path,
-                        mask_delta=self.opt.data_online_creation_mask_delta_A,
-                        crop_delta=self.opt.data_online_creation_crop_delta_A,
-                        mask_square=self.opt.data_online_creation_mask_square_A,
-                        crop_dim=self.opt.data_online_creation_crop_size_A,
-                        output_dim=self.opt.data_load_size,
-                        context_pixels=self.opt.data_online_context_pixels,
-                        load_size=self.opt.data_online_creation_load_size_A,
-                        get_crop_coordinates=True,
-                    )
-                cur_A_img, cur_A_label = crop_image(
-                    cur_A_img_path,
-                    cur_A_label_path,
-                    mask_delta=self.opt.data_online_creation_mask_delta_A,
-                    crop_delta=self.opt.data_online_creation_crop_delta_A,
-                    mask_square=self.opt.data_online_creation_mask_square_A,
-                    crop_dim=self.opt.data_online_creation_crop_size_A,
-                    output_dim=self.opt.data_load_size,
-                    context_pixels=self.opt.data_online_context_pixels,
-                    load_size=self.opt.data_online_creation_load_size_A,
-                    crop_coordinates=crop_coordinates,
-                )
-
-            except Exception as e:
-                print(e, f"{i+1}th frame of domain A in temporal dataloading")
-                return None
-
-            images_A.append(cur_A_img)
-            labels_A.append(cur_A_label)
+        if index is None:
+            index = random.randint(0, len(self.A_windows) - 1)
+        index_A = int(self.A_windows[index % len(self.A_windows)])
 
-        images_A, _ = self.transform(images_A, labels_A)
+        images_A = self.get_window("A", index_A)
+        if images_A is None:
+            return None
 
-        images_A = torch.stack(images_A)
+        if self.opt.data_serial_batches:
+            index_B = int(self.B_windows[index % len(self.B_windows)])
+        else:  # randomize the window for domain B to avoid fixed pairs
+            index_B = int(random.choice(self.B_windows))
 
-        index_B = random.randint(0, self.range_B - 1)
+        images_B = self.get_window("B", index_B)
+        if images_B is None:
+            return None
 
-        images_B = []
-        labels_B = []
+        return {"A": images_A, "B": images_B}
 
-        ref_name_B = self.B_img_paths[index_B].split("/")[-1][: self.num_common_char]
+    def get_window(self, domain, index_start):
+        """Return the (num_frames, C, H, W) tensor of the crops of a window of frames, None on failure"""
+        img_paths = getattr(self, domain + "_img_paths")
+        label_paths = getattr(self, domain + "_label_paths")
+        bbox_index = getattr(self, domain + "_bbox_index")
 
+        cur_img_paths = []
+        cur_label_paths = []
         for i in range(self.num_frames):
-            cur_index_B = index_B + i * self.frame_step
-
-            if (
-                self.num_common_char != -1
-                and self.B_img_paths[cur_index_B].split("/")[-1][: self.num_common_char]
-                not in ref_name_B
-            ):
-                return None
-
-            cur_B_img_path, cur_B_label_path = (
-                self.B_img_paths[cur_index_B],
-                self.B_label_paths[cur_index_B],
-            )
-
+            cur_index = index_start + i * self.frame_step
+            cur_img_path, cur_label_path = img_paths[cur_index], label_paths[cur_index]
             if self.opt.data_relative_paths:
-                cur_B_img_path = os.path.join(self.root, cur_B_img_path)
-                if cur_B_label_path is not None:
-                    cur_B_label_path = os.path.join(self.root, cur_B_label_path)
-
-            try:
-                if i == 0:
-                    crop_coordinates = crop_image(
-                        cur_B_img_path,
-                        cur_B_label_path,
-                        mask_delta=self.opt.data_online_creation_mask_delta_B,
-                        crop_delta=self.opt.data_online_creation_crop_delta_B,
-                        mask_square=self.opt.data_online_creation_mask_square_B,
-                        crop_dim=self.opt.data_online_creation_crop_size_B,
-                        output_dim=self.opt.data_load_size,
-                        context_pixels=self.opt.data_online_context_pixels,
-                        load_size=self.opt.data_online_creation_load_size_B,
-                        get_crop_coordinates=True,
-                    )
-
-                cur_B_img, cur_B_label = crop_image(
-                    cur_B_img_path,
-                    cur_B_label_path,
-                    mask_delta=self.opt.data_online_creation_mask_delta_B,
-                    crop_delta=self.opt.data_online_creation_crop_delta_B,
-                    mask_square=self.opt.data_online_creation_mask_square_B,
-                    crop_dim=self.opt.data_online_creation_crop_size_B,
-                    output_dim=self.opt.data_load_size,
-                    context_pixels=self.opt.data_online_context_pixels,
-                    load_size=self.opt.data_online_creation_load_size_B,
-                    crop_coordinates=crop_coordinates,
-                )
-
-            except Exception as e:
-                print(e, f"{i+1}th frame of domain B in temporal dataloading")
-                return None
-
-            images_B.append(cur_B_img)
-            labels_B.append(cur_B_label)
-
-        images_B, _ = self.transform(images_B, labels_B)
-
-        images_B = torch.stack(images_B)
-
-        return {"A": images_A, "B": images_B}
+                cur_img_path = os.path.join(self.root, cur_img_path)
+                if cur_label_path is not None:
+                    cur_label_path = os.path.join(self.root, cur_label_path)
+            cur_img_paths.append(cur_img_path)
+            cur_label_paths.append(cur_label_path)
+
+        try:
+            crops = crop_sequence(
+                cur_img_paths,
+                cur_label_paths,
+                mask_delta=getattr(
+                    self.opt, "data_online_creation_mask_delta_" + domain
+                ),
+                crop_delta=getattr(
+                    self.opt, "data_online_creation_crop_delta_" + domain
+                ),
+                mask_square=getattr(
+                    self.opt, "data_online_creation_mask_square_" + domain
+                ),
+                crop_dim=getattr(self.opt, "data_online_creation_crop_size_" + domain),
+                output_dim=self.opt.data_load_size,
+                context_pixels=self.opt.data_online_context_pixels,
+                load_size=getattr(self.opt, "data_online_creation_load_size_" + domain),
+                shards=self.shards,
+                bboxes_list=[bbox_index.get(path) for path in cur_label_paths],
+                fast_decode=self.opt.data_online_fast_decode,
+                frame_cache=self.frame_cache,
+            )
+        except Exception as e:
+            print(e, f"window of domain {domain} in temporal dataloading")
+            return None
+
+        images, _ = self.transform(
+            [img for img, _ in crops], [mask for _, mask in crops]
+        )
+        return torch.stack(images)
@@ -0,0 +1,160 @@
+import os
+import numpy as np
+import torch
+from data.base_dataset import BaseDataset, get_transform_list
+from data.image_folder import make_labeled_path_dataset
+from data.online_creation import crop_sequence, FrameCache
+from data.temporal_dataset import TemporalDataset
+from data.video_frames import load_video_seek_index, load_video_bboxes
+
+
+class TemporalVideoDataset(TemporalDataset):
+    """Temporal dataset whose frames are read from video files (see data/video_frames.py).
+
+    Each line of trainA/paths.txt and trainB/paths.txt gives a video and its bbox file, whose
+    lines are 'frame cat xmin ymin xmax ymax'. Windows of D_temporal_number_frames frames
+    every D_temporal_frame_step frames are taken within a video, among frames with bboxes.
+    """
+
+    def __init__(self, opt):
+        BaseDataset.__init__(self, opt)
+
+        self.num_frames = opt.D_temporal_number_frames
+        self.frame_step = opt.D_temporal_frame_step
+        self.transform = get_transform_list(self.opt, grayscale=(self.input_nc == 1))
+        self.frame_cache = FrameCache(opt.data_temporal_frame_cache_size)
+
+        self.A_size = 1  # use to compute image path in base datset method (unused then)
+        self.B_size = 1
+
+        for domain, domain_dir in [("A", self.dir_A), ("B", self.dir_B)]:
+            video_paths, bbox_paths = make_labeled_path_dataset(
+                domain_dir, "/paths.txt"
+            )  # load videos from '/path/to/data/trainA/paths.txt' as well as bboxes
+            if len(bbox_paths) != len(video_paths):
+                raise ValueError(
+                    "%d of the %d videos of temporal domain %s have no bbox file in %s"
+                    % (
+                        len(video_paths) - len(bbox_paths),
+                        len(video_paths),
+                        domain,
+                        os.path.join(domain_dir, "paths.txt"),
+                    )
+                )
+            if opt.data_relative_paths:
+                video_paths = [os.path.join(self.root, path) for path in video_paths]
+                bbox_paths = [os.path.join(self.root, path) for path in bbox_paths]
+
+            seek_indexes = []
+            bboxes = []
+            window_videos = []
+            window_starts = []
+            for video_id, (video_path, bbox_path) in enumerate(
+                zip(video_paths, bbox_paths)
+            ):
+                # seek indexes are built once per video and saved in the checkpoints directory
+                seek_index = load_video_seek_index(
+                    os.path.join(self.sv_dir, "video_seek_index"), video_path
+                )
+                video_bboxes = load_video_bboxes(bbox_path, len(seek_index))
+                starts = self.get_video_windows(
+                    np.array([len(frame_bboxes) > 0 for frame_bboxes in video_bboxes])
+                )
+                seek_indexes.append(seek_index)
+                bboxes.append(video_bboxes)
+                window_videos.append(np.full(len(starts), video_id, dtype=np.int64))
+                window_starts.append(starts)
+
+            if sum(len(starts) for starts in window_starts) == 0:
+                raise ValueError(
+                    "No window of %d frames every %d frames found in the %d videos of temporal domain %s"
+                    % (self.num_frames, self.frame_step, len(video_paths), domain)
+                )
+
+            setattr(self, domain + "_img_paths", video_paths)
+            setattr(self, domain + "_seek_indexes", seek_indexes)
+            setattr(self, domain + "_bboxes", bboxes)
+            setattr(self, domain + "_window_videos", np.concatenate(window_videos))
+            setattr(self, domain + "_window_starts", np.concatenate(window_starts))
+            # windows are sampled by TemporalDataset.get_img
+            setattr(
+                self,
+                domain + "_windows",
+                np.arange(len(getattr(self, domain + "_window_starts"))),
+            )
+            print(
+                "temporal domain %s: %d windows in %d videos"
+                % (domain, len(getattr(self, domain + "_windows")), len(video_paths))
+            )
+
+    def get_video_windows(self, has_bboxes):
+        """Start frames of the windows whose frames all have bboxes"""
+        span = (self.num_frames - 1) * self.frame_step
+        nb_starts = len(has_bboxes) - span
+        if nb_starts <= 0:
+            return np.zeros(0, dtype=np.int64)
+        valid = np.ones(nb_starts, dtype=bool)
+        for i in range(self.num_frames):
+            valid &= has_bboxes[i * self.frame_step : i * self.frame_step + nb_starts]
+        return np.nonzero(valid)[0]
+
+    def read_frames(self, seek_index, frame_ids, frame_paths, load_size):
+        """Decode the frames of a window that are not in the frame cache, None for the others"""
+        # a frame is not read by crop_sequence when its header and decoded image are cached
+        header_keys = [(frame_path, tuple(load_size)) for frame_path in frame_paths]
+        cached = [
+            self.frame_cache.max_size >= 2 * len(frame_ids)
+            and self.frame_cache.touch(header_key)
+            and self.frame_cache.touch(header_key + (None,))
+            for header_key in header_keys
+        ]
+        missing_ids = [
+            frame_id for frame_id, is_cached in zip(frame_ids, cached) if not is_cached
+        ]
+        if len(missing_ids) == 0:
+            return [None] * len(frame_ids)
+        decoded = iter(seek_index.read_frames(missing_ids))
+        return [None if is_cached else next(decoded) for is_cached in cached]
+
+    def get_window(self, domain, window_id):
+        """Return the (num_frames, C, H, W) tensor of the crops of a window of frames, None on failure"""
+        video_id = int(getattr(self, domain + "_window_videos")[window_id])
+        start = int(getattr(self, domain + "_window_starts")[window_id])
+        seek_index = getattr(self, domain + "_seek_indexes")[video_id]
+        video_bboxes = getattr(self, domain + "_bboxes")[video_id]
+        frame_ids = [start + i * self.frame_step for i in range(self.num_frames)]
+        frame_paths = [
+            "%s#%d" % (seek_index.video_path, frame_id) for frame_id in frame_ids
+        ]
+        load_size = getattr(self.opt, "data_online_creation_load_size_" + domain)
+
+        try:
+            frames = self.read_frames(seek_index, frame_ids, frame_paths, load_size)
+            crops = crop_sequence(
+                frame_paths,
+                [None] * len(frame_ids),
+                mask_delta=getattr(
+                    self.opt, "data_online_creation_mask_delta_" + domain
+                ),
+                crop_delta=getattr(
+                    self.opt, "data_online_creation_crop_delta_" + domain
+                ),
+                mask_square=getattr(
+                    self.opt, "data_online_creation_mask_square_" + domain
+                ),
+                crop_dim=getattr(self.opt, "data_online_creation_crop_size_" + domain),
+                output_dim=self.opt.data_load_size,
+                context_pixels=self.opt.data_online_context_pixels,
+                load_size=load_size,
+                bboxes_list=[video_bboxes[frame_id] for frame_id in frame_ids],
+                frame_cache=self.frame_cache,
+                imgs=frames,
+            )
+        except Exception as e:
+            print(e, f"window of domain {domain} in temporal video dataloading")
+            return None
+
+        images, _ = self.transform(
+            [img for img, _ in crops], [mask for _, mask in crops]
+        )
+        return torch.stack(images)
@@ -1,6 +1,7 @@
 import os.path
 from data.base_dataset import BaseDataset, get_transform
 from data.image_folder import make_dataset
+from data.packed_shards import open_image
 from PIL import Image
 import random
 
@@ -32,20 +33,24 @@ class UnalignedDataset(BaseDataset):
         )  # create a path '/path/to/data/validationB'
 
         self.A_img_paths = sorted(
-            make_dataset(self.dir_A, opt.data_max_dataset_size)
+            make_dataset(self.dir_A, opt.data_max_dataset_size, cache_dir=self.sv_dir)
         )  # load images from '/path/to/data/trainA'
         self.B_img_paths = sorted(
-            make_dataset(self.dir_B, opt.data_max_dataset_size)
+            make_dataset(self.dir_B, opt.data_max_dataset_size, cache_dir=self.sv_dir)
         )  # load images from '/path/to/data/trainB'
 
         if os.path.exists(self.dir_A_val):
             self.A_img_paths_val = sorted(
-                make_dataset(self.dir_A_val, opt.data_max_dataset_size)
+                make_dataset(
+                    self.dir_A_val, opt.data_max_dataset_size, cache_dir=self.sv_dir
+                )
             )
 
         if os.path.exists(self.dir_B_val):
             self.B_img_paths_val = sorted(
-                make_dataset(self.dir_B_val, opt.data_max_dataset_size)
+                make_dataset(
+                    self.dir_B_val, opt.data_max_dataset_size, cache_dir=self.sv_dir
+                )
             )
 
         self.A_size = len(self.A_img_paths)  # get the size of dataset A
@@ -67,8 +72,8 @@ class UnalignedDataset(BaseDataset):
         B_label_cls,
         index,
     ):
-        A_img = Image.open(A_img_path).convert("RGB")
-        B_img = Image.open(B_img_path).convert("RGB")
+        A_img = open_image(A_img_path, self.shards).convert("RGB")
+        B_img = open_image(B_img_path, self.shards).convert("RGB")
         # apply image transformation
         A = self.transform_A(A_img)
         B = self.transform_B(B_img)
@@ -7,6 +7,7 @@ from data.image_folder import (
     make_labeled_dataset,
     make_labeled_path_dataset,
 )
+from data.packed_shards import open_image
 from PIL import Image
 import random
 import numpy as np
@@ -37,7 +38,7 @@ class UnalignedLabeledClsDataset(BaseDataset):
 
         if not os.path.isfile(self.dir_A + "/paths.txt"):
             self.A_img_paths, self.A_label = make_labeled_dataset(
-                self.dir_A, opt.data_max_dataset_size
+                self.dir_A, opt.data_max_dataset_size, cache_dir=self.sv_dir
             )  # load images from '/path/to/data/trainA' as well as labels
             self.A_label = np.array(self.A_label)
         else:
@@ -50,7 +51,7 @@ class UnalignedLabeledClsDataset(BaseDataset):
         if opt.train_sem_use_label_B:
             if not os.path.isfile(self.dir_B + "/paths.txt"):
                 self.B_img_paths, self.B_label = make_labeled_dataset(
-                    self.dir_B, opt.data_max_dataset_size
+                    self.dir_B, opt.data_max_dataset_size, cache_dir=self.sv_dir
                 )
                 self.B_label = np.array(self.B_label)
             else:
@@ -61,7 +62,9 @@ class UnalignedLabeledClsDataset(BaseDataset):
 
         else:
             self.B_img_paths = sorted(
-                make_dataset(self.dir_B, opt.data_max_dataset_size)
+                make_dataset(
+                    self.dir_B, opt.data_max_dataset_size, cache_dir=self.sv_dir
+                )
             )  # load images from '/path/to/data/trainB'
 
         self.A_size = len(self.A_img_paths)  # get the size of dataset A
@@ -82,8 +85,8 @@ class UnalignedLabeledClsDataset(BaseDataset):
         B_label_cls,
         index,
     ):
-        A_img = Image.open(A_img_path).convert("RGB")
-        B_img = Image.open(B_img_path).convert("RGB")
+        A_img = open_image(A_img_path, self.shards).convert("RGB")
+        B_img = open_image(B_img_path, self.shards).convert("RGB")
         # apply image transformation
         A = self.transform_A(A_img)
         B = self.transform_B(B_img)
@@ -1,6 +1,7 @@
 import os.path
 from data.base_dataset import BaseDataset, get_transform, get_transform_seg
 from data.image_folder import make_dataset, make_labeled_path_dataset, make_dataset_path
+from data.packed_shards import open_image
 from PIL import Image
 import random
 import numpy as np
@@ -75,8 +76,8 @@ class UnalignedLabeledMaskDataset(BaseDataset):
     ):
         # Domain A
         try:
-            A_img = Image.open(A_img_path).convert("RGB")
-            A_label_mask = Image.open(A_label_mask_path)
+            A_img = open_image(A_img_path, self.shards).convert("RGB")
+            A_label_mask = open_image(A_label_mask_path, self.shards)
         except Exception as e:
             print(
                 "failure with reading A domain image ",
@@ -104,7 +105,7 @@ class UnalignedLabeledMaskDataset(BaseDataset):
         # Domain B
         if B_img_path is not None:
             try:
-                B_img = Image.open(B_img_path).convert("RGB")
+                B_img = open_image(B_img_path, self.shards).convert("RGB")
             except:
                 print(
                     "failed to read B domain image ",
@@ -114,7 +115,7 @@ class UnalignedLabeledMaskDataset(BaseDataset):
 
             if B_label_mask_path is not None:
                 try:
-                    B_label_mask = Image.open(B_label_mask_path)
+                    B_label_mask = open_image(B_label_mask_path, self.shards)
                 except:
                     print(
                         f"failed to read domain B label %s for image %s"
@@ -0,0 +1,80 @@
+import os.path
+from data.unaligned_labeled_mask_online_dataset import UnalignedLabeledMaskOnlineDataset
+from data.crop_bank import CropBankRefresher, load_or_build_crop_bank
+
+
+class UnalignedLabeledMaskOnlineBankDataset(UnalignedLabeledMaskOnlineDataset):
+    """
+    This dataset class samples crops at random from offline crop banks.
+
+    It takes the same data as unaligned_labeled_mask_online. Crops are precomputed once
+    with the data_online_creation_* options, data_online_creation_bank_crops_per_bbox times
+    around each bbox, and stored in memory-mapped crop banks in the checkpoints dir
+    (see data/crop_bank.py). A fraction of the banks is regenerated in the background
+    every data_online_creation_bank_refresh_period seconds, by processes that the training
+    loop starts with start_crop_bank_refresh.
+
+    Domain B crops are drawn from a bank only when domain B has bbox labels.
+    """
+
+    def __init__(self, opt):
+        """Initialize this dataset class.
+
+        Parameters:
+            opt (Option class) -- stores all the experiment flags; needs to be a subclass of BaseOptions
+        """
+        super().__init__(opt)
+
+        self.banks = {
+            "A": self.load_bank("A", self.A_img_paths, self.A_label_mask_paths)
+        }
+        if hasattr(self, "B_img_paths") and len(self.B_bbox_index) > 0:
+            self.banks["B"] = self.load_bank(
+                "B", self.B_img_paths, self.B_label_mask_paths
+            )
+
+    def get_bank_crop_kwargs(self, domain):
+        crop_kwargs = self.get_crop_kwargs(domain)
+        crop_kwargs["fast_decode"] = self.opt.data_online_fast_decode
+        return crop_kwargs
+
+    def load_bank(self, domain, img_paths, label_mask_paths):
+        bank_dir = os.path.join(self.sv_dir, "crop_bank_" + domain)
+        bbox_index = self.A_bbox_index if domain == "A" else self.B_bbox_index
+
+        return load_or_build_crop_bank(
+            bank_dir,
+            img_paths,
+            label_mask_paths,
+            bbox_index,
+            self.opt.data_online_creation_bank_crops_per_bbox,
+            self.get_bank_crop_kwargs(domain),
+            refresh_fraction=self.opt.data_online_creation_bank_refresh_fraction,
+            root=self.root,
+            relative_paths=self.opt.data_relative_paths,
+            shards=self.shards,
+            num_workers=self.opt.data_num_threads,
+        )
+
+    def start_crop_bank_refresh(self):
+        """Start regenerating the banks in the background, return the processes to close at the end of training"""
+        if self.opt.data_online_creation_bank_refresh_fraction <= 0:
+            return []
+        return [
+            CropBankRefresher(
+                bank.bank_dir,
+                self.get_bank_crop_kwargs(domain),
+                self.A_bbox_index if domain == "A" else self.B_bbox_index,
+                self.opt.data_online_creation_bank_refresh_period,
+                root=self.root,
+                relative_paths=self.opt.data_relative_paths,
+                shards=self.shards,
+            )
+            for domain, bank in self.banks.items()
+        ]
+
+    def get_crop(self, domain, img_path, label_mask_path):
+        """Training samples get random crops from the banks, whatever the image requested."""
+        if not self.training_sample or domain not in self.banks:
+            return super().get_crop(domain, img_path, label_mask_path)
+        return self.banks[domain].sample()
@@ -3,9 +3,14 @@ from data.base_dataset import BaseDataset, get_transform, get_transform_seg
 from data.image_folder import make_dataset, make_labeled_path_dataset, make_dataset_path
 from data.online_creation import (
     crop_image,
+    crop_images,
     sanitize_paths,
     write_paths_file,
+    load_bbox_index,
+    sanitize_cache_dir,
+    FileLock,
 )
+from data.packed_shards import open_image
 from PIL import Image
 import random
 import numpy as np
@@ -89,6 +94,24 @@ class UnalignedLabeledMaskOnlineDataset(BaseDataset):
         if os.path.exists(self.dir_B):
             self.B_size = len(self.B_img_paths)  # get the size of dataset B
 
+        # bbox files are parsed once into an index saved next to sanitized paths files
+        self.A_bbox_index = load_bbox_index(
+            os.path.join(self.sv_dir, "bbox_index_train_A.npz"),
+            self.A_label_mask_paths,
+            select_cat=opt.data_online_select_category,
+            root=self.root,
+            relative_paths=opt.data_relative_paths,
+            shards=self.shards,
+        )
+        if hasattr(self, "B_img_paths"):
+            self.B_bbox_index = load_bbox_index(
+                os.path.join(self.sv_dir, "bbox_index_train_B.npz"),
+                self.B_label_mask_paths,
+                root=self.root,
+                relative_paths=opt.data_relative_paths,
+                shards=self.shards,
+            )
+
         self.transform = get_transform_seg(self.opt, grayscale=(self.input_nc == 1))
         self.transform_noseg = get_transform(self.opt, grayscale=(self.input_nc == 1))
 
@@ -98,138 +121,197 @@ class UnalignedLabeledMaskOnlineDataset(BaseDataset):
 
         self.header = ["img", "mask"]
 
+        self.crop_buffers = {"A": [], "B": []}
+        self.training_sample = False
+
     def sanitize(self):
-        paths_sanitized_train_A = os.path.join(
-            self.sv_dir, "paths_sanitized_train_A.txt"
-        )
-        if hasattr(self, "B_img_paths"):
-            paths_sanitized_train_B = os.path.join(
-                self.sv_dir, "paths_sanitized_train_B.txt"
-            )
-        if hasattr(self, "B_img_paths"):
-            train_sanitized_exist = os.path.exists(
-                paths_sanitized_train_A
-            ) and os.path.exists(paths_sanitized_train_B)
-        else:
-            train_sanitized_exist = os.path.exists(paths_sanitized_train_A)
         validation_is_needed = (
             self.opt.phase == "train" and self.opt.train_compute_D_accuracy
         )
 
-        paths_sanitized_validation_A = os.path.join(
-            self.sv_dir, "paths_sanitized_validation_A.txt"
-        )
-        paths_sanitized_validation_B = os.path.join(
-            self.sv_dir, "paths_sanitized_validation_B.txt"
+        print("--------------")
+        print("Sanitizing images and labels paths")
+        print("--- DOMAIN A ---")
+        dir_A = self.dir_A if os.path.exists(self.dir_A) else self.opt.dataroot
+        self.A_img_paths, self.A_label_mask_paths = self.sanitize_domain(
+            self.A_img_paths,
+            self.A_label_mask_paths,
+            "A",
+            "train",
+            dir_A,
+            select_cat=self.opt.data_online_select_category,
         )
-
-        validation_sanitized_exist = os.path.exists(
-            paths_sanitized_validation_A
-        ) and os.path.exists(paths_sanitized_validation_B)
-
-        if train_sanitized_exist and (
-            not validation_is_needed or validation_sanitized_exist
-        ):
-            self.A_img_paths, self.A_label_mask_paths = make_labeled_path_dataset(
-                self.sv_dir, "/paths_sanitized_train_A.txt"
+        if validation_is_needed:
+            self.A_img_paths_val, self.A_label_mask_paths_val = self.sanitize_domain(
+                self.A_img_paths_val,
+                self.A_label_mask_paths_val,
+                "A",
+                "validation",
+                self.dir_val_A,
+            )
+        print("--- DOMAIN B ---")
+        if hasattr(self, "B_img_paths"):
+            self.B_img_paths, self.B_label_mask_paths = self.sanitize_domain(
+                self.B_img_paths, self.B_label_mask_paths, "B", "train", self.dir_B
             )
-            if hasattr(self, "B_img_paths"):
-                self.B_img_paths, self.B_label_mask_paths = make_labeled_path_dataset(
-                    self.sv_dir, "/paths_sanitized_train_B.txt"
-                )
             if validation_is_needed:
-                (
-                    self.A_img_paths_val,
-                    self.A_label_mask_paths_val,
-                ) = make_labeled_path_dataset(
-                    self.sv_dir, "/paths_sanitized_validation_A.txt"
-                )
                 (
                     self.B_img_paths_val,
                     self.B_label_mask_paths_val,
-                ) = make_labeled_path_dataset(
-                    self.sv_dir, "/paths_sanitized_validation_B.txt"
+                ) = self.sanitize_domain(
+                    self.B_img_paths_val,
+                    self.B_label_mask_paths_val,
+                    "B",
+                    "validation",
+                    self.dir_val_B,
                 )
-            print("Sanitized images and labels paths loaded.")
-        else:
-            print("--------------")
-            print("Sanitizing images and labels paths")
-            print("--- DOMAIN A ---")
-
-            self.A_img_paths, self.A_label_mask_paths = sanitize_paths(
-                self.A_img_paths,
-                self.A_label_mask_paths,
-                mask_delta=self.opt.data_online_creation_mask_delta_A,
-                crop_delta=self.opt.data_online_creation_crop_delta_A,
-                mask_square=self.opt.data_online_creation_mask_square_A,
-                crop_dim=self.opt.data_online_creation_crop_size_A,
-                output_dim=self.opt.data_load_size,
-                max_dataset_size=self.opt.data_max_dataset_size,
-                context_pixels=self.opt.data_online_context_pixels,
-                load_size=self.opt.data_online_creation_load_size_A,
-                select_cat=self.opt.data_online_select_category,
-            )
-            write_paths_file(
-                self.A_img_paths,
-                self.A_label_mask_paths,
-                paths_sanitized_train_A,
+        print("--------------")
+
+    def sanitize_domain(
+        self, img_paths, label_mask_paths, domain, split, paths_dir, select_cat=-1
+    ):
+        """Sanitize the paths of a domain, results are saved as 'paths_sanitized_<split>_<domain>.txt'
+        in the checkpoint dir, and shared with the other experiments on the same dataroot
+        in a dataroot-level cache.
+        """
+        paths_sanitized_name = "paths_sanitized_%s_%s.txt" % (split, domain)
+        paths_sanitized = os.path.join(self.sv_dir, paths_sanitized_name)
+        if os.path.exists(paths_sanitized):
+            print("Sanitized images and labels paths loaded from ", paths_sanitized)
+            return make_labeled_path_dataset(self.sv_dir, "/" + paths_sanitized_name)
+
+        params = {
+            "mask_delta": getattr(
+                self.opt, "data_online_creation_mask_delta_" + domain
+            ),
+            "crop_delta": getattr(
+                self.opt, "data_online_creation_crop_delta_" + domain
+            ),
+            "mask_square": getattr(
+                self.opt, "data_online_creation_mask_square_" + domain
+            ),
+            "crop_dim": getattr(self.opt, "data_online_creation_crop_size_" + domain),
+            "output_dim": self.opt.data_load_size,
+            "max_dataset_size": (
+                self.opt.data_max_dataset_size
+                if split == "train"
+                else self.opt.train_pool_size
+            ),
+            "context_pixels": self.opt.data_online_context_pixels,
+            "load_size": getattr(self.opt, "data_online_creation_load_size_" + domain),
+            "select_cat": select_cat,
+        }
+
+        cache_dir = sanitize_cache_dir(
+            self.opt.dataroot, os.path.join(paths_dir, "paths.txt"), params
+        )
+        if cache_dir is None:
+            img_paths, label_mask_paths = sanitize_paths(
+                img_paths,
+                label_mask_paths,
+                shards=self.shards,
+                num_workers=self.opt.data_num_threads,
+                checkpoint_path=os.path.join(
+                    self.sv_dir, "sanitize_checkpoint_%s_%s.txt" % (split, domain)
+                ),
+                **params,
             )
-            if self.opt.phase == "train" and self.opt.train_compute_D_accuracy:
-                self.A_img_paths_val, self.A_label_mask_paths_val = sanitize_paths(
-                    self.A_img_paths_val,
-                    self.A_label_mask_paths_val,
-                    mask_delta=self.opt.data_online_creation_mask_delta_A,
-                    crop_delta=self.opt.data_online_creation_crop_delta_A,
-                    mask_square=self.opt.data_online_creation_mask_square_A,
-                    crop_dim=self.opt.data_online_creation_crop_size_A,
-                    output_dim=self.opt.data_load_size,
-                    max_dataset_size=self.opt.train_pool_size,
-                    context_pixels=self.opt.data_online_context_pixels,
-                    load_size=self.opt.data_online_creation_load_size_A,
-                )
-                write_paths_file(
-                    self.A_img_paths_val,
-                    self.A_label_mask_paths_val,
-                    paths_sanitized_validation_A,
-                )
-            print("--- DOMAIN B ---")
-            if hasattr(self, "B_img_paths"):
-                self.B_img_paths, self.B_label_mask_paths = sanitize_paths(
-                    self.B_img_paths,
-                    self.B_label_mask_paths,
-                    mask_delta=self.opt.data_online_creation_mask_delta_B,
-                    crop_delta=self.opt.data_online_creation_crop_delta_B,
-                    mask_square=self.opt.data_online_creation_mask_square_B,
-                    crop_dim=self.opt.data_online_creation_crop_size_B,
-                    output_dim=self.opt.data_load_size,
-                    max_dataset_size=self.opt.data_max_dataset_size,
-                    context_pixels=self.opt.data_online_context_pixels,
-                    load_size=self.opt.data_online_creation_load_size_B,
-                )
-                write_paths_file(
-                    self.B_img_paths,
-                    self.B_label_mask_paths,
-                    paths_sanitized_train_B,
-                )
-                if self.opt.phase == "train" and self.opt.train_compute_D_accuracy:
-                    self.B_img_paths_val, self.B_label_mask_paths_val = sanitize_paths(
-                        self.B_img_paths_val,
-                        self.B_label_mask_paths_val,
-                        mask_delta=self.opt.data_online_creation_mask_delta_B,
-                        crop_delta=self.opt.data_online_creation_crop_delta_B,
-                        mask_square=self.opt.data_online_creation_mask_square_B,
-                        crop_dim=self.opt.data_online_creation_crop_size_B,
-                        output_dim=self.opt.data_load_size,
-                        max_dataset_size=self.opt.train_pool_size,
-                        context_pixels=self.opt.data_online_context_pixels,
-                        load_size=self.opt.data_online_creation_load_size_B,
+        else:
+            # concurrent trainings on the same data wait for the first one to sanitize
+            with FileLock(os.path.join(cache_dir, "lock")):
+                if os.path.exists(os.path.join(cache_dir, paths_sanitized_name)):
+                    print("Sanitized images and labels paths loaded from ", cache_dir)
+                    img_paths, label_mask_paths = make_labeled_path_dataset(
+                        cache_dir, "/" + paths_sanitized_name
+                    )
+                else:
+                    img_paths, label_mask_paths = sanitize_paths(
+                        img_paths,
+                        label_mask_paths,
+                        shards=self.shards,
+                        num_workers=self.opt.data_num_threads,
+                        checkpoint_path=os.path.join(
+                            cache_dir,
+                            "sanitize_checkpoint_%s_%s.txt" % (split, domain),
+                        ),
+                        **params,
                     )
                     write_paths_file(
-                        self.B_img_paths_val,
-                        self.B_label_mask_paths_val,
-                        paths_sanitized_validation_B,
+                        img_paths,
+                        label_mask_paths,
+                        os.path.join(cache_dir, paths_sanitized_name),
                     )
-            print("--------------")
+
+        write_paths_file(img_paths, label_mask_paths, paths_sanitized)
+        return img_paths, label_mask_paths
+
+    def __getitem__(self, index):
+        # buffered (or banked) crops are served to training samples only
+        self.training_sample = True
+        try:
+            return super().__getitem__(index)
+        finally:
+            self.training_sample = False
+
+    def get_crop(self, domain, img_path, label_mask_path):
+        """Return img_path, label_mask_path, img and mask of an online crop for domain A or B.
+
+        With data_online_creation_crops_per_image > 1, a decoded image gives crops for as many
+        consecutive training samples, that are buffered in each dataloader worker. Buffered
+        crops are served whatever the image requested, hence returned paths.
+        """
+        bbox_index = self.A_bbox_index if domain == "A" else self.B_bbox_index
+
+        crop_kwargs = self.get_crop_kwargs(domain)
+        crop_kwargs.update(
+            {
+                "shards": self.shards,
+                "bboxes": bbox_index.get(label_mask_path),
+                "fast_decode": self.opt.data_online_fast_decode,
+            }
+        )
+
+        if (
+            not self.training_sample
+            or self.opt.data_online_creation_crops_per_image == 1
+        ):
+            img, mask = crop_image(img_path, label_mask_path, **crop_kwargs)
+            return img_path, label_mask_path, img, mask
+
+        crop_buffer = self.crop_buffers[domain]
+        if len(crop_buffer) == 0:
+            for img, mask in crop_images(
+                img_path,
+                label_mask_path,
+                nb_crops=self.opt.data_online_creation_crops_per_image,
+                **crop_kwargs,
+            ):
+                crop_buffer.append((img_path, label_mask_path, img, mask))
+        return crop_buffer.pop(0)
+
+    def get_crop_kwargs(self, domain):
+        """crop_image parameters of domain A or B, from data_online_creation_* options"""
+        if domain == "A":
+            select_cat = self.opt.data_online_select_category
+        else:
+            select_cat = -1
+        crop_kwargs = {
+            "mask_delta": getattr(
+                self.opt, "data_online_creation_mask_delta_" + domain
+            ),
+            "crop_delta": getattr(
+                self.opt, "data_online_creation_crop_delta_" + domain
+            ),
+            "mask_square": getattr(
+                self.opt, "data_online_creation_mask_square_" + domain
+            ),
+            "crop_dim": getattr(self.opt, "data_online_creation_crop_size_" + domain),
+            "output_dim": self.opt.data_load_size,
+            "context_pixels": self.opt.data_online_context_pixels,
+            "load_size": getattr(self.opt, "data_online_creation_load_size_" + domain),
+            "select_cat": select_cat,
+        }
+        return crop_kwargs
 
     def get_img(
         self,
@@ -243,17 +325,8 @@ class UnalignedLabeledMaskOnlineDataset(BaseDataset):
     ):
         # Domain A
         try:
-            A_img, A_label_mask = crop_image(
-                A_img_path,
-                A_label_mask_path,
-                mask_delta=self.opt.data_online_creation_mask_delta_A,
-                crop_delta=self.opt.data_online_creation_crop_delta_A,
-                mask_square=self.opt.data_online_creation_mask_square_A,
-                crop_dim=self.opt.data_online_creation_crop_size_A,
-                output_dim=self.opt.data_load_size,
-                context_pixels=self.opt.data_online_context_pixels,
-                load_size=self.opt.data_online_creation_load_size_A,
-                select_cat=self.opt.data_online_select_category,
+            A_img_path, A_label_mask_path, A_img, A_label_mask = self.get_crop(
+                "A", A_img_path, A_label_mask_path
             )
 
         except Exception as e:
@@ -277,17 +350,12 @@ class UnalignedLabeledMaskOnlineDataset(BaseDataset):
         if B_img_path is not None:
             try:
                 if B_label_mask_path is not None:
-                    B_img, B_label_mask = crop_image(
+                    (
                         B_img_path,
                         B_label_mask_path,
-                        mask_delta=self.opt.data_online_creation_mask_delta_B,
-                        crop_delta=self.opt.data_online_creation_crop_delta_B,
-                        mask_square=self.opt.data_online_creation_mask_square_B,
-                        crop_dim=self.opt.data_online_creation_crop_size_B,
-                        output_dim=self.opt.data_load_size,
-                        context_pixels=self.opt.data_online_context_pixels,
-                        load_size=self.opt.data_online_creation_load_size_B,
-                    )
+                        B_img,
+                        B_label_mask,
+                    ) = self.get_crop("B", B_img_path, B_label_mask_path)
                     B, B_label_mask = self.transform(B_img, B_label_mask)
 
                     if torch.any(B_label_mask > self.semantic_nclasses - 1):
@@ -302,7 +370,7 @@ class UnalignedLabeledMaskOnlineDataset(BaseDataset):
                         B_label_mask = (B_label_mask >= 1) * 1
 
                 else:
-                    B_img = Image.open(B_img_path).convert("RGB")
+                    B_img = open_image(B_img_path, self.shards).convert("RGB")
                     B = self.transform_noseg(B_img)
                     B_label_mask = []
 
@@ -0,0 +1,141 @@
+"""Frames read directly from video files, for the temporal dataset.
+
+Each video comes with a bbox file whose lines are 'frame cat xmin ymin xmax ymax', frame
+being the index of the frame in presentation order, starting at 0.
+
+A seek index of each video, the presentation timestamps of its frames and which of
+them are keyframes, is built once by demuxing the file without decoding it, and saved
+next to the other dataset indexes. A window of frames is then read by seeking to the
+last keyframe before its first frame, and decoding sequentially up to its last frame.
+
+Videos are read with PyAV (pip install av), which is only imported when needed.
+"""
+import hashlib
+import os
+import numpy as np
+from data.online_creation import file_signature
+
+
+def _import_av():
+    try:
+        import av
+    except ImportError as e:
+        raise ImportError(
+            "PyAV is required to read frames from video files, install it with 'pip install av'"
+        ) from e
+    return av
+
+
+class VideoSeekIndex:
+    """Presentation timestamps and keyframe flags of the frames of a video.
+
+    Parameters:
+        video_path (str)     -- video file
+        pts (np.ndarray)     -- int64 timestamps of the frames, in presentation order
+        keyframes (np.array) -- bool, whether each frame is a keyframe
+    """
+
+    def __init__(self, video_path, pts, keyframes):
+        self.video_path = video_path
+        self.pts = pts
+        self.keyframes = keyframes
+
+    def __len__(self):
+        return len(self.pts)
+
+    @classmethod
+    def build(cls, video_path):
+        av = _import_av()
+        pts = []
+        keyframes = []
+        with av.open(video_path) as container:
+            stream = container.streams.video[0]
+            for packet in container.demux(stream):
+                if packet.pts is None:  # flushing packets
+                    continue
+                pts.append(packet.pts)
+                keyframes.append(packet.is_keyframe)
+        order = np.argsort(np.array(pts, dtype=np.int64), kind="stable")
+        return cls(
+            video_path,
+            np.array(pts, dtype=np.int64)[order],
+            np.array(keyframes, dtype=bool)[order],
+        )
+
+    def save(self, index_path):
+        np.savez(
+            index_path,
+            pts=self.pts,
+            keyframes=self.keyframes,
+            signature=np.array(file_signature(self.video_path) or [], dtype=np.int64),
+        )
+
+    @classmethod
+    def load(cls, index_path, video_path):
+        """Load a saved index, None if it is missing or if the video changed since."""
+        if not os.path.isfile(index_path):
+            return None
+        index = np.load(index_path)
+        signature = file_signature(video_path)
+        if signature is None or index["signature"].tolist() != signature:
+            return None
+        return cls(video_path, index["pts"], index["keyframes"])
+
+    def read_frames(self, frame_ids):
+        """Decode the given frames, in increasing order, and return them as RGB PIL images."""
+        av = _import_av()
+        frame_ids = sorted(frame_ids)
+        wanted = {int(self.pts[frame_id]): i for i, frame_id in enumerate(frame_ids)}
+        last_pts = int(self.pts[frame_ids[-1]])
+
+        # decoding starts at the last keyframe before the first frame
+        keyframe_ids = np.nonzero(self.keyframes[: frame_ids[0] + 1])[0]
+        seek_id = keyframe_ids[-1] if len(keyframe_ids) > 0 else 0
+
+        frames = [None] * len(frame_ids)
+        with av.open(self.video_path) as container:
+            stream = container.streams.video[0]
+            container.seek(int(self.pts[seek_id]), stream=stream, backward=True)
+            for frame in container.decode(stream):
+                if frame.pts is None:
+                    continue
+                if frame.pts in wanted:
+                    frames[wanted[frame.pts]] = frame.to_image()
+                if frame.pts >= last_pts:
+                    break
+
+        if any(frame is None for frame in frames):
+            raise ValueError(
+                f"failure with decoding frames {frame_ids} of video {self.video_path}"
+            )
+        return frames
+
+
+def load_video_seek_index(index_dir, video_path):
+    """Load the seek index of a video from index_dir, build and save it first if needed."""
+    index_path = os.path.join(
+        index_dir, hashlib.sha1(video_path.encode("utf-8")).hexdigest() + ".npz"
+    )
+    index = VideoSeekIndex.load(index_path, video_path)
+    if index is None:
+        index = VideoSeekIndex.build(video_path)
+        os.makedirs(index_dir, exist_ok=True)
+        index.save(index_path)
+    return index
+
+
+def load_video_bboxes(bbox_path, nb_frames, select_cat=-1):
+    """Parse a video bbox file into a list of (k, 5) int arrays of [cat, xmin, ymin, xmax, ymax] rows, one per frame."""
+    rows = [[] for i in range(nb_frames)]
+    with open(bbox_path, "r") as f:
+        for line in f:
+            elts = line.split()
+            if len(elts) == 0:
+                continue
+            if len(elts) < 6:
+                raise ValueError(f"{line} in {bbox_path} is not a valid video bbox")
+            frame_id, bbox = int(elts[0]), [int(elt) for elt in elts[1:6]]
+            if frame_id >= nb_frames or (select_cat != -1 and bbox[0] != select_cat):
+                continue
+            rows[frame_id].append(bbox)
+    return [np.array(bboxes, dtype=np.int64).reshape(-1, 5) for bboxes in rows]
@@ -378,13 +378,14 @@ class BaseGanModel(BaseModel):
                     fake_name = None
                     real_name = None
 
-                loss_value = self.compute_D_loss_generic(
-                    netD,
-                    domain,
-                    loss,
-                    fake_name=fake_name,
-                    real_name=real_name,
-                )
+                with self.profiler.span("compute_D_loss " + discriminator.name):
+                    loss_value = self.compute_D_loss_generic(
+                        netD,
+                        domain,
+                        loss,
+                        fake_name=fake_name,
+                        real_name=real_name,
+                    )
 
             else:
                 loss_value = torch.zeros([], device=self.device)
@@ -437,7 +438,8 @@ class BaseGanModel(BaseModel):
         self.loss_G_tot = 0
         for loss_function in self.loss_functions_G:
             with torch.cuda.amp.autocast(enabled=self.with_amp):
-                getattr(self, loss_function)()
+                with self.profiler.span(loss_function):
+                    getattr(self, loss_function)()
 
     def compute_G_loss_GAN(self):
         """Calculate GAN losses for generator(s)"""
@@ -455,13 +457,14 @@ class BaseGanModel(BaseModel):
                     fake_name = None
                     real_name = None
 
-                loss_value = self.compute_G_loss_GAN_generic(
-                    netD,
-                    domain,
-                    loss,
-                    fake_name=fake_name,
-                    real_name=real_name,
-                )
+                with self.profiler.span("compute_G_loss_GAN " + discriminator.name):
+                    loss_value = self.compute_G_loss_GAN_generic(
+                        netD,
+                        domain,
+                        loss,
+                        fake_name=fake_name,
+                        real_name=real_name,
+                    )
 
             else:
                 loss_value = torch.zeros([], device=self.device)
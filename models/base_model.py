@@ -1,5 +1,8 @@
 import os
 import copy
+import functools
+import random
+import warnings
 import torch
 from collections import OrderedDict
 from abc import ABC, abstractmethod
@@ -19,6 +22,10 @@ from .modules.fid.pytorch_fid.fid_score import (
 from util.util import save_image, tensor2im
 import numpy as np
 from util.diff_aug import DiffAugment
+from util.batch_aug import BatchGeometricAug, BatchPhotometricAug
+from util.profiler import Profiler
+from util.checkpoint_writer import CheckpointWriter
+from util.export_worker import ExportWorker, export_network, get_onnx_opset_version
 from . import base_networks
 
 # for D accuracy
@@ -30,6 +37,34 @@ from .modules import loss
 from util.discriminator import DiscriminatorInfo
 
 
+def unwrap_network(net):
+    """Return the network wrapped by DataParallel or DistributedDataParallel"""
+    if isinstance(
+        net, (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)
+    ):
+        return net.module
+    return net
+
+
+def get_numpy_rng_state():
+    """numpy random state, with its keys as a tensor so that it can be loaded as weights"""
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return (
+        name,
+        torch.from_numpy(keys.astype(np.int64)),
+        pos,
+        has_gauss,
+        cached_gaussian,
+    )
+
+
+def set_numpy_rng_state(state):
+    name, keys, pos, has_gauss, cached_gaussian = state
+    np.random.set_state(
+        (name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian)
+    )
+
+
 class BaseModel(ABC):
     """This class is an abstract base class (ABC) for models.
     To create a subclass, you need to implement the following five functions:
@@ -72,9 +107,27 @@ class BaseModel(ABC):
         self.save_dir = os.path.join(
             opt.checkpoints_dir, opt.name
         )  # save all the checkpoints to save_dir
+        self.profiler = Profiler(
+            enabled=self.isTrain and getattr(opt, "train_profile", False) and rank == 0,
+            save_dir=self.save_dir,
+            device=self.device,
+            summary_every=getattr(opt, "train_profile_every", 100),
+        )
+        if self.isTrain and getattr(opt, "train_save_async", False) and rank == 0:
+            self.checkpoint_writer = CheckpointWriter(
+                max_pending=opt.train_save_async_max_pending
+            )
+        else:
+            self.checkpoint_writer = None
+        if self.isTrain and getattr(opt, "train_export_async", False) and rank == 0:
+            self.export_worker = ExportWorker(
+                os.path.join(self.save_dir, "train_config.json"), opt.jg_dir
+            )
+        else:
+            self.export_worker = None
         if (
-            opt.data_preprocess != "scale_width"
-        ):  # with [scale_width], input images might have different sizes, which hurts the performance of cudnn.benchmark.
+            opt.data_preprocess != "scale_width" or opt.data_bucket_by_shape
+        ):  # with [scale_width], input images might have different sizes, which hurts the performance of cudnn.benchmark, unless batches are bucketed by shape.
             torch.backends.cudnn.benchmark = True
             torch.backends.cudnn.deterministic = False
         self.loss_names = []
@@ -93,8 +146,36 @@ class BaseModel(ABC):
         self.fake_A_pool = ImagePool(opt.train_pool_size)
         self.real_B_pool = ImagePool(opt.train_pool_size)
 
+        if self.isTrain and opt.dataaug_batch_geometric:
+            batch_aug_kwargs = {
+                "flip": not opt.dataaug_no_flip,
+                "rotate": not opt.dataaug_no_rotate,
+                "affine": opt.dataaug_affine,
+                "translate": opt.dataaug_affine_translate,
+                "scale_min": opt.dataaug_affine_scale_min,
+                "scale_max": opt.dataaug_affine_scale_max,
+                "shear": opt.dataaug_affine_shear,
+            }
+            # images with masks are rotated by right angles, as in get_transform_seg
+            self.batch_geometric_aug_mask = BatchGeometricAug(
+                right_angles=True, **batch_aug_kwargs
+            )
+            self.batch_geometric_aug = BatchGeometricAug(
+                right_angles=False, **batch_aug_kwargs
+            )
+
+        if (
+            self.isTrain
+            and opt.dataaug_imgaug
+            and opt.dataaug_imgaug_backend == "batch"
+        ):
+            self.batch_photometric_aug = BatchPhotometricAug()
+
         if rank == 0 and (opt.train_compute_fid or opt.train_compute_fid_val):
-            self.transform = get_transform(opt, grayscale=(opt.model_input_nc == 1))
+            # real statistics are computed on images normalized to [-1, 1], as fake images
+            fid_opt = copy.copy(opt)
+            fid_opt.data_uint8 = False
+            self.transform = get_transform(fid_opt, grayscale=(opt.model_input_nc == 1))
             dims = 2048
             batch = 1
             self.netFid = base_networks.define_inception(self.gpu_ids[0], dims)
@@ -210,6 +291,7 @@ class BaseModel(ABC):
                 )
 
         self.niter = 0
+        self.networks_ema_to_load = {}
 
         self.objects_to_update = []
 
@@ -225,12 +307,7 @@ class BaseModel(ABC):
 
         self.margin = self.opt.data_online_context_pixels * 2
 
-        if "segformer" in self.opt.G_netG:
-            self.onnx_opset_version = 11
-        elif "ittr" in self.opt.G_netG:
-            self.onnx_opset_version = 12
-        else:
-            self.onnx_opset_version = 9
+        self.onnx_opset_version = get_onnx_opset_version(self.opt.G_netG)
 
     def init_semantic_cls(self, opt):
 
@@ -395,7 +472,12 @@ class BaseModel(ABC):
             input (dict): include the data itself and its metadata information.
         The option 'direction' can be used to swap domain A and domain B.
         """
-        self.real_A_with_context = data["A"].to(self.device)
+        if hasattr(self, "batch_geometric_aug"):
+            data = self.batch_geometric_augment(data)
+        if hasattr(self, "batch_photometric_aug"):
+            data = self.batch_photometric_augment(data)
+
+        self.real_A_with_context = self.input_to_device(data["A"])
         self.real_A = self.real_A_with_context.clone()
         if self.opt.data_online_context_pixels > 0:
             self.real_A = self.real_A[
@@ -409,7 +491,7 @@ class BaseModel(ABC):
                 self.real_A_with_context, size=self.real_A.shape[2:]
             )
 
-        self.real_B_with_context = data["B"].to(self.device)
+        self.real_B_with_context = self.input_to_device(data["B"])
 
         self.real_B = self.real_B_with_context.clone()
 
@@ -432,9 +514,77 @@ class BaseModel(ABC):
         if self.opt.train_semantic_cls:
             self.set_input_semantic_cls(data)
 
+    def input_to_device(self, imgs):
+        """Move input images to the device, uint8 images (--data_uint8) are normalized to [-1, 1] there."""
+        imgs = imgs.to(self.device)
+        if imgs.dtype == torch.uint8:
+            imgs = imgs.float().div_(127.5).sub_(1.0)
+        return imgs
+
+    def batch_geometric_augment(self, data):
+        """Apply random flip, rotation and affine transforms to the images and masks of a batch, on device.
+
+        Transforms are drawn per sample, and shared by the frames of nuplets and by A and B
+        images with aligned datasets.
+        """
+        data = dict(data)
+        params = None
+        for domain in ["A", "B"]:
+            imgs = data.get(domain)
+            if not torch.is_tensor(imgs) or imgs.dim() not in [4, 5]:
+                continue
+            # nuplets (B, n, C, H, W) are augmented as B * n images
+            imgs_shape = imgs.shape
+            nb_frames = imgs_shape[1] if imgs.dim() == 5 else 1
+            imgs = imgs.to(self.device).reshape(-1, *imgs_shape[-3:])
+            masks = data.get(domain + "_label_mask")
+            if torch.is_tensor(masks) and masks.dim() >= 3:
+                masks_shape = masks.shape
+                masks = masks.to(self.device).reshape(-1, *masks_shape[-2:])
+                batch_geometric_aug = self.batch_geometric_aug_mask
+            else:
+                masks = None
+                batch_geometric_aug = self.batch_geometric_aug
+            if self.opt.data_dataset_mode != "aligned":
+                params = None
+
+            imgs, masks, params = batch_geometric_aug(
+                imgs,
+                masks,
+                params,
+                fill=-1.0 if imgs.is_floating_point() else 0.0,
+                nb_frames=nb_frames,
+            )
+
+            data[domain] = imgs.reshape(imgs_shape)
+            if masks is not None:
+                data[domain + "_label_mask"] = masks.reshape(masks_shape)
+        return data
+
+    def batch_photometric_augment(self, data):
+        """Apply random image augmentation to the A and B images of a batch, on device.
+
+        The frames of nuplets get the same augmentation.
+        """
+        data = dict(data)
+        for domain in ["A", "B"]:
+            imgs = data.get(domain)
+            if not torch.is_tensor(imgs) or imgs.dim() not in [4, 5]:
+                continue
+            imgs_shape = imgs.shape
+            nb_frames = imgs_shape[1] if imgs.dim() == 5 else 1
+            imgs, _ = self.batch_photometric_aug(
+                imgs.to(self.device).reshape(-1, *imgs_shape[-3:]),
+                nb_frames=nb_frames,
+            )
+            data[domain] = imgs.reshape(imgs_shape)
+        return data
+
     def set_input_semantic_mask(self, data):
         if "A_label_mask" in data:
-            self.input_A_label_mask = data["A_label_mask"].to(self.device).squeeze(1)
+            self.input_A_label_mask = (
+                data["A_label_mask"].to(self.device).long().squeeze(1)
+            )
 
             if self.opt.data_online_context_pixels > 0:
                 self.input_A_label_mask = self.input_A_label_mask[
@@ -444,7 +594,9 @@ class BaseModel(ABC):
                 ]
 
         if "B_label_mask" in data:
-            self.input_B_label_mask = data["B_label_mask"].to(self.device).squeeze(1)
+            self.input_B_label_mask = (
+                data["B_label_mask"].to(self.device).long().squeeze(1)
+            )
 
             if self.opt.data_online_context_pixels > 0:
                 self.input_B_label_mask = self.input_B_label_mask[
@@ -471,8 +623,8 @@ class BaseModel(ABC):
 
     def set_input_temporal(self, data_temporal):
 
-        self.temporal_real_A_with_context = data_temporal["A"].to(self.device)
-        self.temporal_real_B_with_context = data_temporal["B"].to(self.device)
+        self.temporal_real_A_with_context = self.input_to_device(data_temporal["A"])
+        self.temporal_real_B_with_context = self.input_to_device(data_temporal["B"])
 
         if self.opt.data_online_context_pixels > 0:
 
@@ -765,9 +917,13 @@ class BaseModel(ABC):
     def save_networks(self, epoch):
         """Save all the networks to the disk.
 
+        With --train_save_async, the networks are written in the background, see util/checkpoint_writer.py
+        With --train_save_D_trainable_only, the pretrained frozen modules of discriminators are not saved.
+
         Parameters:
             epoch (int) -- current epoch; used in the file name '%s_net_%s.pth' % (epoch, name)
         """
+        state_dicts = {}
         for name in self.model_names:
             if isinstance(name, str):
                 save_filename = "%s_net_%s.pth" % (epoch, name)
@@ -775,13 +931,26 @@ class BaseModel(ABC):
                 net = getattr(self, "net" + name)
 
                 if len(self.gpu_ids) > 1 and self.use_cuda:
-                    torch.save(net.module.state_dict(), save_path)
+                    net = net.module
+
+                if self.opt.train_save_D_trainable_only and hasattr(
+                    net, "get_pretrained_modules"
+                ):
+                    state_dicts[save_path] = self.get_trainable_state_dict(net)
                 else:
-                    torch.save(net.state_dict(), save_path)
+                    state_dicts[save_path] = net.state_dict()
+
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.save(state_dicts, name=str(epoch))
+        else:
+            for save_path, state_dict in state_dicts.items():
+                torch.save(state_dict, save_path)
 
     def export_networks(self, epoch):
         """Export chosen networks weights to the disk.
 
+        With --train_export_async, the saved networks are exported by a separate process, see util/export_worker.py
+
         Parameters:
             epoch (int) -- current epoch; used in the file name '%s_net_%s.pth' % (epoch, name)
         """
@@ -790,37 +959,17 @@ class BaseModel(ABC):
                 save_filename = "%s_net_%s.pth" % (epoch, name)
                 save_path = os.path.join(self.save_dir, save_filename)
 
-                net = getattr(self, "net" + name)
-
-                input_nc = self.opt.model_input_nc
-                if self.opt.model_multimodal:
-                    input_nc += self.opt.train_mm_nz
-
-                dummy_input = torch.randn(
-                    1,
-                    input_nc,
-                    self.opt.data_crop_size,
-                    self.opt.data_crop_size,
-                    device=self.device,
-                )
-
-                # onnx
-                if not "ittr" in self.opt.G_netG and not "unet_mha" in self.opt.G_netG:
-                    export_path_onnx = save_path.replace(".pth", ".onnx")
-
-                    torch.onnx.export(
-                        net,
-                        dummy_input,
-                        export_path_onnx,
-                        verbose=False,
-                        opset_version=self.onnx_opset_version,
-                    )
+                if self.export_worker is not None:
+                    if self.checkpoint_writer is not None:
+                        self.checkpoint_writer.call_when_written(
+                            functools.partial(self.export_worker.export, save_path)
+                        )
+                    else:
+                        self.export_worker.export(save_path)
+                    continue
 
-                # jit
-                if self.opt.train_export_jit and not "segformer" in self.opt.G_netG:
-                    export_path_jit = save_path.replace(".pth", ".pt")
-                    jit_model = torch.jit.trace(net, dummy_input)
-                    jit_model.save(export_path_jit)
+                net = getattr(self, "net" + name)
+                export_network(net, self.opt, save_path)
 
     def __patch_instance_norm_state_dict(self, state_dict, module, keys, i=0):
         """Fix InstanceNorm checkpoints incompatibility (prior to 0.4)"""
@@ -846,6 +995,8 @@ class BaseModel(ABC):
         Parameters:
             epoch (int) -- current epoch; used in the file name '%s_net_%s.pth' % (epoch, name)
         """
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.wait()
         for name in self.model_names:
             if isinstance(name, str):
                 load_filename = "%s_net_%s.pth" % (epoch, name)
@@ -860,6 +1011,10 @@ class BaseModel(ABC):
                 # if you are using PyTorch newer than 0.4 (e.g., built from
                 # GitHub source), you can remove str() on self.device
                 state_dict = torch.load(load_path, map_location=str(self.device))
+                pretrained_modules = None
+                if "pretrained_modules" in state_dict:  # only trainable weights
+                    pretrained_modules = state_dict["pretrained_modules"]
+                    state_dict = state_dict["state_dict"]
                 if hasattr(state_dict, "_metadata"):
                     del state_dict._metadata
 
@@ -873,9 +1028,143 @@ class BaseModel(ABC):
 
                 if hasattr(state_dict, "g_ema"):
                     net.load_state_dict(state_dict["g_ema"])
+                elif pretrained_modules is not None:
+                    self.load_trainable_state_dict(net, state_dict, pretrained_modules)
                 else:
                     net.load_state_dict(state_dict)
 
+    def get_trainable_state_dict(self, net):
+        """Checkpoint of net without its pretrained frozen modules, which are rebuilt from their source when loading"""
+        pretrained_modules = net.get_pretrained_modules()
+        state_dict = net.state_dict()
+        trainable_state_dict = OrderedDict(
+            (key, value)
+            for key, value in state_dict.items()
+            if not any(key.startswith(prefix + ".") for prefix in pretrained_modules)
+        )
+        trainable_state_dict._metadata = state_dict._metadata
+        return {
+            "state_dict": trainable_state_dict,
+            "pretrained_modules": pretrained_modules,
+        }
+
+    def load_trainable_state_dict(self, net, state_dict, pretrained_modules):
+        """Load the trainable weights of net, its pretrained frozen modules keep the weights of their source"""
+        if net.get_pretrained_modules() != pretrained_modules:
+            warnings.warn(
+                "pretrained modules were saved from %s, and are now loaded from %s"
+                % (pretrained_modules, net.get_pretrained_modules())
+            )
+        missing_keys, unexpected_keys = net.load_state_dict(state_dict, strict=False)
+        missing_keys = [
+            key
+            for key in missing_keys
+            if not any(key.startswith(prefix + ".") for prefix in pretrained_modules)
+        ]
+        if len(missing_keys) > 0 or len(unexpected_keys) > 0:
+            raise RuntimeError(
+                "Error(s) in loading trainable weights for %s: missing keys %s, unexpected keys %s"
+                % (net.__class__.__name__, missing_keys, unexpected_keys)
+            )
+        for prefix, source in pretrained_modules.items():
+            print("%s re-attached from %s" % (prefix, source))
+
+    def save_training_state(self, epoch, train_state):
+        """Save the state of training besides the network weights, to resume training exactly.
+
+        The training state holds optimizers, schedulers, AMP scaler, iteration count,
+        image pools, APA probabilities, EMA networks and random number generators.
+
+        Parameters:
+            epoch (int) -- current epoch; used in the file name '%s_training_state.pth' % epoch
+            train_state (dict) -- state of the training loop, e.g. iterations and dataloader position
+        """
+        state = {
+            "train_state": train_state,
+            "niter": self.niter,
+            "optimizers": [optimizer.state_dict() for optimizer in self.optimizers],
+            "schedulers": [scheduler.state_dict() for scheduler in self.schedulers],
+            "image_pools": {
+                name: value.images
+                for name, value in vars(self).items()
+                if isinstance(value, ImagePool) and value.pool_size > 0
+            },
+            # adaptive pseudo augmentation probability of discriminator losses
+            "APA_p": [
+                getattr(cur_object, "adaptive_pseudo_augmentation_p", None)
+                for cur_object in self.objects_to_update
+            ],
+            "networks_ema": {},
+            "rng": {
+                "python": random.getstate(),
+                "numpy": get_numpy_rng_state(),
+                "torch": torch.get_rng_state(),
+            },
+        }
+        if self.use_cuda:
+            state["scaler"] = self.scaler.state_dict()
+            state["rng"]["cuda"] = torch.cuda.get_rng_state(self.device)
+        for name in self.model_names:
+            network_ema = getattr(self, "net" + name + "_ema", None)
+            if network_ema is not None:
+                state["networks_ema"][name] = unwrap_network(network_ema).state_dict()
+
+        save_path = os.path.join(self.save_dir, "%s_training_state.pth" % epoch)
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.save({save_path: state}, name="%s state" % epoch)
+        else:
+            torch.save(state, save_path)
+
+    def load_training_state(self, epoch):
+        """Load the training state saved at epoch, once networks are on their devices.
+
+        Parameters:
+            epoch (int) -- current epoch; used in the file name '%s_training_state.pth' % epoch
+
+        Returns the state of the training loop, None when no training state was saved.
+        """
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.wait()
+        load_path = os.path.join(self.save_dir, "%s_training_state.pth" % epoch)
+        if not os.path.isfile(load_path):
+            print("no training state at %s, only networks are resumed" % load_path)
+            return None
+        print("loading the training state from %s" % load_path)
+        state = torch.load(load_path, map_location="cpu")
+
+        if len(state["optimizers"]) != len(self.optimizers):
+            raise ValueError(
+                "training state at %s has %d optimizers, the model has %d"
+                % (load_path, len(state["optimizers"]), len(self.optimizers))
+            )
+        for optimizer, optimizer_state in zip(self.optimizers, state["optimizers"]):
+            optimizer.load_state_dict(optimizer_state)  # moved to parameters devices
+        for scheduler, scheduler_state in zip(self.schedulers, state["schedulers"]):
+            scheduler.load_state_dict(scheduler_state)
+        if self.use_cuda and "scaler" in state:
+            self.scaler.load_state_dict(state["scaler"])
+        self.niter = state["niter"]
+
+        for name, images in state["image_pools"].items():
+            pool = getattr(self, name)
+            pool.images = [image.to(self.device) for image in images]
+            pool.num_imgs = len(pool.images)
+        for cur_object, APA_p in zip(self.objects_to_update, state["APA_p"]):
+            if APA_p is not None:
+                if torch.is_tensor(APA_p):
+                    APA_p = APA_p.to(self.device)
+                cur_object.adaptive_pseudo_augmentation_p = APA_p
+        # EMA networks are created at their first update
+        self.networks_ema_to_load = state["networks_ema"]
+
+        random.setstate(state["rng"]["python"])
+        set_numpy_rng_state(state["rng"]["numpy"])
+        torch.set_rng_state(state["rng"]["torch"])
+        if self.use_cuda and "cuda" in state["rng"]:
+            torch.cuda.set_rng_state(state["rng"]["cuda"], self.device)
+
+        return state["train_state"]
+
     def print_networks(self, verbose):
         """Print the total number of parameters in the network and (if verbose) network architecture
 
@@ -987,6 +1276,10 @@ class BaseModel(ABC):
         if network_ema is None:
             setattr(self, "net" + network_name + "_ema", copy.deepcopy(network).eval())
             network_ema = getattr(self, "net" + network_name + "_ema")
+            if network_name in self.networks_ema_to_load:  # resumed training
+                unwrap_network(network_ema).load_state_dict(
+                    self.networks_ema_to_load.pop(network_name)
+                )
         # - update EMAs
         with torch.no_grad():
             for p_ema, p in zip(network_ema.parameters(), network.parameters()):
@@ -1009,34 +1302,41 @@ class BaseModel(ABC):
                 else:
                     self.set_requires_grad(getattr(self, "net" + network), False)
 
+            group_name = "+".join(group.networks_to_optimize)
+
             if not group.forward_functions is None:
                 with torch.cuda.amp.autocast(enabled=self.with_amp):
                     for forward in group.forward_functions:
-                        getattr(self, forward)()
+                        with self.profiler.span(group_name + " " + forward):
+                            getattr(self, forward)()
 
             for backward in group.backward_functions:
-                getattr(self, backward)()
+                with self.profiler.span(group_name + " " + backward):
+                    getattr(self, backward)()
 
             for loss in group.loss_backward:
-                if self.use_cuda:
-                    ll = (
-                        self.scaler.scale(getattr(self, loss))
-                        / self.opt.train_iter_size
-                    )
-                else:
-                    ll = getattr(self, loss) / self.opt.train_iter_size
-                ll.backward(retain_graph=True)
+                with self.profiler.span(group_name + " backward " + loss):
+                    if self.use_cuda:
+                        ll = (
+                            self.scaler.scale(getattr(self, loss))
+                            / self.opt.train_iter_size
+                        )
+                    else:
+                        ll = getattr(self, loss) / self.opt.train_iter_size
+                    ll.backward(retain_graph=True)
 
             loss_names = []
 
             for temp in group.loss_names_list:
                 loss_names += getattr(self, temp)
-            self.compute_step(group.optimizer, loss_names)
+            with self.profiler.span(group_name + " compute_step"):
+                self.compute_step(group.optimizer, loss_names)
 
             if self.opt.train_G_ema:
                 for network in self.model_names:
                     if network in group.networks_to_ema:
-                        self.ema_step(network)
+                        with self.profiler.span(group_name + " ema_step " + network):
+                            self.ema_step(network)
 
         for cur_object in self.objects_to_update:
             cur_object.update(self.niter)
@@ -262,6 +262,12 @@ class ProjectedDiscriminator(torch.nn.Module):
             **backbone_kwargs,
         )
 
+    def get_pretrained_modules(self):
+        """Frozen modules rebuilt with their pretrained weights, by state_dict prefix, with the source of their weights"""
+        return {
+            "freeze_feature_network.pretrained": self.freeze_feature_network.pretrained_source()
+        }
+
     def train(self, mode=True):
         self.freeze_feature_network = self.freeze_feature_network.train(False)
         self.discriminator = self.discriminator.train(mode)
@@ -385,6 +391,12 @@ class TemporalProjectedDiscriminator(torch.nn.Module):
             input_size=lstm_size, hidden_size=lstm_size, batch_first=True
         )
 
+    def get_pretrained_modules(self):
+        """Frozen modules rebuilt with their pretrained weights, by state_dict prefix, with the source of their weights"""
+        return {
+            "freeze_feature_network.pretrained": self.freeze_feature_network.pretrained_source()
+        }
+
     def train(self, mode=True):
         self.freeze_feature_network = self.freeze_feature_network.train(False)
         self.discriminator = self.discriminator.train(mode)
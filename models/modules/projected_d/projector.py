@@ -302,6 +302,8 @@ class Proj(nn.Module):
         **kwargs,
     ):
         super().__init__()
+        self.projector_model = projector_model
+        self.weight_path = weight_path
         self.proj_type = proj_type
         self.cout = cout
         self.expand = expand
@@ -324,6 +326,16 @@ class Proj(nn.Module):
         self.RESOLUTIONS = self.pretrained.RESOLUTIONS
         self.FEATS = self.pretrained.FEATS
 
+    def pretrained_source(self):
+        """Where the weights of the pretrained feature network are loaded from"""
+        projector_gen = projector_models[self.projector_model]
+        if projector_gen["create_model_function"] is create_segformer_model:
+            return "segformer backbone weights at %s" % self.weight_path
+        elif projector_gen["create_model_function"] is create_clip_model:
+            return "clip model %s" % projector_gen["model_name"]
+        else:
+            return "timm model %s" % projector_gen["model_name"]
+
     def forward(self, x):
         # predict feature maps
 
@@ -17,7 +17,12 @@ class VisionAidedDiscriminator(nn.Module):
             loss_type,
             device=torch.device("cuda" if torch.cuda.is_available() else "cpu"),
         )
+        self.cv_type = cv_type
         self.model.cv_ensemble.requires_grad_(False)  # freeze feature extractor
 
+    def get_pretrained_modules(self):
+        """Frozen modules rebuilt with their pretrained weights, by state_dict prefix, with the source of their weights"""
+        return {"model.cv_ensemble": "vision_aided_loss %s backbones" % self.cv_type}
+
     def forward(self, input):
         return self.model(input)[0]
@@ -59,7 +59,7 @@ class SegmentationModel(BaseModel):
 
     def set_input(self, input):
         AtoB = self.opt.direction == "AtoB"
-        self.real_A = input["A" if AtoB else "B"].to(self.device)
+        self.real_A = self.input_to_device(input["A" if AtoB else "B"])
         self.input_A_label = input["A_label"].to(self.device).squeeze(1)
 
     def forward(self):
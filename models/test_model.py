@@ -73,7 +73,7 @@ class TestModel(BaseModel):
 
         We need to use 'single_dataset' dataset mode. It only load images from one domain.
         """
-        self.real = input["A"].to(self.device)
+        self.real = self.input_to_device(input["A"])
         self.image_paths = input["A_paths"]
 
     def forward(self):
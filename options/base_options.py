@@ -494,6 +494,8 @@ class BaseOptions:
                 "unaligned_labeled_mask_online",
                 "self_supervised_labeled_mask_online",
                 "unaligned_labeled_mask_cls_online",
+                "unaligned_labeled_mask_online_bank",
+                "nuplet_unaligned_labeled_mask",
                 "aligned",
             ],
             help="chooses how datasets are loaded.",
@@ -513,6 +515,22 @@ class BaseOptions:
         parser.add_argument(
             "--data_num_threads", default=4, type=int, help="# threads for loading data"
         )
+        parser.add_argument(
+            "--data_prefetch_batches",
+            type=int,
+            default=0,
+            help="number of batches loaded ahead on a background thread and copied to the device on a side stream while the model computes, 0 to load them synchronously",
+        )
+        parser.add_argument(
+            "--data_bucket_by_shape",
+            action="store_true",
+            help="with --data_preprocess scale_width or none, draw each batch from samples of the same shape, so that batches can have more than one image and cudnn.benchmark stays on",
+        )
+        parser.add_argument(
+            "--data_resample_failures",
+            action="store_true",
+            help="replace samples that fail to load with other random samples in the dataloader workers, so that batches keep their size, failed samples are listed in failed_samples.txt in the checkpoints directory",
+        )
 
         parser.add_argument(
             "--data_load_size", type=int, default=286, help="scale images to this size"
@@ -625,6 +643,46 @@ class BaseOptions:
             default=0,
             help="context pixel band around the crop, unused for generation, only for disc ",
         )
+        parser.add_argument(
+            "--data_online_fast_decode",
+            action="store_true",
+            help="decode JPEG images at reduced resolution (DCT scaling) when crops are downscaled, and resample only the crop instead of the full image, crops are slightly different from the default full decode",
+        )
+        parser.add_argument(
+            "--data_temporal_video",
+            action="store_true",
+            help="if true, the paths.txt files of the temporal dataset list video files with their bbox files, and frames are read from the videos, see data/video_frames.py",
+        )
+        parser.add_argument(
+            "--data_temporal_frame_cache_size",
+            type=int,
+            default=0,
+            help="number of decoded frames kept in the LRU cache of each dataloader worker of the temporal dataset, so that overlapping windows of frames decode them once, 0 for no cache",
+        )
+        parser.add_argument(
+            "--data_online_creation_crops_per_image",
+            type=int,
+            default=1,
+            help="number of crops computed from each decoded image during online creation, crops are served to consecutive samples from a per-worker buffer",
+        )
+        parser.add_argument(
+            "--data_online_creation_bank_crops_per_bbox",
+            type=int,
+            default=4,
+            help="number of crops precomputed around each bbox for the crop bank of unaligned_labeled_mask_online_bank dataset mode",
+        )
+        parser.add_argument(
+            "--data_online_creation_bank_refresh_fraction",
+            type=float,
+            default=0.1,
+            help="fraction of the crop bank regenerated in the background every data_online_creation_bank_refresh_period seconds, 0 to never refresh the bank",
+        )
+        parser.add_argument(
+            "--data_online_creation_bank_refresh_period",
+            type=float,
+            default=300,
+            help="period in seconds of crop bank refreshes",
+        )
 
         parser.add_argument(
             "--data_sanitize_paths",
@@ -636,6 +694,21 @@ class BaseOptions:
             action="store_true",
             help="whether paths to images are relative to dataroot",
         )
+        parser.add_argument(
+            "--data_shards",
+            action="store_true",
+            help="if true, images and labels are read from the packed shards of each domain directory when available, see scripts/pack_path_dataset.py",
+        )
+        parser.add_argument(
+            "--data_paths_mmap",
+            action="store_true",
+            help="if true, dataset paths are stored in memory-mapped files in the checkpoints directory, shared by all ranks and dataloader workers instead of being copied to each of them",
+        )
+        parser.add_argument(
+            "--data_uint8",
+            action="store_true",
+            help="if true, datasets return uint8 images and masks, that are converted to float and normalized on the training device, masks must have less than 256 classes",
+        )
 
         self.initialized = True
         return parser
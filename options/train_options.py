@@ -114,6 +114,11 @@ class TrainOptions(BaseOptions):
             action="store_true",
             help="whether to export model in jit format",
         )
+        parser.add_argument(
+            "--train_export_async",
+            action="store_true",
+            help="export saved models from a separate process on CPU, so that training does not wait for the export",
+        )
 
         parser.add_argument(
             "--train_continue",
@@ -165,6 +170,38 @@ class TrainOptions(BaseOptions):
         )
         parser.add_argument("--train_compute_D_accuracy", action="store_true")
         parser.add_argument("--train_D_accuracy_every", type=int, default=1000)
+        parser.add_argument(
+            "--train_profile",
+            action="store_true",
+            help="record the time spent in each phase of training iterations, written as a chrome trace and summary tables in the checkpoints directory",
+        )
+        parser.add_argument(
+            "--train_profile_every",
+            type=int,
+            default=100,
+            help="number of iterations between profile summaries, with --train_profile",
+        )
+        parser.add_argument(
+            "--train_save_state",
+            action="store_true",
+            help="save the training state with the networks: optimizers, schedulers, image pools, EMA networks, random generators and dataloader position, so that --train_continue resumes training exactly, also in the middle of an epoch",
+        )
+        parser.add_argument(
+            "--train_save_D_trainable_only",
+            action="store_true",
+            help="save only the trainable weights of discriminators with pretrained frozen backbones (projected_d, temporal, vision_aided), backbones are rebuilt from their pretrained weights when loading",
+        )
+        parser.add_argument(
+            "--train_save_async",
+            action="store_true",
+            help="write checkpoints on a background thread, training only waits for the copy of the networks to CPU memory",
+        )
+        parser.add_argument(
+            "--train_save_async_max_pending",
+            type=int,
+            default=2,
+            help="maximum number of checkpoints held in memory until written, with --train_save_async",
+        )
         parser.add_argument(
             "--train_n_epochs",
             type=int,
@@ -470,11 +507,23 @@ class TrainOptions(BaseOptions):
             default=45,
             help="if random affine specified, shear range (0,value)",
         )
+        parser.add_argument(
+            "--dataaug_batch_geometric",
+            action="store_true",
+            help="if specified, flip, rotation and affine augmentations are applied to whole batches on the training device, instead of per image in dataloader workers",
+        )
         parser.add_argument(
             "--dataaug_imgaug",
             action="store_true",
             help="whether to apply random image augmentation",
         )
+        parser.add_argument(
+            "--dataaug_imgaug_backend",
+            type=str,
+            default="imgaug",
+            choices=["imgaug", "batch"],
+            help="random image augmentation implementation, imgaug applies it per image in dataloader workers, batch applies a vectorized version to whole batches on the training device",
+        )
         parser.add_argument(
             "--dataaug_diff_aug_policy",
             type=str,
@@ -0,0 +1,400 @@
+import os
+import sys
+import argparse
+import json
+import multiprocessing
+import shutil
+import tempfile
+import time
+import numpy as np
+import torch
+from PIL import Image, ImageFile
+
+jg_dir = os.path.join("/".join(os.path.abspath(__file__).split("/")[:-2]))
+sys.path.append(jg_dir)
+
+import data
+import data.online_creation
+from data import create_dataset, create_dataloader
+from options.train_options import TrainOptions
+from util.util import flatten_json
+
+parser = argparse.ArgumentParser(
+    description="Measures the throughput of the training dataloader, without a model, for a sweep of loader options"
+)
+parser.add_argument(
+    "--config-json",
+    default="",
+    help="training options, as given to train.py --config_json, default options otherwise",
+)
+parser.add_argument(
+    "--dataroot", default="", help="dataset, overrides the one of the config"
+)
+parser.add_argument(
+    "--dataset-mode", default="", help="--data_dataset_mode, overrides the config"
+)
+parser.add_argument(
+    "--synthetic",
+    action="store_true",
+    help="generate a synthetic dataset of --dataset-mode and benchmark it, so that no data is needed",
+)
+parser.add_argument(
+    "--synthetic-size", type=int, default=200, help="images per synthetic domain"
+)
+parser.add_argument(
+    "--synthetic-img-size",
+    type=int,
+    nargs=2,
+    default=[640, 480],
+    help="width and height of synthetic images",
+)
+parser.add_argument(
+    "--num-threads",
+    type=int,
+    nargs="+",
+    default=[0, 4],
+    help="values of --data_num_threads to benchmark",
+)
+parser.add_argument(
+    "--batch-sizes",
+    type=int,
+    nargs="+",
+    default=[1, 4],
+    help="values of --train_batch_size to benchmark",
+)
+parser.add_argument(
+    "--dataaug",
+    nargs="+",
+    default=["none"],
+    help="data augmentation settings to benchmark, each a comma separated list of option=value, e.g. dataaug_imgaug=true,dataaug_affine=0.5, or none",
+)
+parser.add_argument(
+    "--batches", type=int, default=20, help="measured batches per setting"
+)
+parser.add_argument(
+    "--warmup-batches",
+    type=int,
+    default=2,
+    help="batches loaded before measuring, e.g. while workers start",
+)
+parser.add_argument(
+    "--checkpoints-dir",
+    default="",
+    help="where dataset indexes are written, a temporary directory by default",
+)
+
+SYNTHETIC_MODES = [
+    "unaligned",
+    "unaligned_labeled_cls",
+    "unaligned_labeled_mask",
+    "unaligned_labeled_mask_cls",
+    "unaligned_labeled_mask_online",
+    "unaligned_labeled_mask_cls_online",
+    "unaligned_labeled_mask_online_bank",
+    "aligned",
+]
+
+
+def random_image(rng, width, height):
+    """Smooth random image, that compresses like a photo rather than like noise"""
+    small = rng.integers(0, 256, (height // 16 + 1, width // 16 + 1, 3), dtype=np.uint8)
+    img = Image.fromarray(small).resize((width, height), Image.BILINEAR)
+    noise = rng.integers(-8, 9, (height, width, 3))
+    return Image.fromarray(np.clip(np.array(img) + noise, 0, 255).astype(np.uint8))
+
+
+def generate_synthetic_dataset(root, dataset_mode, size, width, height, nclasses=2):
+    """Write a random dataset with the layout expected by dataset_mode to root, with relative paths."""
+    if dataset_mode not in SYNTHETIC_MODES:
+        raise ValueError(
+            "no synthetic dataset for %s, choose among %s"
+            % (dataset_mode, ", ".join(SYNTHETIC_MODES))
+        )
+    rng = np.random.default_rng(0)
+
+    if dataset_mode == "aligned":
+        os.makedirs(os.path.join(root, "train"), exist_ok=True)
+        for i in range(size):
+            AB = Image.new("RGB", (2 * width, height))
+            AB.paste(random_image(rng, width, height), (0, 0))
+            AB.paste(random_image(rng, width, height), (width, 0))
+            AB.save(os.path.join(root, "train", "%d.jpg" % i), quality=90)
+        return
+
+    for domain in ["trainA", "trainB"]:
+        lines = []
+        for i in range(size):
+            cls = i % nclasses
+            if dataset_mode == "unaligned_labeled_cls":
+                img_path = os.path.join(domain, str(cls), "%d.jpg" % i)
+            else:
+                img_path = os.path.join(domain, "img", "%d.jpg" % i)
+            os.makedirs(os.path.dirname(os.path.join(root, img_path)), exist_ok=True)
+            random_image(rng, width, height).save(
+                os.path.join(root, img_path), quality=90
+            )
+
+            if "online" in dataset_mode:
+                label_path = os.path.join(domain, "bbox", "%d.txt" % i)
+                os.makedirs(os.path.join(root, domain, "bbox"), exist_ok=True)
+                with open(os.path.join(root, label_path), "w") as f:
+                    for k in range(rng.integers(1, 4)):
+                        w, h = rng.integers(width // 16, width // 4, 2)
+                        x = rng.integers(0, width - w)
+                        y = rng.integers(0, height - h)
+                        f.write("%d %d %d %d %d\n" % (1, x, y, x + w, y + h))
+            elif "mask" in dataset_mode:
+                label_path = os.path.join(domain, "mask", "%d.png" % i)
+                os.makedirs(os.path.join(root, domain, "mask"), exist_ok=True)
+                mask = np.zeros((height, width), dtype=np.uint8)
+                w, h = rng.integers(width // 8, width // 2), rng.integers(
+                    height // 8, height // 2
+                )
+                x, y = rng.integers(0, width - w), rng.integers(0, height - h)
+                mask[y : y + h, x : x + w] = 1
+                Image.fromarray(mask).save(os.path.join(root, label_path))
+            else:
+                continue
+
+            if dataset_mode.endswith("_cls") or "_cls_" in dataset_mode:
+                lines.append("%s %d %s" % (img_path, cls, label_path))
+            else:
+                lines.append("%s %s" % (img_path, label_path))
+
+        if lines:
+            with open(os.path.join(root, domain, "paths.txt"), "w") as f:
+                f.write("\n".join(lines) + "\n")
+
+
+def parse_dataaug(setting):
+    """'name=value,...' to a dict of options, values are read as json when possible"""
+    options = {}
+    if setting == "none":
+        return options
+    for item in setting.split(","):
+        name, _, value = item.partition("=")
+        try:
+            options[name] = json.loads(value) if value else True
+        except ValueError:
+            options[name] = value
+    return options
+
+
+class StageTimes:
+    """Time spent in each loading stage, summed over the main process and the dataloader workers."""
+
+    stages = ["decode", "crop", "transform", "sample", "collate"]
+
+    def __init__(self):
+        # shared with forked workers
+        self.times = torch.zeros(len(self.stages), dtype=torch.float64).share_memory_()
+        self.counts = torch.zeros(len(self.stages), dtype=torch.int64).share_memory_()
+
+    def reset(self):
+        self.times.zero_()
+        self.counts.zero_()
+
+    def wrap(self, stage, fn):
+        stage_id = self.stages.index(stage)
+        times, counts = self.times, self.counts
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                times[stage_id] += time.perf_counter() - start
+                counts[stage_id] += 1
+
+        timed.__wrapped__ = fn
+        return timed
+
+    def snapshot(self):
+        """(total time, number of calls) of each stage"""
+        return {
+            stage: (float(self.times[i]), int(self.counts[i]))
+            for i, stage in enumerate(self.stages)
+        }
+
+
+def patch_function(module_prefix, fn, timed):
+    """Replace fn with timed in all the modules it was imported into"""
+    for name, module in list(sys.modules.items()):
+        if module is None or not name.startswith(module_prefix):
+            continue
+        for attr, value in list(vars(module).items()):
+            if value is fn:
+                setattr(module, attr, timed)
+
+
+def instrument(stage_times):
+    """Time image decoding and collation, and return the timed online crop functions"""
+    ImageFile.ImageFile.load = stage_times.wrap("decode", ImageFile.ImageFile.load)
+    data.collate_fn = stage_times.wrap("collate", data.collate_fn)
+    return {
+        fn: stage_times.wrap("crop", fn)
+        for fn in [data.online_creation.crop_image, data.online_creation.crop_images]
+    }
+
+
+def instrument_dataset(dataset, stage_times, crop_fns):
+    """Time the online crops, transforms and samples of a dataset"""
+    # dataset modules are imported when the dataset is created
+    for fn, timed in crop_fns.items():
+        patch_function("data", fn, timed)
+    for attr, value in list(vars(dataset).items()):
+        if attr.startswith("transform") and callable(value):
+            setattr(dataset, attr, stage_times.wrap("transform", value))
+    dataset_class = type(dataset)
+    if not hasattr(dataset_class.__getitem__, "__wrapped__"):
+        dataset_class.__getitem__ = stage_times.wrap(
+            "sample", dataset_class.__getitem__
+        )
+
+
+def get_rss():
+    """Resident memory of this process and of its children (dataloader workers), in bytes, None if unavailable.
+
+    Pages shared between processes are counted once per process.
+    """
+    pids = [os.getpid()] + [child.pid for child in multiprocessing.active_children()]
+    rss = 0
+    for pid in pids:
+        try:
+            with open("/proc/%d/status" % pid) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1]) * 1024
+        except OSError:
+            return None
+    return rss
+
+
+def benchmark(opt, stage_times, crop_fns, nb_batches, nb_warmup_batches):
+    dataset = create_dataset(opt)
+    instrument_dataset(dataset, stage_times, crop_fns)
+    dataloader = create_dataloader(opt, 0, dataset)
+
+    def batches():
+        while True:  # go through the dataset as many times as needed
+            for batch in dataloader:
+                yield batch
+
+    it = batches()
+    for i in range(nb_warmup_batches):
+        next(it)
+    stage_times.reset()
+    start = time.perf_counter()
+    nb_samples = 0
+    for i in range(nb_batches):
+        batch = next(it)
+        nb_samples += len(batch["A"])
+    elapsed = time.perf_counter() - start
+    # before workers load the next batches
+    stats = stage_times.snapshot()
+    rss = get_rss()
+    it.close()
+    return nb_samples, elapsed, stats, rss
+
+
+def main(args):
+    if args.config_json:
+        with open(args.config_json, "r") as f:
+            train_json = flatten_json(json.load(f))
+    else:
+        train_json = {}
+    if args.dataset_mode:
+        train_json["data_dataset_mode"] = args.dataset_mode
+    train_json.setdefault("data_dataset_mode", "unaligned")
+
+    checkpoints_dir = args.checkpoints_dir or tempfile.mkdtemp(
+        prefix="benchmark_dataloader_"
+    )
+    train_json["checkpoints_dir"] = checkpoints_dir
+    train_json.setdefault("name", "benchmark_dataloader")
+    train_json["gpu_ids"] = "-1"
+
+    if args.synthetic:
+        dataroot = os.path.join(checkpoints_dir, "synthetic_data")
+        width, height = args.synthetic_img_size
+        print("generating a synthetic dataset at", dataroot)
+        generate_synthetic_dataset(
+            dataroot,
+            train_json["data_dataset_mode"],
+            args.synthetic_size,
+            width,
+            height,
+        )
+        train_json["dataroot"] = dataroot
+        train_json["data_relative_paths"] = True
+    elif args.dataroot:
+        train_json["dataroot"] = args.dataroot
+    if "dataroot" not in train_json:
+        raise ValueError("no dataset, use --dataroot, --config-json or --synthetic")
+
+    stage_times = StageTimes()
+    crop_fns = instrument(stage_times)
+
+    print(
+        "%-8s %6s %-30s %10s %10s %10s %10s %10s %10s %7s %9s"
+        % (
+            "threads",
+            "batch",
+            "dataaug",
+            "samples/s",
+            "decode",
+            "crop",
+            "transform",
+            "sample",
+            "collate",
+            "util",
+            "rss",
+        )
+    )
+    for dataaug in args.dataaug:
+        for batch_size in args.batch_sizes:
+            for num_threads in args.num_threads:
+                options = dict(train_json)
+                options.update(parse_dataaug(dataaug))
+                options["train_batch_size"] = batch_size
+                options["data_num_threads"] = num_threads
+                opt = TrainOptions().parse_json(options)
+                opt.use_cuda = False
+                os.makedirs(os.path.join(opt.checkpoints_dir, opt.name), exist_ok=True)
+
+                nb_samples, elapsed, stats, rss = benchmark(
+                    opt, stage_times, crop_fns, args.batches, args.warmup_batches
+                )
+
+                def per_call(stage):
+                    total, count = stats[stage]
+                    return "%8.1fms" % (1000 * total / count) if count else "%10s" % "-"
+
+                busy = stats["sample"][0] + stats["collate"][0]
+                print(
+                    "%-8d %6d %-30s %10.1f %10s %10s %10s %10s %10s %6.0f%% %9s"
+                    % (
+                        num_threads,
+                        batch_size,
+                        dataaug[:30],
+                        nb_samples / elapsed,
+                        per_call("decode"),
+                        per_call("crop"),
+                        per_call("transform"),
+                        per_call("sample"),
+                        per_call("collate"),
+                        100 * busy / (max(1, num_threads) * elapsed),
+                        "%.0fMB" % (rss / 2**20) if rss is not None else "-",
+                    )
+                )
+
+    print(
+        "stage times are per call, summed over workers; crop includes the decoding of the cropped image,"
+        " sample includes all stages but collate; util is the busy time of the workers over their wall time"
+    )
+    if not args.checkpoints_dir:
+        shutil.rmtree(checkpoints_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -0,0 +1,67 @@
+import os
+import sys
+import argparse
+import time
+import numpy as np
+import torch
+from PIL import Image
+
+jg_dir = os.path.join("/".join(os.path.abspath(__file__).split("/")[:-2]))
+sys.path.append(jg_dir)
+
+from data.base_dataset import RandomImgAug
+from util.batch_aug import BatchPhotometricAug
+
+parser = argparse.ArgumentParser(
+    description="Compares the speed of the imgaug and batch backends of --dataaug_imgaug"
+)
+parser.add_argument("--img-size", type=int, default=256, help="image size")
+parser.add_argument("--batch-size", type=int, default=16, help="batch size")
+parser.add_argument(
+    "--iterations", type=int, default=20, help="number of batches to augment"
+)
+parser.add_argument(
+    "--device", default="cpu", help="device of the batch backend, e.g. cuda"
+)
+args = parser.parse_args()
+
+rng = np.random.default_rng(0)
+imgs = [
+    Image.fromarray(
+        rng.integers(0, 256, (args.img_size, args.img_size, 3), dtype=np.uint8)
+    )
+    for i in range(args.batch_size)
+]
+batch = (
+    torch.from_numpy(np.stack([np.array(img) for img in imgs]))
+    .permute(0, 3, 1, 2)
+    .float()
+    .div(127.5)
+    .sub(1)
+    .to(args.device)
+)
+
+imgaug = RandomImgAug(with_mask=False)
+start = time.perf_counter()
+for i in range(args.iterations):
+    for img in imgs:
+        imgaug(img, None)
+imgaug_time = (time.perf_counter() - start) / args.iterations
+
+batch_aug = BatchPhotometricAug()
+batch_aug(batch)  # warmup
+if batch.is_cuda:
+    torch.cuda.synchronize()
+start = time.perf_counter()
+for i in range(args.iterations):
+    batch_aug(batch)
+if batch.is_cuda:
+    torch.cuda.synchronize()
+batch_time = (time.perf_counter() - start) / args.iterations
+
+print(
+    "batch of %d images of size %d" % (args.batch_size, args.img_size),
+)
+print("imgaug (per image, cpu): %.1f ms per batch" % (imgaug_time * 1000))
+print("batch (%s): %.1f ms per batch" % (args.device, batch_time * 1000))
+print("speedup: %.1fx" % (imgaug_time / batch_time))
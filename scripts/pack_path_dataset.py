@@ -0,0 +1,78 @@
+import os
+import sys
+import argparse
+import tqdm
+
+jg_dir = os.path.join("/".join(os.path.abspath(__file__).split("/")[:-2]))
+sys.path.append(jg_dir)
+
+from data.image_folder import make_dataset
+from data.packed_shards import ShardWriter, shard_key, SHARDS_DIRNAME
+
+parser = argparse.ArgumentParser(
+    description="Packs the images and labels of a domain into shards, to be used with --data_shards"
+)
+parser.add_argument("--dataroot", help="dataset root directory", required=True)
+parser.add_argument(
+    "--domain-dir",
+    help="domain dir to pack, one-level inside dataroot, e.g. trainA",
+    required=True,
+)
+parser.add_argument(
+    "--paths-file",
+    default="paths.txt",
+    help="paths file inside domain dir, the whole domain dir is packed if it does not exist",
+)
+parser.add_argument(
+    "--relative-paths",
+    action="store_true",
+    help="whether paths in paths file are relative to dataroot",
+)
+parser.add_argument(
+    "--shard-size", type=int, default=1024, help="maximum shard size in MB"
+)
+args = parser.parse_args()
+
+domain_dir = os.path.join(args.dataroot, args.domain_dir)
+shard_dir = os.path.join(domain_dir, SHARDS_DIRNAME)
+path_file = os.path.join(domain_dir, args.paths_file)
+
+
+def full_path(path):
+    if args.relative_paths:
+        return os.path.join(args.dataroot, path)
+    return path
+
+
+nb_failed = 0
+with ShardWriter(shard_dir, args.shard_size * 1024 * 1024) as writer:
+    if os.path.isfile(path_file):
+        with open(path_file, "r") as fp:
+            for line in tqdm.tqdm(fp):
+                elts = line.split()
+                if len(elts) == 0:
+                    continue
+                # first element is the image, the others are labels:
+                # bbox files, mask files, or class values that are not packed
+                for i, elt in enumerate(elts):
+                    cur_path = full_path(elt)
+                    if i > 0 and not os.path.isfile(cur_path):
+                        continue
+                    try:
+                        writer.add_file(shard_key(cur_path, args.dataroot), cur_path)
+                    except:
+                        print("failed packing file ", cur_path)
+                        nb_failed += 1
+    else:
+        print("no paths file found, packing all images in ", domain_dir)
+        for cur_path in tqdm.tqdm(make_dataset(domain_dir)):
+            try:
+                writer.add_file(shard_key(cur_path, args.dataroot), cur_path)
+            except:
+                print("failed packing file ", cur_path)
+                nb_failed += 1
+
+print(
+    "%d files packed into %d shards in %s, %d failures"
+    % (len(writer.keys), writer.cur_shard + 1, shard_dir, nb_failed)
+)
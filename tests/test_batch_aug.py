@@ -0,0 +1,72 @@
+import sys
+from types import SimpleNamespace
+
+import torch
+
+sys.path.append(sys.path[0] + "/..")
+from models.base_model import BaseModel
+from util.batch_aug import BatchGeometricAug, BatchPhotometricAug
+
+
+def get_model(dataset_mode="nuplet_unaligned_labeled_mask"):
+    return SimpleNamespace(
+        opt=SimpleNamespace(data_dataset_mode=dataset_mode),
+        device=torch.device("cpu"),
+        batch_geometric_aug=BatchGeometricAug(right_angles=False, affine=0.5),
+        batch_geometric_aug_mask=BatchGeometricAug(affine=0.5),
+        batch_photometric_aug=BatchPhotometricAug(max_ops=5),
+    )
+
+
+def get_nuplet_batch(batch_size=8, nb_frames=3, size=32):
+    """Nuplet batch whose frames are all identical within a sample."""
+    imgs = torch.rand(batch_size, 1, 3, size, size) * 2 - 1
+    masks = torch.randint(0, 4, (batch_size, 1, 1, size, size))
+    return {
+        "A": imgs.repeat(1, nb_frames, 1, 1, 1),
+        "A_label_mask": masks.repeat(1, nb_frames, 1, 1, 1),
+        "B": imgs.repeat(1, nb_frames, 1, 1, 1).clone(),
+    }
+
+
+def check_frames_equal(tensor):
+    for i in range(1, tensor.shape[1]):
+        assert torch.equal(tensor[:, 0], tensor[:, i])
+
+
+def test_batch_geometric_augment_nuplet():
+    torch.manual_seed(0)
+    model = get_model()
+    data = get_nuplet_batch()
+    out = BaseModel.batch_geometric_augment(model, data)
+
+    for key in ["A", "A_label_mask", "B"]:
+        assert out[key].shape == data[key].shape
+        check_frames_equal(out[key])
+    # the batch is augmented, with transforms that differ across samples
+    assert not torch.equal(out["A"], data["A"])
+    assert not torch.equal(out["B"], data["B"])
+
+
+def test_batch_photometric_augment_nuplet():
+    torch.manual_seed(0)
+    model = get_model()
+    data = get_nuplet_batch()
+    out = BaseModel.batch_photometric_augment(model, data)
+
+    for key in ["A", "B"]:
+        assert out[key].shape == data[key].shape
+        check_frames_equal(out[key])
+    assert not torch.equal(out["A"], data["A"])
+
+
+def test_batch_augment_images():
+    torch.manual_seed(0)
+    model = get_model("unaligned")
+    imgs = torch.rand(4, 3, 32, 32) * 2 - 1
+    data = {"A": imgs, "B": imgs.clone()}
+    out = BaseModel.batch_photometric_augment(
+        model, BaseModel.batch_geometric_augment(model, data)
+    )
+    assert out["A"].shape == imgs.shape
+    assert out["B"].shape == imgs.shape
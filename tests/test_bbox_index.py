@@ -0,0 +1,151 @@
+import os
+import random
+import sys
+
+import numpy as np
+
+sys.path.append(sys.path[0] + "/..")
+from data.online_creation import BBoxIndex, load_bbox_index, rasterize_mask
+from data.path_store import PathStore
+
+
+def write_bboxes(root, nb_files):
+    """Write random bbox files, return their paths relative to root and their bboxes"""
+    rng = random.Random(0)
+    os.makedirs(os.path.join(root, "trainA", "bbox"))
+    paths = []
+    bboxes = []
+    for i in range(nb_files):
+        path = os.path.join("trainA", "bbox", "%d.txt" % i)
+        file_bboxes = []
+        for j in range(rng.randint(1, 4)):
+            xmin, ymin = rng.randint(0, 200), rng.randint(0, 200)
+            file_bboxes.append(
+                [
+                    rng.randint(1, 3),
+                    xmin,
+                    ymin,
+                    xmin + rng.randint(1, 50),
+                    ymin + rng.randint(1, 50),
+                ]
+            )
+        with open(os.path.join(root, path), "w") as f:
+            for bbox in file_bboxes:
+                f.write(" ".join(str(elt) for elt in bbox) + "\n")
+        paths.append(path)
+        bboxes.append(np.array(file_bboxes))
+    return paths, bboxes
+
+
+def test_bbox_index_round_trip(tmp_path):
+    root = str(tmp_path)
+    paths, bboxes = write_bboxes(root, 20)
+
+    index = BBoxIndex.build(paths + [None], root=root, relative_paths=True)
+    assert len(index) == len(paths)
+    for path, file_bboxes in zip(paths, bboxes):
+        assert np.array_equal(index.get(path), file_bboxes)
+        # absolute paths below root are found as well
+        assert np.array_equal(index.get(os.path.join(root, path)), file_bboxes)
+    assert index.get("trainA/bbox/missing.txt") is None
+    assert index.get(None) is None
+
+    index_path = os.path.join(root, "checkpoints", "bbox_index_train_A.npz")
+    index = load_bbox_index(index_path, paths, root=root, relative_paths=True)
+    assert os.path.isfile(index_path)
+    loaded = BBoxIndex.load(index_path, root=root)
+    for path, file_bboxes in zip(paths, bboxes):
+        assert np.array_equal(loaded.get(path), file_bboxes)
+
+    # the index is built again when the files or the category change
+    index = load_bbox_index(index_path, paths[:5], root=root, relative_paths=True)
+    assert len(index) == 5
+    index = load_bbox_index(
+        index_path, paths, select_cat=1, root=root, relative_paths=True
+    )
+    for path, file_bboxes in zip(paths, bboxes):
+        assert np.array_equal(index.get(path), file_bboxes[file_bboxes[:, 0] == 1])
+
+
+def test_load_bbox_index_signatures(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    paths, bboxes = write_bboxes(root, 10)
+    # unparsable files are indexed as failed
+    with open(os.path.join(root, "trainA", "bbox", "invalid.txt"), "w") as f:
+        f.write("1 2 3\n")
+    paths.append(os.path.join("trainA", "bbox", "invalid.txt"))
+    # missing files as well
+    paths.append(os.path.join("trainA", "bbox", "missing.txt"))
+
+    index_path = os.path.join(root, "checkpoints", "bbox_index_train_A.npz")
+    index = load_bbox_index(index_path, paths, root=root, relative_paths=True)
+    assert len(index) == len(paths)
+    assert index.failed.tolist() == [False] * 10 + [True, True]
+    assert index.get(paths[-2]) is None
+    assert index.get(paths[-1]) is None
+
+    def build(*args, **kwargs):
+        raise AssertionError("the bbox index should not be rebuilt")
+
+    # the saved index is reused, failed files included
+    with monkeypatch.context() as m:
+        m.setattr(BBoxIndex, "build", build)
+        index = load_bbox_index(index_path, paths, root=root, relative_paths=True)
+    assert isinstance(index.paths, PathStore)
+    assert list(index.paths) == paths
+    for path, file_bboxes in zip(paths, bboxes):
+        assert np.array_equal(index.get(path), file_bboxes)
+
+    # modified files are parsed again
+    modified = os.path.join(root, paths[0])
+    with open(modified, "w") as f:
+        f.write("2 10 10 20 20\n")
+    stat = os.stat(modified)
+    os.utime(modified, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    index = load_bbox_index(index_path, paths, root=root, relative_paths=True)
+    assert np.array_equal(index.get(paths[0]), [[2, 10, 10, 20, 20]])
+    for path, file_bboxes in zip(paths[1:], bboxes[1:]):
+        assert np.array_equal(index.get(path), file_bboxes)
+
+
+def full_image_mask(bboxes, img_height, img_width):
+    """Mask of the whole image, as computed before masks were rasterized within the crop only"""
+    mask = np.zeros((img_height, img_width), dtype=np.uint8)
+    for cat, xmin, ymin, xmax, ymax in bboxes:
+        xmin = max(0, xmin)
+        ymin = max(0, ymin)
+        xmax = min(xmax, img_width)
+        ymax = min(ymax, img_height)
+        mask[ymin:ymax, xmin:xmax] = np.full((ymax - ymin, xmax - xmin), cat)
+    return mask
+
+
+def test_rasterize_mask():
+    rng = random.Random(0)
+    img_height, img_width = 120, 160
+    for i in range(200):
+        # overlapping bboxes, some of them crossing the image borders
+        bboxes = []
+        for j in range(rng.randint(1, 5)):
+            xmin = rng.randint(-20, img_width - 1)
+            ymin = rng.randint(-20, img_height - 1)
+            bboxes.append(
+                [
+                    rng.randint(1, 4),
+                    xmin,
+                    ymin,
+                    rng.randint(max(0, xmin + 1), img_width + 20),
+                    rng.randint(max(0, ymin + 1), img_height + 20),
+                ]
+            )
+        x_start = rng.randint(0, img_width - 1)
+        y_start = rng.randint(0, img_height - 1)
+        x_end = rng.randint(x_start + 1, img_width)
+        y_end = rng.randint(y_start + 1, img_height)
+
+        mask = rasterize_mask(bboxes, y_start, y_end, x_start, x_end)
+        expected = full_image_mask(bboxes, img_height, img_width)[
+            y_start:y_end, x_start:x_end
+        ]
+        assert mask.dtype == np.uint8
+        assert np.array_equal(mask, expected)
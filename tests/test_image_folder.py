@@ -0,0 +1,77 @@
+import glob
+import os
+import sys
+
+sys.path.append(sys.path[0] + "/..")
+from data.image_folder import (
+    get_listing_cache_path,
+    is_image_file,
+    make_dataset,
+    make_labeled_dataset,
+)
+
+
+def write_tree(root):
+    files = [
+        "root.png",
+        "cat/0.png",
+        "cat/1.jpg",
+        "cat/.hidden.png",
+        "cat/notes.txt",
+        "cat/nested/2.png",
+        "dog/3.png",
+        "bird/4.jpeg",
+        ".hidden_class/5.png",
+        "empty/readme.txt",
+    ]
+    for path in files:
+        path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, "w").close()
+
+
+def glob_labeled_dataset(dir):
+    """Class ids as listed by make_labeled_dataset before directory listings were cached"""
+    images = []
+    labels = []
+    alllabels = {}
+    for img in glob.glob(dir + "/*/*.*"):
+        if is_image_file(img):
+            images.append(img)
+            label = os.path.basename(os.path.dirname(img))
+            labels.append(alllabels.setdefault(label, len(alllabels)))
+    return images, labels
+
+
+def test_make_labeled_dataset(tmp_path):
+    root = str(tmp_path / "trainA")
+    cache_dir = str(tmp_path / "checkpoints")
+    write_tree(root)
+
+    expected = dict(zip(*glob_labeled_dataset(root)))
+    for i in range(2):
+        images, labels = make_labeled_dataset(root, cache_dir=cache_dir)
+        assert dict(zip(images, labels)) == expected
+        assert len(images) == len(expected)
+    assert os.path.isfile(get_listing_cache_path(cache_dir, root))
+
+    # no cache
+    images, labels = make_labeled_dataset(root, cache_dir=None)
+    assert dict(zip(images, labels)) == expected
+
+
+def test_make_dataset_cache(tmp_path):
+    root = str(tmp_path / "trainA")
+    cache_dir = str(tmp_path / "checkpoints")
+    write_tree(root)
+
+    images = sorted(make_dataset(root, cache_dir=cache_dir))
+    assert len(images) == 8
+    assert os.path.isfile(get_listing_cache_path(cache_dir, root))
+    assert not any(name.startswith("listing") for name in os.listdir(root))
+
+    # new files are listed with a cache
+    open(os.path.join(root, "dog", "6.png"), "w").close()
+    assert sorted(make_dataset(root, cache_dir=cache_dir)) == sorted(
+        images + [os.path.join(root, "dog", "6.png")]
+    )
@@ -0,0 +1,72 @@
+import os
+import pickle
+import sys
+
+sys.path.append(sys.path[0] + "/..")
+import data.packed_shards as packed_shards
+from data.packed_shards import ShardReader, ShardWriter, open_text
+
+
+def write_shards(shard_dir, records, shard_size=1 << 30):
+    with ShardWriter(shard_dir, shard_size=shard_size) as writer:
+        for key, data in records.items():
+            writer.add(key, data)
+
+
+def test_shards_round_trip(tmp_path):
+    records_A = {"trainA/img/%d.png" % i: os.urandom(50 + i) for i in range(30)}
+    records_B = {"trainB/bbox/%d.txt" % i: b"1 10 10 20 20\n" for i in range(10)}
+    # small shards, so that records are spread over several shard files
+    write_shards(str(tmp_path / "trainA" / "shards"), records_A, shard_size=200)
+    write_shards(str(tmp_path / "trainB" / "shards"), records_B)
+    assert len(os.listdir(tmp_path / "trainA" / "shards")) > 2
+
+    shards = ShardReader(
+        [
+            str(tmp_path / "trainA" / "shards"),
+            str(tmp_path / "trainB" / "shards"),
+            str(tmp_path / "trainC" / "shards"),
+        ],
+        root=str(tmp_path),
+    )
+    assert len(shards) == len(records_A) + len(records_B)
+    for key, data in {**records_A, **records_B}.items():
+        assert key in shards
+        assert shards.get(key) == data
+        # absolute paths below root are found as well
+        assert shards.get(str(tmp_path / key)) == data
+    assert shards.get("trainA/img/missing.png") is None
+    assert "trainA/img/missing.png" not in shards
+
+    with open_text("trainB/bbox/0.txt", shards) as f:
+        assert f.read() == "1 10 10 20 20\n"
+
+    # file handles are not pickled, and are reopened by the copy
+    shards_copy = pickle.loads(pickle.dumps(shards))
+    assert shards_copy.get("trainA/img/3.png") == records_A["trainA/img/3.png"]
+
+
+def test_shards_duplicate_keys(tmp_path):
+    with ShardWriter(str(tmp_path)) as writer:
+        writer.add("a.png", b"first")
+        writer.add("a.png", b"second")
+    shards = ShardReader([str(tmp_path)])
+    assert len(shards) == 1
+    assert shards.get("a.png") == b"first"
+
+
+def test_shards_hash_collisions(tmp_path, monkeypatch):
+    # all keys share the same hash, records are told apart by their keys
+    monkeypatch.setattr(packed_shards, "key_hash", lambda key: 7)
+    records = {"img_%d.png" % i: bytes([i]) for i in range(5)}
+    write_shards(str(tmp_path), records)
+    shards = ShardReader([str(tmp_path)])
+    for key, data in records.items():
+        assert shards.get(key) == data
+    assert shards.get("img_5.png") is None
+
+
+def test_shards_empty(tmp_path):
+    shards = ShardReader([str(tmp_path / "missing")])
+    assert len(shards) == 0
+    assert shards.get("a.png") is None
@@ -0,0 +1,47 @@
+import pickle
+import sys
+
+sys.path.append(sys.path[0] + "/..")
+from data.path_store import PathStore
+
+paths = ["trainA/img/%d.png" % i for i in range(20)] + [
+    "trainA/img/é.png",
+    "trainA/img/with space.png",
+    "",
+]
+
+
+def test_path_store_from_list():
+    store = PathStore.from_list(paths)
+    assert len(store) == len(paths)
+    assert list(store) == paths
+    assert [store[i] for i in range(len(paths))] == paths
+    assert store[-1] == paths[-1]
+    assert store[2:5] == paths[2:5]
+
+
+def test_path_store_pickle():
+    store = PathStore.from_list(paths)
+    store_copy = pickle.loads(pickle.dumps(store))
+    assert list(store_copy) == paths
+
+
+def test_path_store_save(tmp_path):
+    prefix = str(tmp_path / "stores" / "A_img_paths")
+    store = PathStore.from_list(paths).save(prefix)
+    assert store.prefix == prefix
+    assert list(store) == paths
+    assert list(PathStore.load(prefix)) == paths
+
+    # memory-mapped stores are pickled as their prefix only
+    data = pickle.dumps(store)
+    assert len(data) < len("".join(paths))
+    assert list(pickle.loads(data)) == paths
+
+
+def test_path_store_concatenate():
+    store = PathStore.concatenate(
+        [PathStore.from_list(paths[:5]), PathStore.from_list(paths[5:])]
+    )
+    assert list(store) == paths
+    assert len(PathStore.concatenate([])) == 0
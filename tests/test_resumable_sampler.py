@@ -0,0 +1,97 @@
+import sys
+
+import numpy as np
+import torch
+import torch.utils.data as data
+
+sys.path.append(sys.path[0] + "/..")
+from data.bucket_sampler import BucketBatchSampler
+from data.resumable_sampler import ResumableBatchSampler
+
+
+def make_sampler(dataset_size, batch_size, seed):
+    generator = torch.Generator()
+    sampler = data.RandomSampler(range(dataset_size), generator=generator)
+    return ResumableBatchSampler(
+        data.BatchSampler(sampler, batch_size=batch_size, drop_last=False),
+        generator=generator,
+        seed=seed,
+    )
+
+
+def test_resume_mid_epoch():
+    batch_sampler = make_sampler(23, 4, seed=42)
+    passes = []
+    for epoch in range(3):
+        batch_sampler.set_epoch(epoch)
+        passes.append(list(batch_sampler))
+    # each pass is shuffled differently, with the same samples
+    assert passes[0] != passes[1]
+    assert sorted(sum(passes[1], [])) == list(range(23))
+
+    for epoch in range(3):
+        for start_batch in [0, 1, 3, len(passes[epoch]) - 1]:
+            # a new sampler, e.g. after a restart, with the saved seed
+            resumed = make_sampler(23, 4, seed=42)
+            resumed.start_batch = start_batch
+            resumed.set_epoch(epoch)
+            assert len(resumed) == len(passes[epoch]) - start_batch
+            assert list(resumed) == passes[epoch][start_batch:]
+            # the next pass goes through the whole dataset
+            if epoch + 1 < len(passes):
+                resumed.set_epoch(epoch + 1)
+                assert len(resumed) == len(passes[epoch + 1])
+                assert list(resumed) == passes[epoch + 1]
+
+
+def test_resume_serial_batches():
+    batch_sampler = ResumableBatchSampler(
+        data.BatchSampler(data.SequentialSampler(range(10)), 3, drop_last=False)
+    )
+    batch_sampler.start_batch = 2
+    batch_sampler.set_epoch(0)
+    assert list(batch_sampler) == [[6, 7, 8], [9]]
+    batch_sampler.set_epoch(1)
+    assert list(batch_sampler) == [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+
+
+def test_distributed_sampler_epochs():
+    sampler = data.distributed.DistributedSampler(
+        range(40), num_replicas=2, rank=0, shuffle=True, seed=0
+    )
+    batch_sampler = ResumableBatchSampler(
+        data.BatchSampler(sampler, batch_size=4, drop_last=False)
+    )
+    batch_sampler.set_epoch(0)
+    pass_0 = list(batch_sampler)
+    batch_sampler.set_epoch(1)
+    pass_1 = list(batch_sampler)
+    # DistributedSampler is reshuffled at each epoch
+    assert pass_0 != pass_1
+
+    batch_sampler.start_batch = 2
+    batch_sampler.set_epoch(1)
+    assert list(batch_sampler) == pass_1[2:]
+
+
+def test_bucket_sampler_seed():
+    bucket_ids = np.arange(40) % 3
+
+    def make_bucket_sampler(seed):
+        return ResumableBatchSampler(
+            BucketBatchSampler(bucket_ids, batch_size=4, seed=seed), seed=seed
+        )
+
+    batch_sampler = make_bucket_sampler(seed=42)
+    batch_sampler.set_epoch(0)
+    pass_0 = list(batch_sampler)
+    # runs with different seeds go through different orders
+    other = make_bucket_sampler(seed=7)
+    other.set_epoch(0)
+    assert list(other) != pass_0
+
+    # the seed restored from a checkpoint sets the order of the buckets
+    other.seed = 42
+    other.start_batch = 3
+    other.set_epoch(0)
+    assert list(other) == pass_0[3:]
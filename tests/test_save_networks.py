@@ -0,0 +1,92 @@
+import os
+import sys
+
+import torch
+
+sys.path.append(sys.path[0] + "/..")
+from models.base_model import BaseModel
+from options.train_options import TrainOptions
+
+
+class FeatureNetwork(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.pretrained = torch.nn.Linear(64, 64)
+        self.scratch = torch.nn.Linear(64, 8)
+
+
+class FrozenBackboneDiscriminator(torch.nn.Module):
+    """Discriminator with a pretrained frozen module, as projected discriminators"""
+
+    def __init__(self):
+        super().__init__()
+        self.freeze_feature_network = FeatureNetwork()
+        self.discriminator = torch.nn.BatchNorm1d(8)
+
+    def get_pretrained_modules(self):
+        return {"freeze_feature_network.pretrained": "frozen backbone"}
+
+
+def create_model(checkpoints_dir, save_D_trainable_only):
+    opt = TrainOptions().parse_json(
+        {
+            "dataroot": checkpoints_dir,
+            "checkpoints_dir": checkpoints_dir,
+            "name": "joligan_utest",
+            "gpu_ids": "-1",
+            "train_save_D_trainable_only": save_D_trainable_only,
+        }
+    )
+    opt.use_cuda = False
+    model = BaseModel(opt, rank=0)
+    os.makedirs(model.save_dir, exist_ok=True)
+    model.model_names = ["G_A", "D_A"]
+    model.netG_A = torch.nn.Conv2d(3, 3, 3)
+    model.netD_A = FrozenBackboneDiscriminator()
+    # the running statistics are saved as well
+    model.netD_A.discriminator.running_mean.uniform_()
+    return model
+
+
+def test_save_D_trainable_only(tmp_path):
+    model = create_model(str(tmp_path), save_D_trainable_only=True)
+    model.save_networks("latest")
+
+    checkpoint = torch.load(os.path.join(model.save_dir, "latest_net_D_A.pth"))
+    assert checkpoint["pretrained_modules"] == {
+        "freeze_feature_network.pretrained": "frozen backbone"
+    }
+    assert not any(
+        key.startswith("freeze_feature_network.pretrained.")
+        for key in checkpoint["state_dict"]
+    )
+    assert "freeze_feature_network.scratch.weight" in checkpoint["state_dict"]
+    # networks without pretrained modules are saved whole
+    assert "weight" in torch.load(os.path.join(model.save_dir, "latest_net_G_A.pth"))
+
+    loaded = create_model(str(tmp_path), save_D_trainable_only=True)
+    # pretrained modules keep the weights of their source
+    loaded.netD_A.freeze_feature_network.pretrained.load_state_dict(
+        model.netD_A.freeze_feature_network.pretrained.state_dict()
+    )
+    loaded.load_networks("latest")
+    for name in model.model_names:
+        state_dict = getattr(model, "net" + name).state_dict()
+        loaded_state_dict = getattr(loaded, "net" + name).state_dict()
+        assert state_dict.keys() == loaded_state_dict.keys()
+        for key in state_dict:
+            assert torch.equal(state_dict[key], loaded_state_dict[key]), key
+
+
+def test_save_D_whole(tmp_path):
+    model = create_model(str(tmp_path), save_D_trainable_only=False)
+    model.save_networks("latest")
+    checkpoint = torch.load(os.path.join(model.save_dir, "latest_net_D_A.pth"))
+    assert "freeze_feature_network.pretrained.weight" in checkpoint
+
+    loaded = create_model(str(tmp_path), save_D_trainable_only=False)
+    loaded.load_networks("latest")
+    assert torch.equal(
+        loaded.netD_A.freeze_feature_network.pretrained.weight,
+        model.netD_A.freeze_feature_network.pretrained.weight,
+    )
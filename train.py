@@ -61,6 +61,20 @@ def signal_handler(sig, frame):
     dist.destroy_process_group()
 
 
+def get_train_state(
+    opt, dataloader, epoch, epoch_iter, epoch_batches, total_iters, epoch_done
+):
+    """State of the training loop, saved with --train_save_state to resume training"""
+    return {
+        "epoch": epoch,
+        "epoch_iter": epoch_iter,
+        "epoch_done": epoch_done,
+        "total_iters": total_iters,
+        "train_epoch_count": opt.train_epoch_count,
+        "dataloader": dataloader.state_dict(None if epoch_done else epoch_batches),
+    }
+
+
 def train_gpu(rank, world_size, opt, dataset, dataset_temporal):
 
     if not opt.warning_mode:
@@ -88,7 +102,10 @@ def train_gpu(rank, world_size, opt, dataset, dataset_temporal):
     model = create_model(opt, rank)  # create a model given opt.model and other options
 
     if hasattr(model, "data_dependent_initialize"):
+        # the first pass of the training goes through all the batches
+        loader_state = dataloader.state_dict()
         data = next(iter(dataloader))
+        dataloader.load_state_dict(loader_state)
         model.data_dependent_initialize(data)
 
     model.setup(opt)  # regular setup: load and print networks; create schedulers
@@ -112,21 +129,57 @@ def train_gpu(rank, world_size, opt, dataset, dataset_temporal):
             opt.train_pool_size
         )
         model.real_A_val, model.real_B_val = (
-            model.real_A_val.to(model.device),
-            model.real_B_val.to(model.device),
+            model.input_to_device(model.real_A_val),
+            model.input_to_device(model.real_B_val),
         )
 
     if rank == 0 and opt.output_display_networks:
+        # the passes over the dataset stay the same on all ranks
+        loader_state = dataloader.state_dict()
         data = next(iter(dataloader))
+        dataloader.load_state_dict(loader_state)
         for path in model.save_networks_img(data):
             visualizer.display_img(path + ".png")
 
+    # the crop banks are shared by all ranks, and regenerated by a single one
+    crop_bank_refreshers = []
+    if rank == 0 and hasattr(dataset, "start_crop_bank_refresh"):
+        crop_bank_refreshers = dataset.start_crop_bank_refresh()
+
+    start_epoch = opt.train_epoch_count
+    resumed_epoch_iter = 0
+
+    if opt.train_continue:
+        train_state = model.load_training_state(
+            "iter_%d" % opt.train_load_iter
+            if opt.train_load_iter > 0
+            else opt.train_epoch
+        )
+        if train_state is not None:
+            # the learning rate schedule depends on the initial epoch count
+            opt.train_epoch_count = train_state["train_epoch_count"]
+            total_iters = train_state["total_iters"]
+            if train_state["epoch_done"]:
+                start_epoch = train_state["epoch"] + 1
+            else:  # the remaining batches of the epoch are loaded
+                start_epoch = train_state["epoch"]
+                resumed_epoch_iter = train_state["epoch_iter"]
+            dataloader.load_state_dict(train_state["dataloader"])
+            if rank == 0:
+                print(
+                    "resuming training at epoch %d, total_iters %d"
+                    % (start_epoch, total_iters)
+                )
+
     for epoch in range(
-        opt.train_epoch_count, opt.train_n_epochs + opt.train_n_epochs_decay + 1
+        start_epoch, opt.train_n_epochs + opt.train_n_epochs_decay + 1
     ):  # outer loop for different epochs; we save the model by <epoch_count>, <epoch_count>+<save_latest_freq>
         epoch_start_time = time.time()  # timer for entire epoch
         iter_data_time = time.time()  # timer for data loading per iteration
-        epoch_iter = 0  # the number of training iterations in current epoch, reset to 0 every epoch
+        epoch_iter = resumed_epoch_iter  # the number of training iterations in current epoch, reset to 0 every epoch
+        # the index of the next batch in current epoch, for resuming
+        epoch_batches = dataloader.batch_sampler.start_batch
+        resumed_epoch_iter = 0
         if rank == 0:
             visualizer.reset()  # reset the visualizer: make sure it saves the results to HTML at least once every epoch
 
@@ -148,31 +201,36 @@ def train_gpu(rank, world_size, opt, dataset, dataset_temporal):
             iter_start_time = time.time()  # timer for computation per iteration
             t_data_mini_batch = iter_start_time - iter_data_time
 
-            model.set_input(data)  # unpack data from dataloader and apply preprocessing
+            with model.profiler.span("set_input"):
+                # unpack data from dataloader and apply preprocessing
+                model.set_input(data)
 
-            if use_temporal:
-                model.set_input_temporal(temporal_data)
+                if use_temporal:
+                    model.set_input_temporal(temporal_data)
 
-            model.optimize_parameters()  # calculate loss functions, get gradients, update network weights
+            with model.profiler.span("optimize_parameters"):
+                model.optimize_parameters()  # calculate loss functions, get gradients, update network weights
 
             t_comp = (time.time() - iter_start_time) / opt.train_batch_size
 
             batch_size = model.get_current_batch_size() * len(opt.gpu_ids)
             total_iters += batch_size
             epoch_iter += batch_size
+            epoch_batches = dataloader.next_batch
 
             if rank == 0:
                 if (
                     total_iters % opt.output_display_freq < batch_size
                 ):  # display images on visdom and save images to a HTML file
                     save_result = total_iters % opt.output_update_html_freq == 0
-                    model.compute_visuals()
-                    visualizer.display_current_results(
-                        model.get_current_visuals(),
-                        epoch,
-                        save_result,
-                        params=model.get_display_param(),
-                    )
+                    with model.profiler.span("display_current_results"):
+                        model.compute_visuals()
+                        visualizer.display_current_results(
+                            model.get_current_visuals(),
+                            epoch,
+                            save_result,
+                            params=model.get_display_param(),
+                        )
 
                 if (
                     total_iters % opt.output_print_freq < batch_size
@@ -194,19 +252,35 @@ def train_gpu(rank, world_size, opt, dataset, dataset_temporal):
                         % (epoch, total_iters)
                     )
 
-                    model.save_networks("latest")
-                    model.export_networks("latest")
-
-                    if opt.train_save_by_iter:
-                        save_suffix = "iter_%d" % total_iters
-                        model.save_networks(save_suffix)
-                        model.export_networks(save_suffix)
+                    with model.profiler.span("save_networks"):
+                        model.save_networks("latest")
+                        model.export_networks("latest")
+
+                        if opt.train_save_by_iter:
+                            save_suffix = "iter_%d" % total_iters
+                            model.save_networks(save_suffix)
+                            model.export_networks(save_suffix)
+
+                        if opt.train_save_state:
+                            train_state = get_train_state(
+                                opt,
+                                dataloader,
+                                epoch,
+                                epoch_iter,
+                                epoch_batches,
+                                total_iters,
+                                epoch_done=False,
+                            )
+                            model.save_training_state("latest", train_state)
+                            if opt.train_save_by_iter:
+                                model.save_training_state(save_suffix, train_state)
 
                 if (
                     total_iters % opt.train_fid_every < batch_size
                     and opt.train_compute_fid
                 ):
-                    model.compute_fid(epoch, total_iters)
+                    with model.profiler.span("compute_fid"):
+                        model.compute_fid(epoch, total_iters)
                     if opt.output_display_id > 0:
                         fids = model.get_current_fids()
                         visualizer.plot_current_fid(
@@ -217,7 +291,8 @@ def train_gpu(rank, world_size, opt, dataset, dataset_temporal):
                     total_iters % opt.train_D_accuracy_every < batch_size
                     and opt.train_compute_D_accuracy
                 ):
-                    model.compute_D_accuracy()
+                    with model.profiler.span("compute_D_accuracy"):
+                        model.compute_D_accuracy()
                     if opt.output_display_id > 0:
                         accuracies = model.get_current_D_accuracies()
                         visualizer.plot_current_D_accuracies(
@@ -238,7 +313,8 @@ def train_gpu(rank, world_size, opt, dataset, dataset_temporal):
                     total_iters % opt.train_mask_miou_every < batch_size
                     and opt.train_mask_compute_miou
                 ):
-                    model.compute_miou()
+                    with model.profiler.span("compute_miou"):
+                        model.compute_miou()
                     if opt.output_display_id > 0:
                         miou = model.get_current_miou()
                         visualizer.plot_current_miou(
@@ -247,6 +323,8 @@ def train_gpu(rank, world_size, opt, dataset, dataset_temporal):
 
                 iter_data_time = time.time()
 
+            model.profiler.step()
+
         if (
             epoch % opt.train_save_epoch_freq == 0
         ):  # cache our model every <save_epoch_freq> epochs
@@ -261,6 +339,19 @@ def train_gpu(rank, world_size, opt, dataset, dataset_temporal):
                 model.export_networks("latest")
                 model.export_networks(epoch)
 
+                if opt.train_save_state:
+                    train_state = get_train_state(
+                        opt,
+                        dataloader,
+                        epoch,
+                        epoch_iter,
+                        epoch_batches,
+                        total_iters,
+                        epoch_done=True,
+                    )
+                    model.save_training_state("latest", train_state)
+                    model.save_training_state(epoch, train_state)
+
         if rank == 0:
             print(
                 "End of epoch %d / %d \t Time Taken: %d sec"
@@ -270,6 +361,11 @@ def train_gpu(rank, world_size, opt, dataset, dataset_temporal):
                     time.time() - epoch_start_time,
                 )
             )
+            if hasattr(dataloader, "reset_data_wait_time"):  # --data_prefetch_batches
+                print(
+                    "Time waiting for data: %.1f sec"
+                    % dataloader.reset_data_wait_time()
+                )
         model.update_learning_rate()  # update learning rates at the end of every epoch.
 
     ###Let's compute final FID
@@ -288,6 +384,14 @@ def train_gpu(rank, world_size, opt, dataset, dataset_temporal):
             )
             json.dump(data, outfile)
 
+    model.profiler.close()
+    if model.checkpoint_writer is not None:
+        model.checkpoint_writer.close()
+    if model.export_worker is not None:
+        model.export_worker.close()
+    for refresher in crop_bank_refreshers:
+        refresher.close()
+
     if rank == 0:
         print("End of training")
 
@@ -0,0 +1,355 @@
+import math
+import torch
+import torch.nn.functional as F
+
+
+class BatchGeometricAug:
+    """Random flip, rotation and affine augmentations of a batch of images and masks.
+
+    Same family of transforms as the per-sample dataloader ones (see get_transform and
+    get_transform_seg in data/base_dataset.py), with random parameters drawn per sample,
+    composed into a single affine matrix and applied to the whole batch with one
+    affine_grid/grid_sample call. Masks are resampled with nearest interpolation.
+    Runs on the device of the tensors it is given.
+
+    Parameters:
+        flip (bool)            -- random horizontal flips
+        rotate (bool)          -- random rotations
+        right_angles (bool)    -- rotations by 0, 90, 180 or 270 degrees (as for images with masks),
+                                  by a random angle in [-90, 180] otherwise
+        affine (float)         -- probability of a random affine transform
+        translate (float)      -- maximum translation, as a fraction of the image size
+        scale_min (float)      -- minimum scale
+        scale_max (float)      -- maximum scale
+        shear (float)          -- maximum shear angle in degrees
+    """
+
+    def __init__(
+        self,
+        flip=True,
+        rotate=True,
+        right_angles=True,
+        affine=0.0,
+        translate=0.2,
+        scale_min=0.8,
+        scale_max=1.2,
+        shear=45,
+    ):
+        self.flip = flip
+        self.rotate = rotate
+        self.right_angles = right_angles
+        self.affine = affine
+        self.translate = translate
+        self.scale_min = scale_min
+        self.scale_max = scale_max
+        self.shear = shear
+
+    def get_params(self, batch_size, height, width, device):
+        """Draw per sample (N, 3, 3) forward transforms, in pixel coordinates centered on the image."""
+        params = torch.eye(3, device=device).repeat(batch_size, 1, 1)
+
+        if self.flip:
+            flip = torch.rand(batch_size, device=device) < 0.5
+            params[flip, 0, 0] = -1
+
+        if self.rotate:
+            if self.right_angles:
+                angle = torch.randint(0, 4, (batch_size,), device=device).float() * 90.0
+            else:
+                angle = torch.empty(batch_size, device=device).uniform_(-90.0, 180.0)
+            angle = angle * math.pi / 180.0
+            cos, sin = torch.cos(angle), torch.sin(angle)
+            # rotations are counter-clockwise, as with torchvision, y axis pointing down
+            rotation = torch.eye(3, device=device).repeat(batch_size, 1, 1)
+            rotation[:, 0, 0] = cos
+            rotation[:, 0, 1] = sin
+            rotation[:, 1, 0] = -sin
+            rotation[:, 1, 1] = cos
+            params = rotation @ params
+
+        if self.affine > 0:
+            apply = torch.rand(batch_size, device=device) < self.affine
+            scale = torch.empty(batch_size, device=device).uniform_(
+                self.scale_min, self.scale_max
+            )
+            shear = torch.empty(batch_size, device=device).uniform_(
+                -self.shear, self.shear
+            )
+            tx = torch.empty(batch_size, device=device).uniform_(-1, 1)
+            ty = torch.empty(batch_size, device=device).uniform_(-1, 1)
+
+            affine = torch.eye(3, device=device).repeat(batch_size, 1, 1)
+            affine[:, 0, 0] = scale
+            affine[:, 0, 1] = -scale * torch.tan(shear * math.pi / 180.0)
+            affine[:, 1, 1] = scale
+            affine[:, 0, 2] = torch.round(tx * self.translate * width)
+            affine[:, 1, 2] = torch.round(ty * self.translate * height)
+            affine[~apply] = torch.eye(3, device=device)
+            params = affine @ params
+
+        return params
+
+    def get_theta(self, params, height, width):
+        """(N, 2, 3) affine_grid matrices, mapping output to input normalized coordinates."""
+        to_pixels = torch.diag(
+            torch.tensor([width / 2.0, height / 2.0, 1.0], device=params.device)
+        )
+        to_normalized = torch.diag(
+            torch.tensor([2.0 / width, 2.0 / height, 1.0], device=params.device)
+        )
+        theta = to_normalized @ torch.linalg.inv(params) @ to_pixels
+        return theta[:, :2]
+
+    def __call__(self, imgs, masks=None, params=None, fill=0.0, nb_frames=1):
+        """Augment imgs (N, C, H, W) and masks (N, 1, H, W) or (N, H, W) with the same per-sample transforms.
+
+        params can be given to apply the transforms drawn for another batch (e.g. paired images),
+        areas out of the source images are filled with fill (e.g. -1 for normalized images).
+        With nb_frames > 1, each group of nb_frames consecutive images (e.g. the frames of a
+        nuplet) gets the same transform.
+        Returns the augmented imgs, masks and the params that were used.
+        """
+        batch_size, _, height, width = imgs.shape
+        if params is None:
+            params = self.get_params(
+                batch_size // nb_frames, height, width, imgs.device
+            ).repeat_interleave(nb_frames, dim=0)
+        theta = self.get_theta(params, height, width)
+        grid = F.affine_grid(theta, imgs.shape, align_corners=False)
+
+        imgs_dtype = imgs.dtype
+        imgs = F.grid_sample(
+            imgs.float() - fill,
+            grid,
+            mode="bilinear",
+            padding_mode="zeros",
+            align_corners=False,
+        )
+        imgs = imgs + fill
+        if imgs_dtype == torch.uint8:
+            imgs = imgs.round().clamp(0, 255)
+        imgs = imgs.to(imgs_dtype)
+
+        if masks is not None:
+            masks_dtype, masks_shape = masks.dtype, masks.shape
+            masks = masks.reshape(batch_size, 1, height, width).float()
+            masks = F.grid_sample(
+                masks, grid, mode="nearest", padding_mode="zeros", align_corners=False
+            )
+            masks = masks.to(masks_dtype).reshape(masks_shape)
+
+        return imgs, masks, params
+
+
+def rgb_to_hsv(imgs):
+    """(N, 3, H, W) RGB images in [0, 1] to HSV, all channels in [0, 1]."""
+    r, g, b = imgs.unbind(dim=1)
+    maxc, _ = imgs.max(dim=1)
+    minc, _ = imgs.min(dim=1)
+    delta = maxc - minc
+    s = delta / maxc.clamp(min=1e-8)
+    delta_safe = torch.where(delta > 0, delta, torch.ones_like(delta))
+    rc = (maxc - r) / delta_safe
+    gc = (maxc - g) / delta_safe
+    bc = (maxc - b) / delta_safe
+    h = torch.where(
+        maxc == r, bc - gc, torch.where(maxc == g, 2.0 + rc - bc, 4.0 + gc - rc)
+    )
+    h = torch.where(delta > 0, (h / 6.0) % 1.0, torch.zeros_like(h))
+    return torch.stack([h, s, maxc], dim=1)
+
+
+def hsv_to_rgb(imgs):
+    """(N, 3, H, W) HSV images, all channels in [0, 1], to RGB in [0, 1]."""
+    h, s, v = imgs[:, 0:1], imgs[:, 1:2], imgs[:, 2:3]
+    # channel c is v - v * s * clamp(min(k, 4 - k), 0, 1), with k = (n + 6 * h) mod 6
+    # and n = 5, 3, 1 for red, green and blue
+    n = torch.tensor([5.0, 3.0, 1.0], device=imgs.device).view(1, 3, 1, 1)
+    k = (n + h * 6.0) % 6.0
+    return v - v * s * torch.minimum(k, 4.0 - k).clamp(0, 1)
+
+
+class BatchPhotometricAug:
+    """Random photometric augmentations of a batch of RGB images, as tensors.
+
+    Batched counterpart of RandomImgAug in data/base_dataset.py: each sample gets between
+    0 and max_ops operations among gaussian blur, sharpen, emboss, additive gaussian noise,
+    channel inversion, brightness, hue and saturation, multiply, contrast and grayscale,
+    with the same parameter ranges as the imgaug pipeline, drawn per sample.
+    Each operation is computed at once for all the samples it was selected for.
+    Operations are applied in a fixed order, and the slowest imgaug ones (superpixels,
+    median blur, edge detection and frequency noise blending) have no equivalent.
+
+    Images are either uint8 in [0, 255] or float normalized to [-1, 1], and are returned
+    with the same dtype and range. Masks are not modified. Groups of consecutive images,
+    e.g. the frames of a nuplet, can share the same operations and parameters.
+
+    Parameters:
+        max_ops (int) -- maximum number of operations per sample
+    """
+
+    ops = [
+        "blur",
+        "sharpen",
+        "emboss",
+        "noise",
+        "invert",
+        "add",
+        "hue_saturation",
+        "multiply",
+        "contrast",
+        "grayscale",
+    ]
+
+    def __init__(self, max_ops=5):
+        self.max_ops = max_ops
+        self.nb_frames = 1
+
+    def rand(self, batch_size, *shape, device=None):
+        """Uniform values in [0, 1) drawn per sample, and shared by the nb_frames images of a group."""
+        values = torch.rand(batch_size // self.nb_frames, *shape, device=device)
+        return values.repeat_interleave(self.nb_frames, dim=0)
+
+    def uniform(self, low, high, batch_size, *shape, device=None):
+        return low + (high - low) * self.rand(batch_size, *shape, device=device)
+
+    def per_channel(self, low, high, batch_size, p, device):
+        """Per sample factors, (N, 3, 1, 1), drawn per channel for a fraction p of the samples."""
+        values = self.uniform(low, high, batch_size, 3, device=device)
+        same = self.rand(batch_size, device=device) >= p
+        values[same] = values[same, :1].expand(-1, 3)
+        return values.view(batch_size, 3, 1, 1)
+
+    def filter(self, imgs, kernels):
+        """Convolve each image with its own (N, k, k) kernel, with replicate padding."""
+        batch_size, channels, height, width = imgs.shape
+        k = kernels.shape[-1]
+        weight = kernels.repeat_interleave(channels, dim=0).unsqueeze(1)
+        out = F.pad(
+            imgs.reshape(1, batch_size * channels, height, width),
+            [k // 2] * 4,
+            mode="replicate",
+        )
+        out = F.conv2d(out, weight, groups=batch_size * channels)
+        return out.view(batch_size, channels, height, width)
+
+    def blur(self, imgs):
+        batch_size, channels, height, width = imgs.shape
+        sigma = self.uniform(0.0, 3.0, batch_size, 1, device=imgs.device).clamp(
+            min=1e-3
+        )
+        radius = max(1, math.ceil(3 * sigma.max().item()))
+        x = torch.arange(-radius, radius + 1, device=imgs.device).float()
+        kernels = torch.exp(-(x**2) / (2 * sigma**2))
+        kernels = kernels / kernels.sum(dim=1, keepdim=True)
+        kernels = kernels.repeat_interleave(channels, dim=0)
+
+        # separable filter, horizontal then vertical
+        out = imgs.reshape(1, batch_size * channels, height, width)
+        out = F.pad(out, [radius, radius, 0, 0], mode="replicate")
+        out = F.conv2d(out, kernels.view(-1, 1, 1, 2 * radius + 1), groups=out.shape[1])
+        out = F.pad(out, [0, 0, radius, radius], mode="replicate")
+        out = F.conv2d(out, kernels.view(-1, 1, 2 * radius + 1, 1), groups=out.shape[1])
+        return out.view(batch_size, channels, height, width)
+
+    def sharpen(self, imgs):
+        batch_size = imgs.shape[0]
+        alpha = self.uniform(0.0, 1.0, batch_size, 1, 1, device=imgs.device)
+        lightness = self.uniform(0.75, 1.5, batch_size, 1, 1, device=imgs.device)
+        identity = torch.zeros(3, 3, device=imgs.device)
+        identity[1, 1] = 1
+        effect = -torch.ones(batch_size, 3, 3, device=imgs.device)
+        effect[:, 1, 1] = 8 + lightness[:, 0, 0]
+        return self.filter(imgs, (1 - alpha) * identity + alpha * effect)
+
+    def emboss(self, imgs):
+        batch_size = imgs.shape[0]
+        alpha = self.uniform(0.0, 1.0, batch_size, 1, 1, device=imgs.device)
+        strength = self.uniform(0.0, 2.0, batch_size, 1, 1, device=imgs.device)
+        identity = torch.zeros(3, 3, device=imgs.device)
+        identity[1, 1] = 1
+        # [[-1 - s, -s, 0], [-s, 1, s], [0, s, 1 + s]]
+        base = torch.tensor(
+            [[-1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]], device=imgs.device
+        )
+        direction = torch.tensor(
+            [[-1.0, -1.0, 0.0], [-1.0, 0.0, 1.0], [0.0, 1.0, 1.0]], device=imgs.device
+        )
+        effect = base + strength * direction
+        return self.filter(imgs, (1 - alpha) * identity + alpha * effect)
+
+    def noise(self, imgs):
+        batch_size, _, height, width = imgs.shape
+        scale = self.uniform(0.0, 0.05, batch_size, 1, 1, 1, device=imgs.device)
+        noise = torch.randn(
+            batch_size // self.nb_frames, 3, height, width, device=imgs.device
+        ).repeat_interleave(self.nb_frames, dim=0)
+        same = self.rand(batch_size, device=imgs.device) >= 0.5
+        noise[same] = noise[same, :1].expand(-1, 3, -1, -1)
+        return imgs + scale * noise
+
+    def invert(self, imgs):
+        invert = self.rand(imgs.shape[0], 3, 1, 1, device=imgs.device) < 0.05
+        return torch.where(invert, 1.0 - imgs, imgs)
+
+    def add(self, imgs):
+        return imgs + self.per_channel(
+            -5.0 / 255, 5.0 / 255, imgs.shape[0], 0.5, imgs.device
+        )
+
+    def hue_saturation(self, imgs):
+        # imgaug adds the same value in [-20, 20] to hue and saturation, both on a 0-255 scale
+        value = self.uniform(-20.0, 20.0, imgs.shape[0], 1, 1, device=imgs.device) / 255
+        h, s, v = rgb_to_hsv(imgs.clamp(0, 1)).unbind(dim=1)
+        return hsv_to_rgb(torch.stack([h + value, (s + value).clamp(0, 1), v], dim=1))
+
+    def multiply(self, imgs):
+        return imgs * self.per_channel(0.5, 1.5, imgs.shape[0], 0.5, imgs.device)
+
+    def contrast(self, imgs):
+        alpha = self.per_channel(0.5, 2.0, imgs.shape[0], 0.5, imgs.device)
+        return 0.5 + alpha * (imgs - 0.5)
+
+    def grayscale(self, imgs):
+        alpha = self.uniform(0.0, 1.0, imgs.shape[0], 1, 1, 1, device=imgs.device)
+        gray = (
+            0.299 * imgs[:, 0:1] + 0.587 * imgs[:, 1:2] + 0.114 * imgs[:, 2:3]
+        ).expand_as(imgs)
+        return alpha * gray + (1 - alpha) * imgs
+
+    def get_params(self, batch_size, device):
+        """(N, nb ops) boolean selection of the operations applied to each sample."""
+        nb_ops = (self.rand(batch_size, 1, device=device) * (self.max_ops + 1)).long()
+        ranks = self.rand(batch_size, len(self.ops), device=device).argsort(dim=1)
+        return ranks < nb_ops
+
+    def __call__(self, imgs, params=None, nb_frames=1):
+        """Augment imgs (N, 3, H, W), returns the augmented imgs and the selected operations.
+
+        With nb_frames > 1, each group of nb_frames consecutive images (e.g. the frames of a
+        nuplet) gets the same operations with the same parameters.
+        """
+        if imgs.shape[1] != 3:
+            return imgs, None
+        self.nb_frames = nb_frames
+        if params is None:
+            params = self.get_params(imgs.shape[0], imgs.device)
+
+        imgs_dtype = imgs.dtype
+        if imgs_dtype == torch.uint8:
+            out = imgs.float() / 255
+        else:
+            out = (imgs.float() + 1) / 2
+
+        for i, op in enumerate(self.ops):
+            selected = params[:, i]
+            if not selected.any():
+                continue
+            # operations are only computed for the samples they were selected for
+            out[selected] = getattr(self, op)(out[selected]).clamp(0, 1)
+
+        if imgs_dtype == torch.uint8:
+            out = (out * 255).round().clamp(0, 255)
+        else:
+            out = out * 2 - 1
+        return out.to(imgs_dtype), params
@@ -0,0 +1,187 @@
+"""Checkpoints written in the background of training.
+
+A CheckpointWriter takes snapshots of state_dicts to CPU memory, pinned when they come
+from a CUDA device so that the device-to-host copy is asynchronous, and writes them to
+disk on a background thread. Each file is written next to its destination and renamed
+once complete, so that a checkpoint on disk is never partially written. At most
+max_pending snapshots are held in memory: when that many are still being written, the
+next one waits for the oldest to complete.
+
+Pinned buffers are reused across snapshots of tensors of the same shape and type.
+Callbacks can be queued behind the pending snapshots, e.g. to export written networks.
+"""
+import collections
+import copy
+import os
+import queue
+import threading
+import time
+import torch
+
+_END = object()
+
+
+class CheckpointWriter:
+    """Background writer of state_dicts.
+
+    Parameters:
+        max_pending (int) -- maximum number of snapshots held in memory until written
+        verbose (bool)    -- whether the latency of each snapshot is printed
+    """
+
+    def __init__(self, max_pending=2, verbose=True):
+        self.max_pending = max_pending
+        self.verbose = verbose
+        self.pending = threading.Semaphore(max_pending)
+        self.jobs = queue.Queue()
+        self.free_buffers = collections.defaultdict(list)
+        self.buffers_lock = threading.Lock()
+        self.error = None
+        self.total_snapshot_time = 0.0
+        self.total_wait_time = 0.0
+        self.total_write_time = 0.0
+        self.nb_snapshots = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def get_buffer(self, tensor):
+        key = (tuple(tensor.shape), tensor.dtype)
+        with self.buffers_lock:
+            if len(self.free_buffers[key]) > 0:
+                return self.free_buffers[key].pop()
+        try:
+            return torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+        except RuntimeError:  # pinned memory is not available
+            return torch.empty(tensor.shape, dtype=tensor.dtype)
+
+    def release_buffers(self, buffers):
+        with self.buffers_lock:
+            for buffer in buffers:
+                self.free_buffers[(tuple(buffer.shape), buffer.dtype)].append(buffer)
+
+    def snapshot_state_dict(self, state_dict, buffers):
+        """Copy of state_dict in CPU memory, copies from CUDA tensors are asynchronous.
+
+        Nested dicts and lists, e.g. of optimizer states, are copied as well.
+        """
+        if torch.is_tensor(state_dict):
+            if state_dict.is_cuda:
+                buffer = self.get_buffer(state_dict)
+                buffer.copy_(state_dict.detach(), non_blocking=buffer.is_pinned())
+                buffers.append(buffer)
+                return buffer
+            return state_dict.detach().clone()
+        if isinstance(state_dict, dict):
+            if isinstance(state_dict, collections.OrderedDict):
+                snapshot = collections.OrderedDict()
+            else:
+                snapshot = {}
+            for key, value in state_dict.items():
+                snapshot[key] = self.snapshot_state_dict(value, buffers)
+            if hasattr(state_dict, "_metadata"):
+                snapshot._metadata = state_dict._metadata
+            return snapshot
+        if isinstance(state_dict, (list, tuple)):
+            return type(state_dict)(
+                self.snapshot_state_dict(value, buffers) for value in state_dict
+            )
+        return copy.deepcopy(state_dict)
+
+    def save(self, state_dicts, name=""):
+        """Snapshot state_dicts, a dict of destination paths to state_dicts, and write them in the background.
+
+        Only the device-to-host copy is done before returning, unless max_pending
+        snapshots are still being written, in which case the oldest is waited for.
+        """
+        self.check_error()
+
+        wait_start = time.time()
+        self.pending.acquire()
+        wait_time = time.time() - wait_start
+
+        snapshot_start = time.time()
+        buffers = []
+        snapshots = {
+            path: self.snapshot_state_dict(state_dict, buffers)
+            for path, state_dict in state_dicts.items()
+        }
+        event = None
+        if any(buffer.is_pinned() for buffer in buffers):
+            event = torch.cuda.Event()
+            event.record()
+        snapshot_time = time.time() - snapshot_start
+
+        self.total_wait_time += wait_time
+        self.total_snapshot_time += snapshot_time
+        self.nb_snapshots += 1
+        self.jobs.put((name, snapshots, buffers, event, wait_time, snapshot_time))
+
+    def call_when_written(self, callback):
+        """Call callback on the background thread, once the pending snapshots are written"""
+        self.jobs.put(callback)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is _END:
+                return
+            if callable(job):
+                try:
+                    job()
+                except Exception as e:
+                    print("failed calling ", job)
+                    print(e)
+                continue
+            name, snapshots, buffers, event, wait_time, snapshot_time = job
+            try:
+                write_start = time.time()
+                if event is not None:
+                    event.synchronize()
+                for path, snapshot in snapshots.items():
+                    tmp_path = path + ".tmp"
+                    torch.save(snapshot, tmp_path)
+                    os.replace(tmp_path, path)
+                write_time = time.time() - write_start
+                self.total_write_time += write_time
+                if self.verbose:
+                    print(
+                        "checkpoint %s written: waited %.2fs, snapshot %.2fs, write %.2fs in background"
+                        % (name, wait_time, snapshot_time, write_time)
+                    )
+            except Exception as e:
+                print("failed writing checkpoint ", name)
+                print(e)
+                self.error = e
+            finally:
+                del snapshots
+                self.release_buffers(buffers)
+                self.pending.release()
+
+    def check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("a background checkpoint write failed") from error
+
+    def wait(self):
+        """Wait until all the snapshots are written"""
+        for _ in range(self.max_pending):
+            self.pending.acquire()
+        for _ in range(self.max_pending):
+            self.pending.release()
+        self.check_error()
+
+    def close(self):
+        """Write the remaining snapshots and stop the background thread"""
+        self.wait()
+        self.jobs.put(_END)
+        self.thread.join()
+        if self.verbose and self.nb_snapshots > 0:
+            print(
+                "%d checkpoints: waited %.1fs, snapshot %.1fs in training, write %.1fs in background"
+                % (
+                    self.nb_snapshots,
+                    self.total_wait_time,
+                    self.total_snapshot_time,
+                    self.total_write_time,
+                )
+            )
@@ -0,0 +1,152 @@
+"""Export of generators to ONNX and TorchScript, in a separate process.
+
+An ExportWorker process rebuilds the generators on CPU from the train_config.json of
+the run, and exports the saved .pth files it is sent, next to them, so that training
+neither waits for tracing nor allocates its memory on the training device. When several
+jobs for the same file are queued, e.g. successive 'latest' checkpoints, only the most
+recent one is exported.
+"""
+import json
+import multiprocessing
+import os
+import queue
+import time
+import torch
+
+_END = None
+
+
+def get_onnx_opset_version(G_netG):
+    if "segformer" in G_netG:
+        return 11
+    elif "ittr" in G_netG:
+        return 12
+    else:
+        return 9
+
+
+def export_network(net, opt, save_path):
+    """Export net, whose weights were saved at save_path, to ONNX and with --train_export_jit to TorchScript"""
+    input_nc = opt.model_input_nc
+    if opt.model_multimodal:
+        input_nc += opt.train_mm_nz
+
+    dummy_input = torch.randn(
+        1,
+        input_nc,
+        opt.data_crop_size,
+        opt.data_crop_size,
+        device=next(net.parameters()).device,
+    )
+
+    # onnx
+    if not "ittr" in opt.G_netG and not "unet_mha" in opt.G_netG:
+        export_path_onnx = save_path.replace(".pth", ".onnx")
+        torch.onnx.export(
+            net,
+            dummy_input,
+            export_path_onnx + ".tmp",
+            verbose=False,
+            opset_version=get_onnx_opset_version(opt.G_netG),
+        )
+        os.replace(export_path_onnx + ".tmp", export_path_onnx)
+
+    # jit
+    if opt.train_export_jit and not "segformer" in opt.G_netG:
+        export_path_jit = save_path.replace(".pth", ".pt")
+        jit_model = torch.jit.trace(net, dummy_input)
+        jit_model.save(export_path_jit + ".tmp")
+        os.replace(export_path_jit + ".tmp", export_path_jit)
+
+
+def load_generator(config_path, jg_dir):
+    """Rebuild the generator of a run on CPU, from its train_config.json"""
+    from models import gan_networks
+    from options.train_options import TrainOptions
+
+    with open(config_path, "r") as jsonf:
+        train_json = json.load(jsonf)
+    opt = TrainOptions().parse_json(train_json)
+    opt.jg_dir = jg_dir
+
+    model_input_nc = opt.model_input_nc
+    if opt.model_multimodal:
+        opt.model_input_nc += opt.train_mm_nz
+    net = gan_networks.define_G(**vars(opt))
+    opt.model_input_nc = model_input_nc
+    net.eval()
+    return net, opt
+
+
+def export_loop(jobs, config_path, jg_dir, num_threads):
+    torch.set_num_threads(num_threads)
+    net, opt = load_generator(config_path, jg_dir)
+
+    end = False
+    while not end:
+        pending = [jobs.get()]
+        while True:
+            try:
+                pending.append(jobs.get_nowait())
+            except queue.Empty:
+                break
+
+        # only the most recent job for each file is exported
+        save_paths = []
+        for job in pending:
+            if job is _END:
+                end = True
+                continue
+            if job in save_paths:
+                save_paths.remove(job)
+            save_paths.append(job)
+        nb_skipped = len(pending) - len(save_paths) - int(end)
+        if nb_skipped > 0:
+            print("export: skipped %d stale jobs" % nb_skipped)
+
+        for save_path in save_paths:
+            export_start = time.time()
+            try:
+                state_dict = torch.load(save_path, map_location="cpu")
+                net.load_state_dict(state_dict)
+                with torch.no_grad():
+                    export_network(net, opt, save_path)
+                print("exported %s in %.1fs" % (save_path, time.time() - export_start))
+            except Exception as e:
+                print("failed exporting ", save_path)
+                print(e)
+
+
+class ExportWorker:
+    """Process that exports the generator weights it is sent.
+
+    Parameters:
+        config_path (str) -- train_config.json of the run
+        jg_dir (str)      -- joliGAN directory, for model configuration files
+        num_threads (int) -- CPU threads used by the export
+    """
+
+    def __init__(self, config_path, jg_dir, num_threads=1):
+        if not os.path.isfile(config_path):
+            raise ValueError(
+                "exporting in the background requires the train config at %s"
+                % config_path
+            )
+        # the training process may have initialized CUDA, which cannot be forked
+        context = multiprocessing.get_context("spawn")
+        self.jobs = context.Queue()
+        self.process = context.Process(
+            target=export_loop,
+            args=(self.jobs, config_path, jg_dir, num_threads),
+            daemon=True,
+        )
+        self.process.start()
+
+    def export(self, save_path):
+        """Queue the export of the generator weights saved at save_path"""
+        self.jobs.put(save_path)
+
+    def close(self):
+        """Export the remaining jobs and stop the process"""
+        self.jobs.put(_END)
+        self.process.join()
@@ -0,0 +1,162 @@
+"""Per-phase timing of training iterations.
+
+Named spans are recorded with their CPU wall time, and on CUDA with their device time
+measured by CUDA events, which are only read when spans are flushed so that recording
+never synchronizes the device. Every `summary_every` iterations, spans are flushed:
+  - appended to profile_trace.json in the checkpoints directory, in the Chrome trace
+    event format (open with chrome://tracing or https://ui.perfetto.dev)
+  - aggregated per name into a summary table, printed and appended to profile_summary.txt
+
+When disabled, span() returns a shared no-op context manager.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+import torch
+
+_NO_SPAN = contextlib.nullcontext()
+
+
+class _Span:
+    __slots__ = ("profiler", "name", "start", "start_event", "end_event")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        if self.profiler.use_cuda:
+            self.start_event = torch.cuda.Event(enable_timing=True)
+            self.end_event = torch.cuda.Event(enable_timing=True)
+            self.start_event.record()
+        else:
+            self.start_event = self.end_event = None
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        if self.end_event is not None:
+            self.end_event.record()
+        self.profiler.spans.append(
+            (
+                self.name,
+                threading.get_ident(),
+                self.start,
+                end - self.start,
+                self.start_event,
+                self.end_event,
+            )
+        )
+        return False
+
+
+class Profiler:
+    """Records named spans of training iterations.
+
+    Parameters:
+        enabled (bool)        -- whether spans are recorded
+        save_dir (str)        -- where the trace and summaries are written
+        device (torch.device) -- device whose time is measured as well, when CUDA
+        summary_every (int)   -- iterations between flushes of the spans
+    """
+
+    def __init__(self, enabled=False, save_dir=None, device=None, summary_every=100):
+        self.enabled = enabled
+        self.save_dir = save_dir
+        self.use_cuda = device is not None and torch.device(device).type == "cuda"
+        self.summary_every = summary_every
+        self.spans = []
+        self.iteration = 0
+        self.origin = time.perf_counter_ns()
+        self.trace_started = False
+        self.flushed_iteration = 0
+
+    def span(self, name):
+        """Context manager that records the time spent in its block under name"""
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self, name)
+
+    def step(self):
+        """Mark the end of a training iteration, and flush spans every summary_every iterations"""
+        if not self.enabled:
+            return
+        self.iteration += 1
+        if self.iteration % self.summary_every == 0:
+            self.flush()
+
+    def flush(self):
+        if not self.enabled or len(self.spans) == 0:
+            return
+        spans, self.spans = self.spans, []
+        if self.use_cuda:
+            spans[-1][5].synchronize()
+
+        events = []
+        stats = {}
+        pid = os.getpid()
+        for name, tid, start, duration, start_event, end_event in spans:
+            event = {
+                "name": name,
+                "ph": "X",
+                "pid": pid,
+                "tid": tid,
+                "ts": (start - self.origin) / 1000,
+                "dur": duration / 1000,
+            }
+            device_ms = None
+            if start_event is not None:
+                device_ms = start_event.elapsed_time(end_event)
+                event["args"] = {"device_ms": device_ms}
+            events.append(event)
+
+            stat = stats.setdefault(name, [0, 0.0, 0.0])
+            stat[0] += 1
+            stat[1] += duration / 1e6
+            if device_ms is not None:
+                stat[2] += device_ms
+
+        self.write_trace(events)
+        self.write_summary(stats)
+        self.flushed_iteration = self.iteration
+
+    def write_trace(self, events):
+        """Append events to the trace, in the json array format whose closing bracket is optional"""
+        trace_path = os.path.join(self.save_dir, "profile_trace.json")
+        with open(trace_path, "a" if self.trace_started else "w") as f:
+            if not self.trace_started:
+                f.write("[\n")
+            for event in events:
+                f.write(json.dumps(event) + ",\n")
+        self.trace_started = True
+
+    def write_summary(self, stats):
+        lines = [
+            "profile of iterations %d to %d"
+            % (self.flushed_iteration + 1, self.iteration),
+            "%-48s %8s %12s %14s %12s"
+            % ("span", "calls", "cpu ms/call", "device ms/call", "cpu total s"),
+        ]
+        for name, (count, cpu_ms, device_ms) in sorted(
+            stats.items(), key=lambda item: -item[1][1]
+        ):
+            lines.append(
+                "%-48s %8d %12.2f %14s %12.2f"
+                % (
+                    name[:48],
+                    count,
+                    cpu_ms / count,
+                    "%.2f" % (device_ms / count) if self.use_cuda else "-",
+                    cpu_ms / 1000,
+                )
+            )
+        summary = "\n".join(lines)
+        print(summary)
+        with open(os.path.join(self.save_dir, "profile_summary.txt"), "a") as f:
+            f.write(summary + "\n\n")
+
+    def close(self):
+        self.flush()